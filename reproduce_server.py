@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Run Reproducible commands without starting a new Python for each one.
+
+Usage:
+  reproduce_server.py <reproduce> <request_fd> <response_fd>
+
+The server compiles the reproduce script and imports the modules it needs
+once, then reads one JSON request per line from <request_fd>, such as
+  {"arguments": ["log", "-n1"], "cwd": "/path/to/run", "stdout": null}
+For each request it forks a copy of itself that runs the script in the
+given folder, optionally with its output written to the file "stdout",
+and writes the return code and resource usage of that copy as one JSON
+line to <response_fd>. The server stops when the request pipe is closed.
+
+It only uses the standard library, so it runs with the same Python as
+Reproducible itself.
+"""
+
+import sys
+import os
+import ast
+import json
+import time
+import traceback
+
+USAGE_FIELDS = ['ru_utime', 'ru_stime', 'ru_maxrss', 'ru_inblock',
+                'ru_oublock', 'ru_nvcsw', 'ru_nivcsw']
+
+
+def preload_modules(tree):
+    """Import the top-level modules of a script ahead of the first run"""
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            try:
+                __import__(name)
+            except Exception:
+                pass
+
+
+def run_request(code, script, request):
+    """Run the script for one request in a forked copy of the server"""
+    status = 1
+    try:
+        os.chdir(request['cwd'])
+        if request.get('stdout'):
+            output = os.open(request['stdout'],
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(output, 1)
+            os.close(output)
+        sys.argv = [script] + request['arguments']
+        exec(code, {'__name__': '__main__', '__file__': script})
+        status = 0
+    except SystemExit as error:
+        if error.code is None:
+            status = 0
+        elif isinstance(error.code, int):
+            status = error.code
+        else:
+            print(error.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def serve(script, requests, responses):
+    """Fork a copy for each request and report how it finished"""
+    with open(script, 'r') as f:
+        source = f.read()
+    tree = ast.parse(source, script)
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    preload_modules(tree)
+    code = compile(tree, script, 'exec')
+    for line in requests:
+        request = json.loads(line)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        start_time = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            requests.close()
+            responses.close()
+            run_request(code, script, request)
+        _, status, rusage = os.wait4(pid, 0)
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        response = {'returncode': returncode,
+                    'wall_time': time.perf_counter() - start_time,
+                    'usage': {field: getattr(rusage, field)
+                              for field in USAGE_FIELDS}}
+        responses.write(json.dumps(response) + '\n')
+        responses.flush()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        sys.exit(__doc__)
+    with os.fdopen(int(sys.argv[2]), 'r') as requests:
+        with os.fdopen(int(sys.argv[3]), 'w') as responses:
+            serve(sys.argv[1], requests, responses)
@@ -2,13 +2,29 @@
 """Run a batch of simulations reproducibly.
 
 Usage:
+  run_batch.py daemon [--jobs=<n>] [--socket=<path>]
+  run_batch.py status [<batch>] [--socket=<path>]
+  run_batch.py cancel <batch> [--socket=<path>]
+  run_batch.py wait [<batch>] [--socket=<path>]
+  run_batch.py query [--where=<condition>] [--input_branch=<branch>]...
+                     [--since=<date>] [--until=<date>]
+  run_batch.py prune [--keep-full=<days>] [--compress-after=<days>]
+                     [--archive-format=<format>] [--jobs=<n>]
+  run_batch.py --worker=<folder> [--jobs=<n>] [--requeue-after=<hours>]
   run_batch.py <command>
   run_batch.py [options] [--] <command>
-  run_batch.py [--git [--input_branch=<branch>]... [--results_branch=<branch>]]
-               [--archive [--full]] [--class=<class>]
-               [--sweep=<sweep>]...
+  run_batch.py [--git [--input_branch=<branch>]... [--results_branch=<branch>]
+                [--worktree] [--commit-batch=<n>]]
+               [--archive [--full] [--cache] [--fast-archive]
+                [--archive-format=<format>] [--dedup]] [--class=<class>]
+               [--sweep=<sweep>]... [--where=<condition>] [--shard=<i/n>]
+               [--adapt=<budget>]
+               [--samples=<n> [--sampling=<method>] [--seed=<seed>]]
                [--post=<command>]
-               [--clean]
+               [--clean] [--sandbox] [--jobs=<n>] [--archive-queue=<n>]
+               [--resume] [--progress] [--fork-server]
+               [--priority=<n>] [--cores=<n>] [--memory=<GB>]
+               [--submit [--socket=<path>]] [--queue=<folder>]
                [options] [--] <command>
   run_batch.py --help
 
@@ -17,6 +33,20 @@ Options:
   -g --git                  Use Git to checkout input files and record results.
   -a --archive              Save the results of each run in an archive folder.
   -f --full                 Save full data files to archive folder.
+  -c --cache                Reuse the archived results of an earlier run with
+                            identical command, parameters and input files
+                            instead of running the simulation again. Not
+                            available together with --git or --adapt.
+  --fast-archive            Archive by renaming and cloning files on the same
+                            file system as the archive, and otherwise copy
+                            several files at once inside the kernel.
+  --archive-format=<format> Pack the copied and moved files of each run into
+                            one compressed file: zip, or tar.zst, compressed
+                            with zstd on all cores. Files in either can be
+                            read one by one; tar.zst lists them in an index.
+  --dedup                   Store each copied input file only once, under its
+                            content hash in the archive root, and link it into
+                            the archive folder of every run that uses it.
   -d --clean                Clean up by deleting results files after completion.
   --class=<class>           Specify the simulation class (see below)
   --input_branch=<branch>   Specify an input branch in Git.
@@ -24,7 +54,50 @@ Options:
                             input branches.
   --results_branch=<branch> Specify a results branch in Git.
                             Does not allow multiple branches.
+  -w --worktree             Run each input branch side by side in its own Git
+                            worktree, committing results without checkout.
+  --commit-batch=<n>        Commit results for every <n> runs together, and
+                            any remaining results at the end of the batch,
+                            without checking out the results branch.
   --post=<command>          Specify a post-processing command.
+  -s --sandbox              Run each simulation in its own temporary folder,
+                            with input files linked from the run folder.
+  -j --jobs=<n>             Run up to <n> sweep combinations at the same time,
+                            each in its own sandbox folder (implies --sandbox).
+  --priority=<n>            Priority of these runs when waiting for free cores
+                            or memory, higher first, 0 if not given.
+  --cores=<n>               Cores used by each run, instead of the number
+                            declared for the simulation class (see below).
+  --memory=<GB>             Memory used by each run in GB, instead of the
+                            amount declared for the simulation class.
+  --submit                  Queue the batch with the run_batch daemon and return
+                            at once, instead of running it here.
+  --socket=<path>           Socket of the daemon, instead of the default socket
+                            for this user in the temporary folder.
+  --queue=<folder>          Write each run as a task file into a queue folder,
+                            e.g. on a shared file system, instead of running it
+                            here. Runs with Git cannot be queued.
+  --worker=<folder>         Claim and carry out the tasks in a queue folder,
+                            up to -j at the same time, until none are left.
+                            Any number of workers on any number of computers
+                            can share one queue folder.
+  --requeue-after=<hours>   Return tasks claimed by a worker more than <hours>
+                            ago to the queue, in case that worker stopped on
+                            another computer. Tasks of stopped workers on this
+                            computer are always returned.
+  --archive-queue=<n>       Archive and clean up each run in the background
+                            while the next run starts, with up to <n> runs
+                            waiting to be archived (implies --sandbox).
+  -r --resume               Skip runs already completed in an earlier batch,
+                            according to the ledger in the run folder.
+  --fork-server             Run Reproducible through a helper process that
+                            is started once for each job and forks a copy of
+                            itself for every run and log, instead of starting
+                            Python again each time.
+  --progress                Show the number of completed, failed and running
+                            runs with an estimate of the time left, based on
+                            earlier runs. The line is kept up to date on a
+                            terminal, and otherwise printed after each run.
   --sweep=<key:v1,v2,v3...> Specify a parametric sweep with multiple values for
                             parameters leading to multiple runs.
                             Multiple parameters can be specified independently,
@@ -35,6 +108,30 @@ Options:
                             With connected specification, only the given
                             combinations are simulated (e.g. (1,2) and (2,4)).
                             See below for more examples.
+  --where=<condition>       Only run sweep combinations that meet a condition,
+                            such as --where='I<0.5 or E>1.0'.
+  --shard=<i/n>             Split the sweep into <n> equal parts and only run
+                            part <i>, e.g. to share a sweep between computers.
+  --adapt=<budget>          Treat the sweep values as a coarse grid, then keep
+                            adding points where the last number printed by
+                            the post-processing command changes the most, up
+                            to a total of <budget> runs.
+  --samples=<n>             Run <n> sampled parameter sets for the sweeps given
+                            as ranges, like I:0.0..1.0 or E:0.1..10:log.
+  --sampling=<method>       How to sample the sweep ranges: random, lhs (Latin
+                            hypercube) or sobol (needs SciPy), random if not
+                            given.
+  --seed=<seed>             Random seed for the samples, 0 if not given.
+  --since=<date>            Only find archived runs from this date on, given
+                            as YYYY-MM-DD.
+  --until=<date>            Only find archived runs up to and including this
+                            date, given as YYYY-MM-DD.
+  --keep-full=<days>        Keep the full data of archived runs for <days>
+                            days, then delete the files that only a full
+                            archive keeps.
+  --compress-after=<days>   Pack the files of archived runs into one file, zip
+                            unless another archive format is given, once they
+                            are <days> days old.
 
 Options passed to Reproducible:
   --config <configfile>     Overwrite the location of Reproducible config file.
@@ -54,16 +151,46 @@ Options passed to Reproducible run:
   --list-parameters         list all parameters that need to be set
   -p <key:value>            for several parameters use k1:v1,k2:v2 syntax
 
+Daemon commands:
+  daemon                    Start a daemon that runs submitted batches, as many
+                            at the same time as given by -j. Runs without Git
+                            use sandbox folders and runs with Git use
+                            worktrees, so batches in the same folder do not
+                            interfere.
+  status [<batch>]          Show the state of submitted batches.
+  cancel <batch>            Remove a batch from the queue, or skip the
+                            remaining runs of a running batch.
+  wait [<batch>]            Wait until a batch, or all batches, are finished.
+
+Archive commands:
+  query                     List the archived runs that match all the given
+                            conditions: parameter values with --where, input
+                            branches with --input_branch, and dates with the
+                            options --since and --until. Every archived run
+                            is added to an index in the archive root when it
+                            is saved.
+  prune                     Apply a retention policy to the archived runs in
+                            the index, up to -j runs at the same time. Only
+                            runs that have become old enough since the last
+                            time are read, and files linked to the shared
+                            store of input files are left as they are.
+
 Simulation classes:
   impact                    Simulations with Impact-T or Impact-Z.
                             Input files: *.in *.data *.txt *.xlsx
                             Output files: fort.* *.dst *.plt
+                            Resources: 1 core, 2 GB
   bdsim                     Simulations with BDSIM.
                             Input files: *.gmad *.data *.txt *.xlsx
                             Output files: *.root *.png *.eps
+                            Resources: 1 core, 4 GB
   opal                      Simulations with OPAL.
                             Input files: *.in *.data *.txt *.xlsx
                             Output files: *.h5 *.lbal *.stat *.dat data
+                            Resources: 4 cores, 8 GB
+Runs of other classes use 1 core and 1 GB. Parallel runs only start when
+enough cores and memory are free, and waiting runs with the highest priority
+start first.
 
 Examples:
 
@@ -107,9 +234,18 @@ run_batch.py --template=ImpactT.in --sweep=I:0.0,0.2,0.4,0.6 \\
         reproduce run --template ImpactT -p I:0.2 -- ImpactTexe
         reproduce run --template ImpactT -p I:0.4 -- ImpactTexe
         reproduce run --template ImpactT -p I:0.6 -- ImpactTexe
-    If `--git` is specified, each run result will be in a separate commit.
+    If `--git` is specified, each run result will be in a separate commit,
+    unless `--commit-batch` is used to group results into fewer commits.
     If `--archive` is specified, each run will be archived to a separate folder.
     If `--runlog` is specified, each run will produce a separate log.
+    If `--jobs=4` is specified, up to four values will be simulated at once.
+    If the batch is stopped, `--resume` will only run the remaining values.
+    The time taken by each stage of every run, from checkout to clean up, is
+    saved in 'run_batch.telemetry.jsonl' in the run folder, and a table of
+    the time spent in each stage is shown at the end of the batch.
+    The CPU time, peak memory and disk blocks used by the simulation and the
+    post-processing command are saved in the ledger, and in 'usage.json' in
+    the archive folder of each run.
 
 run_batch.py --template=ImpactT.in --sweep=I:0.0,0.2,0.4,0.6 --sweep=E:1.0,1.5 \\
              --class=impact -- ImpactTexe
@@ -127,6 +263,8 @@ run_batch.py --template=ImpactT.in --sweep=I:0.0,0.2,0.4,0.6 --sweep=E:1.0,1.5 \
         reproduce run --template ImpactT -p I:0.2,E:1.5 -- ImpactTexe
         reproduce run --template ImpactT -p I:0.4,E:1.5 -- ImpactTexe
         reproduce run --template ImpactT -p I:0.6,E:1.5 -- ImpactTexe
+    Adding `--where='I>0.3 or E<1.2'` would skip I:0.0,E:1.5 and I:0.2,E:1.5,
+    and adding `--shard=1/2` would run every other remaining combination.
 
 run_batch.py --template=ImpactT.in --sweep=(I,E):(0.0,1.0),(0.2,1.0),(0.4,1.5) \\
              --class=impact -- ImpactTexe
@@ -138,26 +276,120 @@ run_batch.py --template=ImpactT.in --sweep=(I,E):(0.0,1.0),(0.2,1.0),(0.4,1.5) \
         reproduce run --template ImpactT -p I:0.2,E:1.0 -- ImpactTexe
         reproduce run --template ImpactT -p I:0.4,E:1.5 -- ImpactTexe
 
+run_batch.py --template=ImpactT.in --sweep=I:0.0,1.0 --adapt=8 \\
+             --post='python emittance.py' --class=impact -- ImpactTexe
+
+    Adaptive parametric sweep for the parameter I.
+    After the runs for I:0.0 and I:1.0, each new run halves the interval
+    in which the last number printed by 'python emittance.py' changed the
+    most, until 8 runs have been made.
+
+run_batch.py --template=ImpactT.in --sweep=I:0.0..1.0 --sweep=E:0.1..10:log \\
+             --samples=20 --sampling=lhs --seed=1 --class=impact -- ImpactTexe
+
+    Sampled parametric sweep for the parameters I and E.
+    Instead of a full grid, 20 sets of values are taken from a Latin
+    hypercube, with I between 0.0 and 1.0 and E spread evenly on a log scale
+    between 0.1 and 10. The same seed always gives the same 20 runs.
+
+run_batch.py daemon --jobs=2 &
+run_batch.py --submit --sweep=I:0.0,0.2 --class=impact -- ImpactTexe
+run_batch.py wait
+
+    Queue batches with a daemon instead of running them in the foreground.
+    The daemon runs up to two submitted batches at the same time, each run
+    in its own sandbox folder, and `wait` returns once all of them are done.
+
+run_batch.py --queue=/shared/queue --archive --sweep=I:0.0,0.2 -- ImpactTexe
+run_batch.py --worker=/shared/queue --jobs=4
+
+    Share a sweep between computers through a shared file system.
+    The first command only writes a task file for each run into the queue
+    folder. The second one, started on as many computers as are available,
+    claims the tasks one by one, runs them and moves them to done or failed.
+
+run_batch.py query --where='I==0.4' --input_branch=input/full --since=2026-09-01
+
+    Find the archived runs with beam current I of 0.4 from input branch
+    'input/full' since the start of September 2026, and show their archive
+    folders. Adding `--until=2026-09-30` would leave out later runs.
+
+run_batch.py prune --keep-full=30 --compress-after=90 --jobs=8
+
+    Apply a retention policy to the archive, eight runs at a time.
+    Runs archived with `--full` lose their full data files after 30 days,
+    and all runs are packed into a zip file after 90 days.
+
 """
 
 import sys
 import os
 import pathlib
-import git
 import subprocess
 import shutil
-from datetime import datetime
-from docopt import docopt
+import contextlib
+import tempfile
+import threading
+import fcntl
+import fnmatch
+import io
+from datetime import datetime, date, timedelta
 import itertools
 import unicodedata
 import re
+import json
+import hashlib
+import ast
+import operator
+import random
+import heapq
+import queue
+import getpass
+import signal
+import time
+import types
+import logger
 
 # User settings
 REPRODUCIBLE = '~/Code/Reproducible'
 PYENV        = '~/.pyenv'
 LOGFILE      = 'simulations.log'
+LEDGER       = 'run_batch.ledger'
+TELEMETRY    = 'run_batch.telemetry.jsonl'
 ARCHIVE_LOG  = 'simulation.log'
 ARCHIVE_ROOT = '~/Simulations/'
+CACHE_INDEX  = 'run_cache.jsonl'
+DAEMON_SOCKET = f'run_batch-{getpass.getuser()}.sock'
+ARCHIVE_STREAMS = 4
+ARCHIVE_PACK = 'outputs'
+PACK_FRAME_SIZE = 8 * 2**20
+BLOB_STORE   = '.blobs'
+BLOB_MANIFEST = 'blobs.json'
+USAGE_FILE   = 'usage.json'
+ARCHIVE_INDEX = 'archive_index.sqlite'
+
+# Helper script that runs Reproducible without starting Python for each run
+FORK_SERVER = (pathlib.Path(__file__).absolute()
+               .with_name('reproduce_server.py'))
+
+# Linux ioctl request for copy-on-write file clones
+FICLONE = 0x40049409
+
+# Locks to stop parallel runs writing to the same file or Git at the same time
+_log_lock = threading.Lock()
+_ledger_lock = threading.Lock()
+_cache_lock = threading.Lock()
+_index_lock = threading.Lock()
+_telemetry_lock = threading.Lock()
+_commit_lock = threading.RLock()
+_scheduler_lock = threading.Lock()
+_scheduler = None
+_fork_server_lock = threading.Lock()
+_git_repo_lock = threading.Lock()
+_git_repos = dict()
+_python_cache = dict()
+_fork_servers = threading.local()
+_fork_server_list = []
 
 
 # Utility methods
@@ -178,6 +410,25 @@ def get_safe_folder_name(value):
     value = re.sub(r'-$', '', re.sub(r'[-\s]+', '-', value))
     return value
 
+def get_positive_integer(value, description):
+    """Convert a value given as an option to a positive integer"""
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid {description}: {value}')
+    if number < 1:
+        raise ValueError(f'Invalid {description}: {value}')
+    return number
+
+def get_seed(given_seed):
+    """Get the random seed for a sampled sweep, 0 unless given"""
+    if not given_seed:
+        return 0
+    try:
+        return int(given_seed)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid random seed: {given_seed}')
+
 def get_archive_folder(archive_root):
     """Get an absolute path object for a new archive folder with today's date"""
     if not archive_root.is_dir():
@@ -200,7 +451,37 @@ def get_python_for_reproducible(reproducible_folder, pyenv_folder):
     else:
         return 'python3'
 
+def get_cached_python(reproducible_folder, pyenv_folder):
+    """Get the Python for Reproducible, cached until .python-version changes"""
+    version_file = reproducible_folder.joinpath('.python-version')
+    try:
+        version_time = version_file.stat().st_mtime_ns
+    except OSError:
+        version_time = None
+    key = (str(reproducible_folder), str(pyenv_folder), version_time)
+    if key not in _python_cache:
+        _python_cache[key] = get_python_for_reproducible(reproducible_folder,
+                                                         pyenv_folder)
+    return _python_cache[key]
+
 # Communication methods
+def format_size(size):
+    """Format a number of bytes in a form that is easy to read"""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if size < 1000:
+            return f'{size:.1f} {unit}'
+        size /= 1000
+    return f'{size:.1f} TB'
+
+def format_duration(seconds):
+    """Format a number of seconds in a short form like 1h 05m or 3m 07s"""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f'{seconds // 3600}h {seconds % 3600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m {seconds % 60:02d}s'
+    return f'{seconds}s'
+
 def announce(message):
     """Announce a given message."""
     print(str(message))
@@ -224,19 +505,38 @@ def announce_end(this_run):
 # Git methods
 def get_git_repo(repo_path):
     """Return a repo object for the Git repo at a given path"""
+    import git
     if not pathlib.Path(repo_path).is_dir():
         raise OSError(f'Repo folder not found: {repo_path}')
-    else:
-        return git.Repo(repo_path)
+    key = (threading.current_thread(), str(get_folder(repo_path)))
+    with _git_repo_lock:
+        repo = _git_repos.get(key)
+    if repo is None:
+        repo = git.Repo(repo_path)
+        with _git_repo_lock:
+            for old_key in [old_key for old_key in _git_repos
+                            if not old_key[0].is_alive()]:
+                _git_repos.pop(old_key).close()
+            _git_repos[key] = repo
+    return repo
+
+def forget_git_repo(repo_path):
+    """Close the repo objects kept for a folder that is being removed"""
+    folder = str(get_folder(repo_path))
+    with _git_repo_lock:
+        for key in [key for key in _git_repos if key[1] == folder]:
+            _git_repos.pop(key).close()
 
 def git_checkout(repo, branch_name):
     """Check out the given branch"""
+    import git
     if not isinstance(repo, git.Repo):
         raise TypeError(f'Not a valid repo: {repo}')
     repo.heads[branch_name].checkout()
 
 def git_switch(repo, branch_name):
     """Switch branches without checking anything out"""
+    import git
     if not isinstance(repo, git.Repo):
         raise TypeError(f'Not a valid repo: {repo}')
     repo.head.reference = repo.heads[branch_name]
@@ -244,17 +544,89 @@ def git_switch(repo, branch_name):
 
 def git_get_file(repo, branch_name, file_name):
     """Checkout a single file from a given branch"""
+    import git
     if not isinstance(repo, git.Repo):
         raise TypeError(f'Not a valid repo: {repo}')
     repo.git.checkout(branch_name, '--', file_name)
 
+def git_read_file(repo, branch_name, file_name, folder):
+    """Write a single file from a given branch without touching the index"""
+    import git
+    if not isinstance(repo, git.Repo):
+        raise TypeError(f'Not a valid repo: {repo}')
+    try:
+        content = repo.heads[branch_name].commit.tree[file_name].data_stream.read()
+    except KeyError:
+        content = b''
+    folder.joinpath(file_name).write_bytes(content)
+
 def git_commit(repo, commit_files, commit_message):
     """Add and commit the given files"""
+    import git
     if not isinstance(repo, git.Repo):
         raise TypeError(f'Not a valid repo: {repo}')
     repo.index.add(commit_files)
     repo.index.commit(commit_message)
 
+def git_append_to_file(repo, branch_name, file_name, new_content,
+                       commit_message):
+    """Commit extra content for a file directly to a branch without checkout"""
+    import git
+    from gitdb import IStream
+    if not isinstance(repo, git.Repo):
+        raise TypeError(f'Not a valid repo: {repo}')
+    if not isinstance(new_content, bytes):
+        raise TypeError(f'Invalid content to commit: {new_content}')
+    with _commit_lock:
+        branch = repo.heads[branch_name]
+        try:
+            content = branch.commit.tree[file_name].data_stream.read()
+        except KeyError:
+            content = b''
+        content += new_content
+        blob = repo.odb.store(IStream(git.Blob.type, len(content),
+                                      io.BytesIO(content)))
+        index = git.IndexFile.from_tree(repo, branch.commit)
+        index.add([git.BaseIndexEntry((0o100644, blob.binsha, 0, file_name))],
+                  write=False)
+        branch.commit = git.Commit.create_from_tree(
+            repo, index.write_tree(), commit_message,
+            parent_commits=[branch.commit], head=False)
+
+def create_worktree(repo, branch_name):
+    """Check out a branch into a new temporary worktree beside the repo"""
+    import git
+    if not isinstance(repo, git.Repo):
+        raise TypeError(f'Not a valid repo: {repo}')
+    if branch_name not in [head.name for head in repo.heads]:
+        raise ValueError(f'Branch not found: {branch_name}')
+    repo_folder = get_folder(repo.working_tree_dir)
+    worktree_folder = get_folder(tempfile.mkdtemp(
+        prefix=f'.{repo_folder.name}-worktree-', dir=str(repo_folder.parent)))
+    repo.git.worktree('add', '--detach', str(worktree_folder), branch_name)
+    return worktree_folder
+
+def remove_worktree(repo, worktree_folder):
+    """Delete a temporary worktree once its results have been saved"""
+    import git
+    if not isinstance(repo, git.Repo):
+        raise TypeError(f'Not a valid repo: {repo}')
+    if not worktree_folder.is_dir():
+        raise OSError(f'Cannot access worktree folder: {worktree_folder}')
+    forget_git_repo(worktree_folder)
+    repo.git.worktree('remove', '--force', str(worktree_folder))
+
+def detach_worktree(repo, worktree_folder):
+    """Unregister a temporary worktree but keep its files as a plain folder"""
+    import git
+    if not isinstance(repo, git.Repo):
+        raise TypeError(f'Not a valid repo: {repo}')
+    if not worktree_folder.is_dir():
+        raise OSError(f'Cannot access worktree folder: {worktree_folder}')
+    forget_git_repo(worktree_folder)
+    worktree_folder.joinpath('.git').unlink(missing_ok=True)
+    repo.git.worktree('prune')
+
 def get_input_branch(repo, given_input_branch):
     """Get a list of all input branches, unless given an override"""
     if given_input_branch:
@@ -310,6 +682,41 @@ def get_commit_message(this_run):
     """Create a message string to commit results of the current run"""
     return 'Results for ' + this_run['title']
 
+def get_commit_batch(settings, parameters):
+    """Set up a batch to collect log updates to commit together"""
+    if not parameters['--commit-batch']:
+        return None
+    return {'size': get_positive_integer(parameters['--commit-batch'],
+                                         'commit batch size'),
+            'branch': parameters['--results_branch'],
+            'file': settings['logfile'],
+            'updates': [],
+            'messages': []}
+
+def add_to_commit_batch(repo, commit_batch, update, commit_message):
+    """Add a log update to the batch, and commit if the batch is full"""
+    with _commit_lock:
+        commit_batch['updates'].append(update)
+        commit_batch['messages'].append(commit_message)
+        if len(commit_batch['updates']) >= commit_batch['size']:
+            commit_batch_results(repo, commit_batch)
+
+def commit_batch_results(repo, commit_batch):
+    """Commit all log updates in the batch as a single commit"""
+    with _commit_lock:
+        if not commit_batch['updates']:
+            return
+        if len(commit_batch['messages']) == 1:
+            commit_message = commit_batch['messages'][0]
+        else:
+            commit_message = (
+                f'Results for {len(commit_batch["messages"])} runs\n\n'
+                + '\n'.join(commit_batch['messages']))
+        git_append_to_file(repo, commit_batch['branch'], commit_batch['file'],
+                           b''.join(commit_batch['updates']), commit_message)
+        commit_batch['updates'].clear()
+        commit_batch['messages'].clear()
+
 # Template methods
 def get_valid_templates(run_folder, templates):
     """Check which files exist and return lists of valid and invalid files."""
@@ -324,7 +731,7 @@ def get_valid_templates(run_folder, templates):
             None if len(invalid_templates) == 0 else ','.join(invalid_templates))
 
 # Post-processing methods
-def post_process(settings, command):
+def post_process(settings, command, *, capture=False):
     """Run the given post-processing command in the run folder"""
     folder = settings['current_folder']
     environ = os.environ.copy()
@@ -332,7 +739,20 @@ def post_process(settings, command):
     environ['PATH'] = environ['PATH'].replace(f'{this_env}:', '')
     environ['PYENV_DIR'] = ''
     environ['PYENV_VERSION'] = ''
-    return subprocess.run(command.split(), cwd=folder, env=environ)
+    if capture:
+        result = run_with_usage(command.split(), cwd=folder, env=environ,
+                                stdout=subprocess.PIPE, text=True)
+        print(result.stdout, end='')
+        return result
+    return run_with_usage(command.split(), cwd=folder, env=environ)
+
+def get_metric(output):
+    """Get the last number in the output of a post-processing command"""
+    numbers = re.findall(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?',
+                         output or '')
+    if not numbers:
+        return None
+    return float(numbers[-1])
 
 # Archive methods
 def create_archive_folder(archive_folder):
@@ -372,7 +792,94 @@ def get_delete_list(simulation_class):
     """Get list of file patterns to delete - same as full archive list."""
     return get_move_list(simulation_class, is_full_archive=True)
 
-def copy_to_archive(run_folder, archive_folder, copy_patterns):
+def get_pattern_matcher(patterns):
+    """Compile a list of glob patterns into a single file name matcher"""
+    if not patterns:
+        return lambda filename: None
+    return re.compile('|'.join([fnmatch.translate(pattern)
+                                for pattern in patterns])).match
+
+def scan_run_folder(run_folder, copy_patterns, move_patterns, delete_patterns):
+    """Sort the files of a run folder for archiving, reading it only once"""
+    matchers = {'copy': get_pattern_matcher(copy_patterns),
+                'move': get_pattern_matcher(move_patterns),
+                'delete': get_pattern_matcher(delete_patterns),
+                'rendered': get_pattern_matcher(['*.rendered'])}
+    scan = {name: [] for name in matchers}
+    with os.scandir(run_folder) as entries:
+        for entry in entries:
+            if entry.name == LOGFILE:
+                continue
+            for name, matches in matchers.items():
+                if matches(entry.name):
+                    scan[name].append(run_folder.joinpath(entry.name))
+    return scan
+
+def is_same_device(path, folder):
+    """Check whether a file and a folder are on the same file system"""
+    return os.stat(path).st_dev == os.stat(folder).st_dev
+
+def stream_file(source, destination):
+    """Copy file data inside the kernel and return the number of bytes"""
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            size = os.fstat(source_file.fileno()).st_size
+            copied = 0
+            use_copy_file_range = hasattr(os, 'copy_file_range')
+            while copied < size:
+                if use_copy_file_range:
+                    try:
+                        sent = os.copy_file_range(source_file.fileno(),
+                                                  destination_file.fileno(),
+                                                  size - copied)
+                    except OSError:
+                        use_copy_file_range = False
+                        continue
+                else:
+                    sent = os.sendfile(destination_file.fileno(),
+                                       source_file.fileno(),
+                                       copied, size - copied)
+                if sent == 0:
+                    break
+                copied += sent
+    shutil.copystat(str(source), str(destination))
+    return copied
+
+def archive_file(source, archive_folder, move=False):
+    """Archive a file by rename or clone if possible, returning bytes copied"""
+    destination = archive_folder.joinpath(source.name)
+    if source.is_symlink() or not source.is_file():
+        if move:
+            shutil.move(str(source), str(archive_folder))
+        else:
+            shutil.copy2(str(source), str(archive_folder))
+        return 0
+    if destination.is_file() or destination.is_symlink():
+        destination.unlink()
+    if is_same_device(source, archive_folder):
+        if move:
+            os.rename(source, destination)
+            return 0
+        try:
+            clone_file(source, destination)
+            shutil.copystat(str(source), str(destination))
+            return 0
+        except OSError:
+            pass
+    copied = stream_file(source, destination)
+    if move:
+        source.unlink()
+    return copied
+
+def fast_archive_files(files, archive_folder, move=False):
+    """Archive several files at once and return the bytes that were copied"""
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=ARCHIVE_STREAMS) as executor:
+        return sum(executor.map(lambda this_file: archive_file(
+            this_file, archive_folder, move), files))
+
+def copy_to_archive(run_folder, archive_folder, copy_patterns, *, scan=None):
     """Copy files to the given archive folder based on glob patterns"""
     if not run_folder.is_dir():
         raise OSError(f'Cannot access source folder: {run_folder}')
@@ -380,14 +887,12 @@ def copy_to_archive(run_folder, archive_folder, copy_patterns):
         raise OSError(f'Cannot access archive folder: {archive_folder}')
     if not isinstance(copy_patterns, list):
         raise ValueError(f'Invalid archive copy pattern: {copy_patterns}')
-    file_list = set()
-    for pattern in copy_patterns:
-        file_list.update(set(run_folder.glob(pattern)))
-    for this_file in file_list:
-        if this_file.name != LOGFILE:
-            shutil.copy2(str(this_file), str(archive_folder))
-
-def move_to_archive(run_folder, archive_folder, move_patterns):
+    if scan is None:
+        scan = scan_run_folder(run_folder, copy_patterns, [], [])
+    for this_file in scan['copy']:
+        shutil.copy2(str(this_file), str(archive_folder))
+
+def move_to_archive(run_folder, archive_folder, move_patterns, *, scan=None):
     """Move files to the given archive folder based on glob patterns"""
     if not run_folder.is_dir():
         raise OSError(f'Cannot access source folder: {run_folder}')
@@ -395,26 +900,30 @@ def move_to_archive(run_folder, archive_folder, move_patterns):
         raise OSError(f'Cannot access archive folder: {archive_folder}')
     if not isinstance(move_patterns, list):
         raise ValueError(f'Invalid archive move pattern: {move_patterns}')
-    file_list = set()
-    for pattern in move_patterns:
-        file_list.update(set(run_folder.glob(pattern)))
-    for this_file in file_list:
-        if this_file.name != LOGFILE:
-            shutil.move(str(this_file), str(archive_folder))
-
-def move_rendered_templates(run_folder, archive_folder):
+    if scan is None:
+        scan = scan_run_folder(run_folder, [], move_patterns, [])
+    for this_file in scan['move']:
+        shutil.move(str(this_file), str(archive_folder))
+
+def move_rendered_templates(run_folder, archive_folder, *, scan=None):
     """Save rendered template files to archive folder"""
     if not run_folder.is_dir():
         raise OSError(f'Cannot access source folder: {run_folder}')
     if not archive_folder.is_dir():
         raise OSError(f'Cannot access archive folder: {archive_folder}')
-    file_list = run_folder.glob('*.rendered')
-    for this_file in file_list:
+    if scan is None:
+        scan = scan_run_folder(run_folder, [], [], [])
+    for this_file in scan['rendered']:
         new_filename = str(this_file.name).replace('.rendered','')
         shutil.move(str(this_file), str(archive_folder.joinpath(new_filename)))
 
-def archive_log(settings, archive_folder):
+def archive_log(settings, archive_folder, *, fork_server=False):
     """Get a log of the last run and save it to the archive folder"""
+    if fork_server:
+        run_in_fork_server(settings, ['log', '-n1'],
+                           stdout=archive_folder.joinpath(
+                               settings['archive_log']))
+        return
     log_command = [str(settings['python']),
                    str(settings['reproduce']), 'log', '-n1']
     log_output = subprocess.run(log_command,
@@ -423,26 +932,661 @@ def archive_log(settings, archive_folder):
     with open(archive_folder.joinpath(settings['archive_log']), 'wb') as f:
         f.write(log_output)
 
-def archive_output(settings, this_run):
+def archive_output(settings, this_run, *, scan=None):
     """Archive the input, output and log files of the latest run"""
     create_archive_folder(this_run['archive'])
-    copy_to_archive(settings['current_folder'],
-                    this_run['archive'],
-                    this_run['archive_copy'])
-    move_to_archive(settings['current_folder'],
-                    this_run['archive'],
-                    this_run['archive_move'])
-    move_rendered_templates(settings['current_folder'], this_run['archive'])
-    archive_log(settings, this_run['archive'])
-
-def delete_output(settings, this_run):
+    if scan is None:
+        scan = scan_run_folder(settings['current_folder'],
+                               this_run['archive_copy'],
+                               this_run['archive_move'], [])
+    if this_run['--dedup']:
+        rendered_names = [path.stem for path in scan['rendered']]
+        dedup_to_archive(settings['archive_root'], this_run['archive'],
+                         [path for path in scan['copy']
+                          if path.name not in rendered_names])
+        scan = dict(scan, copy=[])
+    if this_run['archive_format']:
+        pack_output(this_run, scan)
+    elif this_run['--fast-archive']:
+        fast_archive_output(this_run, scan)
+    else:
+        copy_to_archive(settings['current_folder'],
+                        this_run['archive'],
+                        this_run['archive_copy'], scan=scan)
+        move_to_archive(settings['current_folder'],
+                        this_run['archive'],
+                        this_run['archive_move'], scan=scan)
+    move_rendered_templates(settings['current_folder'], this_run['archive'],
+                            scan=scan)
+    archive_log(settings, this_run['archive'],
+                fork_server=this_run['--fork-server'])
+    if this_run.get('usage'):
+        with open(this_run['archive'].joinpath(USAGE_FILE), 'w') as f:
+            json.dump(this_run['usage'], f, indent=1)
+    index_run(settings['archive_root'], this_run)
+
+def fast_archive_output(this_run, scan):
+    """Copy and move scanned files to the archive and report the speed"""
+    start_time = time.perf_counter()
+    total_size = sum([get_file_size(this_file)
+                      for this_file in scan['copy'] + scan['move']])
+    copied = fast_archive_files(scan['copy'], this_run['archive'])
+    copied += fast_archive_files(scan['move'], this_run['archive'], move=True)
+    seconds = max(time.perf_counter() - start_time, 1e-6)
+    announce(f'Archived {format_size(total_size)} in {seconds:.2f} s '
+             f'({format_size(total_size / seconds)}/s), '
+             f'{format_size(copied)} copied between file systems')
+
+def get_blob_path(blob_store, file_hash):
+    """Get the location of a file with the given hash in the blob store"""
+    return blob_store.joinpath(file_hash[:2], file_hash[2:])
+
+def store_blob(blob_store, source):
+    """Add a file to the blob store unless it is there, and return its hash"""
+    file_hash = get_file_hash(source)
+    blob = get_blob_path(blob_store, file_hash)
+    if not blob.is_file():
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        new_blob = blob.parent.joinpath(
+            f'.{blob.name}-{os.getpid()}-{threading.get_ident()}')
+        copy_file(source, new_blob)
+        new_blob.chmod(0o444)
+        os.replace(new_blob, blob)
+    return file_hash
+
+def link_blob(blob, destination):
+    """Hardlink a blob into an archive folder, or copy it if that fails"""
+    if destination.is_file() or destination.is_symlink():
+        destination.unlink()
+    try:
+        os.link(blob, destination)
+    except OSError:
+        shutil.copy2(str(blob), str(destination))
+
+def dedup_to_archive(archive_root, archive_folder, paths):
+    """Put files in the archive folder as links into the blob store"""
+    blob_store = archive_root.joinpath(BLOB_STORE)
+    manifest_file = archive_folder.joinpath(BLOB_MANIFEST)
+    if manifest_file.is_file():
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    else:
+        manifest = dict()
+    for path in paths:
+        if path.is_symlink() or not path.is_file():
+            shutil.copy2(str(path), str(archive_folder))
+            continue
+        file_hash = store_blob(blob_store, path)
+        link_blob(get_blob_path(blob_store, file_hash),
+                  archive_folder.joinpath(path.name))
+        manifest[path.name] = file_hash
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def get_archive_format(given_format):
+    """Get the format to pack archived files in, None for a plain folder"""
+    if not given_format or given_format == 'folder':
+        return None
+    if given_format not in ['zip', 'tar.zst']:
+        raise ValueError(f'Unknown archive format: {given_format}')
+    if given_format == 'tar.zst' and not shutil.which('zstd'):
+        raise OSError('The zstd command is needed for tar.zst archives')
+    return given_format
+
+def iter_archive_members(paths):
+    """Get each file to pack with its name in the archive, including folders"""
+    for path in paths:
+        if path.is_dir() and not path.is_symlink():
+            for root, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    member = pathlib.Path(root, filename)
+                    yield member, str(member.relative_to(path.parent))
+        else:
+            yield path, path.name
+
+def pack_zip(members, pack_file):
+    """Pack files into a zip file, whose members can be read one by one"""
+    import zipfile
+    with zipfile.ZipFile(pack_file, 'w', compression=zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as archive:
+        for path, name in members:
+            archive.write(path, name)
+
+def compress_frame(chunks, pack_file):
+    """Append data to a file as a separate zstd frame, using all cores"""
+    pack_file.flush()
+    compressor = subprocess.Popen(['zstd', '-T0', '-q', '-c'],
+                                  stdin=subprocess.PIPE, stdout=pack_file)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                compressor.stdin.write(chunk)
+            else:
+                with open(chunk, 'rb') as data:
+                    shutil.copyfileobj(data, compressor.stdin)
+    finally:
+        compressor.stdin.close()
+        returncode = compressor.wait()
+    if returncode != 0:
+        raise OSError(f'Compression failed for {pack_file.name}')
+    return pack_file.seek(0, os.SEEK_END)
+
+def pack_tar_zst(members, pack_file):
+    """Pack files into a tar file of zstd frames of several members each"""
+    import tarfile
+    index = {'frames': [], 'members': []}
+    tar_offset = 0
+    # Only used to make the tar headers of the files
+    archive = tarfile.TarFile(fileobj=io.BytesIO(), mode='w')
+    with open(pack_file, 'wb') as f:
+        frame_offset = 0
+        chunks = []
+        position = 0
+        for path, name in members:
+            tarinfo = archive.gettarinfo(str(path), name)
+            header = tarinfo.tobuf(archive.format, archive.encoding,
+                                   archive.errors)
+            chunks.append(header)
+            if tarinfo.isreg():
+                padding = -tarinfo.size % tarfile.BLOCKSIZE
+                chunks.extend([path, tarfile.NUL * padding])
+            else:
+                tarinfo.size = padding = 0
+            index['members'].append({'name': name, 'size': tarinfo.size,
+                                     'offset': tar_offset + len(header),
+                                     'frame': len(index['frames']),
+                                     'position': position + len(header)})
+            tar_offset += len(header) + tarinfo.size + padding
+            position += len(header) + tarinfo.size + padding
+            if position >= PACK_FRAME_SIZE:
+                frame_end = compress_frame(chunks, f)
+                index['frames'].append([frame_offset,
+                                        frame_end - frame_offset])
+                frame_offset = frame_end
+                chunks = []
+                position = 0
+        chunks.append(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        frame_end = compress_frame(chunks, f)
+        index['frames'].append([frame_offset, frame_end - frame_offset])
+    with open(f'{pack_file}.index.json', 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+
+def read_packed_file(pack_file, name):
+    """Read one file from a tar.zst pack without unpacking the others"""
+    with open(f'{pack_file}.index.json', 'r') as f:
+        index = json.load(f)
+    members = {member['name']: member for member in index['members']}
+    if name not in members:
+        raise ValueError(f'File not found in {pack_file}: {name}')
+    member = members[name]
+    frame_offset, frame_size = index['frames'][member['frame']]
+    with open(pack_file, 'rb') as f:
+        f.seek(frame_offset)
+        frame = f.read(frame_size)
+    result = subprocess.run(['zstd', '-dc'], input=frame, capture_output=True)
+    if result.returncode != 0:
+        raise OSError(f'Decompression failed for {pack_file}')
+    return result.stdout[member['position']:
+                         member['position'] + member['size']]
+
+def pack_output(this_run, scan):
+    """Pack the files to copy and move into one compressed file per run"""
+    pack_file = this_run['archive'].joinpath(
+        f'{ARCHIVE_PACK}.{this_run["archive_format"]}')
+    paths = list(dict.fromkeys(scan['copy'] + scan['move']))
+    if this_run['archive_format'] == 'zip':
+        pack_zip(iter_archive_members(paths), pack_file)
+    else:
+        pack_tar_zst(iter_archive_members(paths), pack_file)
+    for path in scan['move']:
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+def delete_output(settings, this_run, *, scan=None):
     """Delete any output files that haven't been archived."""
     delete_list = get_delete_list(this_run['--class'])
-    for pattern in delete_list:
-        files = settings['current_folder'].glob(pattern)
-        for this_file in files:
-            if this_file.name != LOGFILE:
-                this_file.unlink()
+    if scan is None:
+        scan = scan_run_folder(settings['current_folder'], [], [], delete_list)
+    for this_file in scan['delete']:
+        this_file.unlink(missing_ok=True)
+
+# Background archive methods
+def create_archiver(queue_size):
+    """Start a thread that archives runs while the next runs go ahead"""
+    archiver = {'queue': queue.Queue(maxsize=queue_size)}
+    archiver['thread'] = threading.Thread(target=run_archiver,
+                                          args=(archiver,), daemon=True)
+    archiver['thread'].start()
+    return archiver
+
+def run_archiver(archiver):
+    """Store the output of each handed off run, then release its folder"""
+    while True:
+        job = archiver['queue'].get()
+        if job is None:
+            return
+        settings, this_run, release = job
+        try:
+            store_output(settings, this_run, this_run['returncode'])
+        except Exception as error:
+            announce_error(f'Archiving {this_run["title"]} failed: {error}')
+            record_run(this_run, 'failed')
+        finally:
+            record_telemetry(this_run)
+            release()
+
+def hand_off_output(settings, this_run, release):
+    """Queue the output of a run for the archiver, if the batch has one"""
+    if not this_run['archiver'] or 'returncode' not in this_run:
+        return False
+    if this_run.get('cache_hit'):
+        return False
+    if not (this_run['--archive'] or this_run['--clean']):
+        return False
+    archiver = this_run['archiver']
+    archiver['queue'].put((settings, this_run, release))
+    return True
+
+def wait_for_archiver(archiver):
+    """Wait until all queued runs are archived and stop the archiver"""
+    archiver['queue'].put(None)
+    archiver['thread'].join()
+
+# Sandbox folder methods
+def clone_file(source, destination):
+    """Make a copy-on-write clone of a file, if the file system supports it"""
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+def share_file(source, destination):
+    """Share file data by reflink or hardlink, falling back to a full copy"""
+    try:
+        clone_file(source, destination)
+        return
+    except OSError:
+        if destination.exists():
+            destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(str(source), str(destination))
+
+def copy_file(source, destination):
+    """Copy a file that may be written to, using a reflink where possible"""
+    try:
+        clone_file(source, destination)
+        shutil.copystat(str(source), str(destination))
+    except OSError:
+        shutil.copy2(str(source), str(destination))
+
+def matches_any(filename, patterns):
+    """Check whether a file name matches any of the given glob patterns"""
+    return any([fnmatch.fnmatchcase(filename, pattern) for pattern in patterns])
+
+def create_sandbox_folder(run_folder, simulation_class, *, templates=None):
+    """Set up a temporary folder with the inputs for a single isolated run"""
+    if not run_folder.is_dir():
+        raise OSError(f'Cannot access source folder: {run_folder}')
+    sandbox_folder = get_folder(tempfile.mkdtemp(
+        prefix=f'.{run_folder.name}-sandbox-', dir=str(run_folder.parent)))
+    share_patterns = get_copy_list(simulation_class)
+    skip_patterns = get_delete_list(simulation_class) + ['*.rendered', LEDGER,
+                                                         TELEMETRY, '.git']
+    copy_names = templates.split(',') if templates else []
+    for this_item in run_folder.iterdir():
+        new_item = sandbox_folder.joinpath(this_item.name)
+        if this_item.name == LOGFILE:
+            copy_file(this_item, new_item)
+        elif matches_any(this_item.name, skip_patterns):
+            continue
+        elif this_item.is_symlink():
+            new_item.symlink_to(os.readlink(this_item))
+        elif this_item.is_dir():
+            new_item.symlink_to(this_item)
+        elif this_item.name in copy_names:
+            copy_file(this_item, new_item)
+        elif matches_any(this_item.name, share_patterns):
+            share_file(this_item, new_item)
+        else:
+            copy_file(this_item, new_item)
+    return sandbox_folder
+
+def remove_sandbox_folder(sandbox_folder):
+    """Delete a sandbox folder once its results have been archived"""
+    if not sandbox_folder.is_dir():
+        raise OSError(f'Cannot access sandbox folder: {sandbox_folder}')
+    shutil.rmtree(str(sandbox_folder))
+
+def get_file_size(file_path):
+    """Get the size of a file in bytes, or zero if it does not exist yet"""
+    if file_path.is_file():
+        return file_path.stat().st_size
+    else:
+        return 0
+
+def get_log_update(logfile, offset):
+    """Get anything written to a log file after the given offset"""
+    if not logfile.is_file():
+        return b''
+    with open(logfile, 'rb') as f:
+        f.seek(offset)
+        return f.read()
+
+def merge_log(source_log, destination_log, offset):
+    """Append anything written to a log file after a given offset to another"""
+    new_entries = get_log_update(source_log, offset)
+    if new_entries:
+        with _log_lock:
+            with open(destination_log, 'ab') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                f.write(new_entries)
+
+# Ledger methods
+def get_run_hash(this_run):
+    """Get a hash identifying the inputs of a run, to match across batches"""
+    run_identity = [this_run[key] for key in ['<command>', '-p', '--template',
+                                              '--class', '--input_branch',
+                                              '--results_branch', '--post']]
+    return hashlib.sha1(json.dumps(run_identity).encode()).hexdigest()
+
+def get_started_run_hash(this_run):
+    """Get the hash of a run as it was when the run started"""
+    return this_run.get('run_hash') or get_run_hash(this_run)
+
+def record_run(this_run, status):
+    """Add the current status of a run to the ledger for the batch"""
+    if not this_run['ledger']:
+        return
+    record = {'time': datetime.now().isoformat(timespec='seconds'),
+              'hash': get_started_run_hash(this_run),
+              'title': this_run['title'],
+              'parameters': this_run['-p'] or None,
+              'branch': this_run['--input_branch'] or None,
+              'status': status,
+              'archive': str(this_run['archive']) if this_run['archive']
+                         else None}
+    if status != 'started' and this_run.get('usage'):
+        record['usage'] = this_run['usage']
+    with _ledger_lock:
+        with open(this_run['ledger'], 'a') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record) + '\n')
+
+def get_completed_runs(ledger):
+    """Get the hashes of all runs whose latest status is completed"""
+    latest_status = dict()
+    if ledger.is_file():
+        with open(ledger, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                latest_status[record['hash']] = record['status']
+    return {run_hash for run_hash, status in latest_status.items()
+            if status == 'completed'}
+
+def is_completed_run(this_run):
+    """Check whether a run was already completed in a previous batch"""
+    if not this_run['completed_runs']:
+        return False
+    if get_started_run_hash(this_run) in this_run['completed_runs']:
+        announce(f'Skipping completed run: {this_run["title"]}')
+        finish_progress_run(this_run, 'skipped')
+        return True
+    return False
+
+# Telemetry methods
+@contextlib.contextmanager
+def timed_stage(this_run, stage):
+    """Time a stage of a run and add the time to the timings of the run"""
+    timings = this_run.setdefault('timings', dict())
+    with logger.timed(quiet=True) as timer:
+        try:
+            yield timer
+        finally:
+            timings[stage] = timings.get(stage, 0) + timer.elapsed_seconds()
+
+def record_telemetry(this_run):
+    """Save the stage timings of a finished run and add them to the batch"""
+    timings = this_run.get('timings') or dict()
+    if this_run['stage_times'] is not None:
+        with _telemetry_lock:
+            for stage, seconds in timings.items():
+                runs, total = this_run['stage_times'].get(stage, (0, 0))
+                this_run['stage_times'][stage] = (runs + 1, total + seconds)
+    if not this_run['telemetry']:
+        return
+    record = {'time': datetime.now().isoformat(timespec='seconds'),
+              'hash': get_started_run_hash(this_run),
+              'title': this_run['title'],
+              'parameters': this_run['-p'] or None,
+              'branch': this_run['--input_branch'] or None,
+              'returncode': this_run.get('returncode'),
+              'timings': {stage: round(seconds, 6)
+                          for stage, seconds in timings.items()},
+              'total': round(sum(timings.values()), 6)}
+    with _telemetry_lock:
+        with open(this_run['telemetry'], 'a') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record) + '\n')
+
+def show_stage_times(stage_times):
+    """Print a table of the time spent in each stage over a batch"""
+    if not stage_times:
+        return
+    batch_time = max(sum([total for runs, total in stage_times.values()]),
+                     1e-9)
+    print()
+    print(f'{"Stage":<10} {"Runs":>6} {"Total":>12} {"Mean":>12} '
+          f'{"Share":>7}')
+    for stage, (runs, total) in sorted(stage_times.items(),
+                                       key=lambda item: -item[1][1]):
+        print(f'{stage:<10} {runs:>6} {total:>10.2f} s '
+              f'{total / runs:>10.3f} s {100 * total / batch_time:>6.1f}%')
+
+# Progress methods
+def get_run_history(telemetry):
+    """Get the durations of earlier runs from telemetry, grouped by hash"""
+    history = dict()
+    if telemetry and telemetry.is_file():
+        with open(telemetry, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                history.setdefault(record['hash'], []).append(record['total'])
+    return history
+
+def create_progress(total, history, jobs, stream=None):
+    """Start keeping track of the progress of a batch of runs"""
+    stream = stream or sys.stdout
+    progress = {'total': total, 'jobs': jobs, 'history': history,
+                'completed': 0, 'failed': 0, 'skipped': 0, 'running': dict(),
+                'durations': [], 'start_time': time.perf_counter(),
+                'stream': stream, 'is_tty': stream.isatty(),
+                'lock': threading.Lock(), 'stop': threading.Event()}
+    progress['thread'] = threading.Thread(target=run_progress_ticker,
+                                          args=(progress,), daemon=True)
+    progress['thread'].start()
+    return progress
+
+def get_expected_duration(progress, run_hash=None):
+    """Estimate how long a run takes from this batch and earlier batches"""
+    if run_hash in progress['history']:
+        earlier = progress['history'][run_hash]
+        return sum(earlier) / len(earlier)
+    if progress['durations']:
+        return sum(progress['durations']) / len(progress['durations'])
+    earlier = [duration for durations in progress['history'].values()
+               for duration in durations]
+    if earlier:
+        return sum(earlier) / len(earlier)
+    return None
+
+def get_progress_line(progress):
+    """Describe the progress of a batch, with an estimate of the time left"""
+    now = time.perf_counter()
+    finished = progress['completed'] + progress['failed'] + progress['skipped']
+    line = (f'{finished}/{progress["total"]} finished: '
+            f'{progress["completed"]} completed, {progress["failed"]} failed, '
+            f'{len(progress["running"])} running')
+    elapsed = now - progress['start_time']
+    done = progress['completed'] + progress['failed']
+    if done and elapsed > 0:
+        line += f', {done / elapsed * 3600:.1f} runs/h'
+    mean_duration = get_expected_duration(progress)
+    if mean_duration is not None:
+        waiting = max(progress['total'] - finished
+                      - len(progress['running']), 0)
+        remaining = waiting * mean_duration
+        for run_hash, start_time in progress['running'].values():
+            expected = get_expected_duration(progress, run_hash)
+            remaining += max(expected - (now - start_time), 0)
+        line += (f', about {format_duration(remaining / progress["jobs"])}'
+                 ' left')
+    if progress['running'] and progress['is_tty']:
+        line += ' | ' + ', '.join(
+            [f'{title} {format_duration(now - start_time)}'
+             for title, (_, start_time) in progress['running'].items()])
+    return line
+
+def show_progress(progress, message=None):
+    """Redraw the progress line on a terminal, or print it as a log line"""
+    with progress['lock']:
+        line = get_progress_line(progress)
+        if message and progress['is_tty']:
+            progress['stream'].write('\r\x1b[K' + message + '\n')
+        elif message:
+            line = message + ' (' + line + ')'
+        if progress['is_tty']:
+            progress['stream'].write('\r\x1b[K' + line)
+        else:
+            progress['stream'].write(line + '\n')
+        progress['stream'].flush()
+
+def run_progress_ticker(progress):
+    """Keep redrawing the progress line, or log it now and then"""
+    interval = 1 if progress['is_tty'] else 60
+    while not progress['stop'].wait(interval):
+        show_progress(progress)
+
+def start_progress_run(this_run):
+    """Add a run that is starting to the progress of its batch"""
+    progress = this_run['progress']
+    if not progress:
+        return
+    with progress['lock']:
+        progress['running'][this_run['title']] = (
+            get_started_run_hash(this_run), time.perf_counter())
+
+def finish_progress_run(this_run, state):
+    """Count a run as completed, failed or skipped in the batch progress"""
+    progress = this_run['progress']
+    if not progress:
+        return
+    with progress['lock']:
+        _, start_time = progress['running'].pop(
+            this_run['title'], (None, None))
+        progress[state] += 1
+        if start_time is not None:
+            duration = time.perf_counter() - start_time
+            progress['durations'].append(duration)
+    if start_time is not None:
+        show_progress(progress, f'{state.capitalize()}: {this_run["title"]} '
+                                f'in {format_duration(duration)}')
+
+def stop_progress(progress):
+    """Stop updating the progress of a batch and show the final state"""
+    progress['stop'].set()
+    progress['thread'].join()
+    show_progress(progress)
+    if progress['is_tty']:
+        progress['stream'].write('\n')
+        progress['stream'].flush()
+
+def get_run_count(batch_run):
+    """Get the number of runs in a batch, for showing progress"""
+    if batch_run['adapt']:
+        run_count = batch_run['adapt']
+    elif batch_run['--sweep']:
+        run_count = sum([1 for _ in get_sweep_runs(batch_run)])
+    else:
+        run_count = 1
+    if batch_run['--git'] and isinstance(batch_run['--input_branch'], list):
+        run_count *= max(len(batch_run['--input_branch']), 1)
+    return run_count
+
+# Result cache methods
+def get_file_hash(file_path):
+    """Get a hash of the contents of a file"""
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_cache_hash(settings, this_run):
+    """Get a hash of the command, options, templates and input files"""
+    run_folder = settings['current_folder']
+    cache_hash = hashlib.sha256()
+    cache_hash.update(json.dumps([this_run[key] for key in [
+        '<command>', '-p', '--template', '--class', '--post', '--full',
+        '--src', '--build', '--hash', '--config', '--dedup',
+        '--archive-format']]).encode())
+    input_files = set()
+    for pattern in get_copy_list(this_run['--class']):
+        input_files.update(set(run_folder.glob(pattern)))
+    for input_file in sorted(input_files):
+        if input_file.is_file() and input_file.name != LOGFILE:
+            cache_hash.update(input_file.name.encode())
+            cache_hash.update(get_file_hash(input_file).encode())
+    return cache_hash.hexdigest()
+
+def find_cached_results(archive_root, cache_hash):
+    """Get the archive folder of the latest run with the same hash, if any"""
+    cache_index = archive_root.joinpath(CACHE_INDEX)
+    folder_hashes = dict()
+    if cache_index.is_file():
+        with _cache_lock:
+            with open(cache_index, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    folder_hashes.pop(record['archive'], None)
+                    folder_hashes[record['archive']] = record['hash']
+    for folder, folder_hash in reversed(list(folder_hashes.items())):
+        if folder_hash == cache_hash and pathlib.Path(folder).is_dir():
+            return pathlib.Path(folder)
+    return None
+
+def add_to_cache(archive_root, cache_hash, archive_folder):
+    """Add the archive folder of a successful run to the cache index"""
+    record = {'hash': cache_hash, 'archive': str(archive_folder)}
+    with _cache_lock:
+        with open(archive_root.joinpath(CACHE_INDEX), 'a') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record) + '\n')
+
+def link_cached_results(cached_folder, archive_folder):
+    """Fill an archive folder with links to the files of a cached run"""
+    if not cached_folder.is_dir():
+        raise OSError(f'Cannot access cached folder: {cached_folder}')
+    create_archive_folder(archive_folder)
+    if cached_folder.resolve() == archive_folder.resolve():
+        return
+    for this_file in sorted(cached_folder.rglob('*')):
+        new_file = archive_folder.joinpath(this_file.relative_to(cached_folder))
+        if this_file.is_dir():
+            new_file.mkdir(exist_ok=True)
+        elif this_file.is_file() and not new_file.exists():
+            share_file(this_file, new_file)
 
 # Sweep methods
 def get_sweep_parameters(sweep_definition):
@@ -466,25 +1610,573 @@ def get_sweep_values(sweep_definition):
     else:
         return sweep_values.split(',')
 
-def get_sweep_strings(sweep_definition):
-    """Get all single-value parameter strings for a given sweep string"""
-    if not ':' in sweep_definition:
-        raise ValueError('Invalid sweep definition: ' + sweep_definition)
+def get_sweep_assignments(sweep_definition):
+    """Get (parameter, value) pairs for each step of a given sweep string"""
     sweep_parameters = get_sweep_parameters(sweep_definition)
     if len(sweep_parameters) > 1:
-        return [','.join([sweep_parameters[i] + ':' + values[i]
-                        for i in range(len(sweep_parameters))])
+        return [tuple((sweep_parameters[i], values[i])
+                      for i in range(len(sweep_parameters)))
                 for values in get_sweep_values(sweep_definition)]
     else:
-        return [sweep_parameters[0] + ':' + value
+        return [((sweep_parameters[0], value),)
                 for value in get_sweep_values(sweep_definition)]
 
+def get_assignment_string(assignments):
+    """Get a parameter string like a:1,b:2 from (parameter, value) pairs"""
+    return ','.join([name + ':' + value for name, value in assignments])
+
+def get_sweep_strings(sweep_definition):
+    """Get all single-value parameter strings for a given sweep string"""
+    if not ':' in sweep_definition:
+        raise ValueError('Invalid sweep definition: ' + sweep_definition)
+    return [get_assignment_string(assignments)
+            for assignments in get_sweep_assignments(sweep_definition)]
+
+def iter_sweep_combinations(sweeps, condition=None, known_values=None):
+    """Generate combinations of parameter values for multiple sweeps lazily"""
+    sweep_steps = [get_sweep_assignments(sweep) for sweep in sweeps]
+    values = dict(known_values) if known_values else dict()
+    def add_sweep(depth, chosen):
+        if depth == len(sweep_steps):
+            if condition is not None:
+                result = evaluate_condition(condition, values)
+                if result is None:
+                    raise ValueError('Unknown parameters in condition')
+                if not result:
+                    return
+            yield ','.join(chosen)
+            return
+        for assignments in sweep_steps[depth]:
+            values.update({name: get_number(value)
+                           for name, value in assignments})
+            if (condition is None
+                    or evaluate_condition(condition, values) is not False):
+                yield from add_sweep(depth + 1, chosen
+                                     + [get_assignment_string(assignments)])
+            for name, value in assignments:
+                values.pop(name, None)
+                if known_values and name in known_values:
+                    values[name] = known_values[name]
+    yield from add_sweep(0, [])
+
 def get_sweep_combinations(sweeps):
     """Get all combinations of parameter values for multiple sweeps"""
-    sweep_strings = [get_sweep_strings(sweep) for sweep in sweeps]
-    combinations = itertools.product(*sweep_strings)
-    combination_strings = [','.join(item) for item in combinations]
-    return combination_strings
+    return list(iter_sweep_combinations(sweeps))
+
+def get_number(value):
+    """Convert a parameter value to a number if possible"""
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def get_parameter_values(parameter_string):
+    """Get a dictionary of values from a parameter string like a:1,b:2"""
+    if not parameter_string:
+        return dict()
+    values = dict()
+    for assignment in parameter_string.split(','):
+        if not ':' in assignment:
+            raise ValueError(f'Invalid parameter: {assignment}')
+        name, value = assignment.split(':', 1)
+        values[name] = get_number(value)
+    return values
+
+# Sweep sampling methods
+SWEEP_RANGE = re.compile(
+    r'\s*([^:,()\s]+)\s*:\s*([^:]+?)\s*\.\.\s*([^:]+?)\s*(?::\s*(log))?\s*')
+
+def get_sweep_range(sweep_definition):
+    """Get name, limits and scale from a sweep range like a:0.1..10:log"""
+    match = SWEEP_RANGE.fullmatch(sweep_definition)
+    if not match:
+        return None
+    name, low, high, scale = match.groups()
+    try:
+        low, high = float(low), float(high)
+    except ValueError:
+        raise ValueError(f'Invalid sweep range: {sweep_definition}')
+    if scale and (low <= 0 or high <= 0):
+        raise ValueError(f'Log sweep ranges must be positive: {sweep_definition}')
+    return (name, low, high, bool(scale))
+
+def get_unit_samples(count, dimensions, method, seed):
+    """Get reproducible samples of the unit cube for a sampling method"""
+    if method == 'random':
+        generator = random.Random(seed)
+        return [[generator.random() for _ in range(dimensions)]
+                for _ in range(count)]
+    if method == 'lhs':
+        generator = random.Random(seed)
+        columns = [[(stratum + generator.random()) / count
+                    for stratum in generator.sample(range(count), count)]
+                   for _ in range(dimensions)]
+        return [list(sample) for sample in zip(*columns)]
+    if method == 'sobol':
+        try:
+            from scipy.stats import qmc
+        except ImportError:
+            raise ImportError('Sobol sampling needs SciPy, '
+                              'install it with: pip install scipy')
+        sampler = qmc.Sobol(d=dimensions, scramble=True, seed=seed)
+        return sampler.random(count).tolist()
+    raise ValueError(f'Unknown sampling method: {method}')
+
+def get_sample_value(low, high, log_scale, unit_value):
+    """Scale a value between 0 and 1 to a sweep range"""
+    if log_scale:
+        return low * (high / low) ** unit_value
+    return low + (high - low) * unit_value
+
+def get_sampled_sweeps(sweeps, count, method='random', seed=0):
+    """Replace sweep ranges by a single sweep through sampled values"""
+    ranges = [get_sweep_range(sweep) for sweep in sweeps]
+    sampled = [this_range for this_range in ranges if this_range]
+    if not sampled:
+        return list(sweeps)
+    value_sets = [[get_value_string(get_sample_value(*this_range[1:], value))
+                   for this_range, value in zip(sampled, sample)]
+                  for sample in get_unit_samples(count, len(sampled),
+                                                 method, seed)]
+    names = [this_range[0] for this_range in sampled]
+    if len(names) == 1:
+        sampled_sweep = (names[0] + ':'
+                         + ','.join([values[0] for values in value_sets]))
+    else:
+        sampled_sweep = ('(' + ','.join(names) + '):'
+                         + ','.join(['(' + ','.join(values) + ')'
+                                     for values in value_sets]))
+    return ([sweep for sweep, this_range in zip(sweeps, ranges)
+             if not this_range] + [sampled_sweep])
+
+# Sweep condition methods
+CONDITION_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or,
+                   ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+                   ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow,
+                   ast.Mod, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE,
+                   ast.Gt, ast.GtE, ast.Name, ast.Load, ast.Constant)
+CONDITION_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub,
+                       ast.Mult: operator.mul, ast.Div: operator.truediv,
+                       ast.Pow: operator.pow, ast.Mod: operator.mod,
+                       ast.USub: operator.neg, ast.UAdd: operator.pos,
+                       ast.Not: operator.not_,
+                       ast.Eq: operator.eq, ast.NotEq: operator.ne,
+                       ast.Lt: operator.lt, ast.LtE: operator.le,
+                       ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+def parse_condition(expression):
+    """Parse a condition on parameter values such as 'I<0.5 or E>1.0'"""
+    try:
+        condition = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError(f'Invalid condition: {expression}')
+    for node in ast.walk(condition):
+        if not isinstance(node, CONDITION_NODES):
+            raise ValueError(f'Invalid condition: {expression}')
+    return condition.body
+
+def evaluate_condition(node, values):
+    """Evaluate a parsed condition, or return None if values are missing"""
+    if isinstance(node, ast.Constant):
+        return node.value
+    elif isinstance(node, ast.Name):
+        return values.get(node.id)
+    elif isinstance(node, ast.UnaryOp):
+        operand = evaluate_condition(node.operand, values)
+        if operand is None:
+            return None
+        return CONDITION_OPERATORS[type(node.op)](operand)
+    elif isinstance(node, ast.BinOp):
+        left = evaluate_condition(node.left, values)
+        right = evaluate_condition(node.right, values)
+        if left is None or right is None:
+            return None
+        try:
+            return CONDITION_OPERATORS[type(node.op)](left, right)
+        except (TypeError, ZeroDivisionError) as error:
+            raise ValueError(
+                f'Cannot evaluate condition {ast.unparse(node)}: {error}')
+    elif isinstance(node, ast.BoolOp):
+        unknown = False
+        for value in node.values:
+            result = evaluate_condition(value, values)
+            if result is None:
+                unknown = True
+            elif isinstance(node.op, ast.And) and not result:
+                return False
+            elif isinstance(node.op, ast.Or) and result:
+                return True
+        if unknown:
+            return None
+        return isinstance(node.op, ast.And)
+    elif isinstance(node, ast.Compare):
+        unknown = False
+        left = evaluate_condition(node.left, values)
+        for this_operator, comparator in zip(node.ops, node.comparators):
+            right = evaluate_condition(comparator, values)
+            if left is None or right is None:
+                unknown = True
+            else:
+                try:
+                    result = CONDITION_OPERATORS[type(this_operator)](left,
+                                                                      right)
+                except TypeError as error:
+                    raise ValueError(f'Cannot evaluate condition '
+                                     f'{ast.unparse(node)}: {error}')
+                if not result:
+                    return False
+            left = right
+        if unknown:
+            return None
+        return True
+    else:
+        raise ValueError(f'Invalid condition: {ast.dump(node)}')
+
+# Sweep shard methods
+def get_shard(shard_definition):
+    """Get the index and number of shards from a definition like 2/4"""
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', shard_definition)
+    if not match:
+        raise ValueError(f'Invalid shard: {shard_definition}')
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or index < 1 or index > count:
+        raise ValueError(f'Invalid shard: {shard_definition}')
+    return index, count
+
+def select_shard(combinations, index, count):
+    """Select every nth combination, starting from the given shard index"""
+    return itertools.islice(combinations, index - 1, None, count)
+
+# Archive index methods
+INDEX_TABLES = """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY, archive TEXT UNIQUE, title TEXT,
+        command TEXT, class TEXT, branch TEXT, parameters TEXT,
+        date TEXT, size INTEGER, tier TEXT, cache_hash TEXT);
+    CREATE TABLE IF NOT EXISTS parameters (run_id INTEGER, name TEXT, value);
+    CREATE TABLE IF NOT EXISTS files (run_id INTEGER, name TEXT, size INTEGER);
+    CREATE INDEX IF NOT EXISTS runs_date ON runs (date);
+    CREATE INDEX IF NOT EXISTS runs_branch ON runs (branch, date);
+    CREATE INDEX IF NOT EXISTS runs_tier ON runs (tier, date);
+    CREATE INDEX IF NOT EXISTS parameters_run ON parameters (run_id, name);
+    CREATE INDEX IF NOT EXISTS files_run ON files (run_id);
+"""
+INDEX_OPERATORS = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/',
+                   ast.Mod: '%', ast.USub: '-', ast.UAdd: '+', ast.Not: 'NOT',
+                   ast.And: 'AND', ast.Or: 'OR',
+                   ast.Eq: '=', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=',
+                   ast.Gt: '>', ast.GtE: '>='}
+
+def open_archive_index(archive_root):
+    """Open the index of archived runs, creating it if needed"""
+    import sqlite3
+    connection = sqlite3.connect(archive_root.joinpath(ARCHIVE_INDEX),
+                                 timeout=60)
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(runs)')]
+    if columns and 'tier' not in columns:
+        connection.execute(
+            "ALTER TABLE runs ADD COLUMN tier TEXT DEFAULT 'full'")
+    if columns and 'cache_hash' not in columns:
+        connection.execute('ALTER TABLE runs ADD COLUMN cache_hash TEXT')
+    connection.executescript(INDEX_TABLES)
+    return connection
+
+def get_archive_manifest(archive_folder):
+    """Get the names and sizes of the files in an archive folder"""
+    return sorted([(this_file.name, this_file.stat().st_size)
+                   for this_file in archive_folder.iterdir()
+                   if this_file.is_file()])
+
+def index_run(archive_root, this_run):
+    """Add an archived run to the index, replacing any earlier entry"""
+    manifest = get_archive_manifest(this_run['archive'])
+    values = get_parameter_values(this_run['-p'])
+    if this_run['--git'] and isinstance(this_run['--input_branch'], str):
+        branch = this_run['--input_branch']
+    else:
+        branch = None
+    if this_run['archive_format']:
+        tier = 'packed'
+    elif this_run['--full']:
+        tier = 'full'
+    else:
+        tier = 'reduced'
+    with _index_lock:
+        connection = open_archive_index(archive_root)
+        try:
+            with connection:
+                old_ids = [(run_id,) for run_id, in connection.execute(
+                    'SELECT id FROM runs WHERE archive = ?',
+                    (str(this_run['archive']),))]
+                for table, column in [('parameters', 'run_id'),
+                                      ('files', 'run_id'), ('runs', 'id')]:
+                    connection.executemany(
+                        f'DELETE FROM {table} WHERE {column} = ?', old_ids)
+                run_id = connection.execute(
+                    'INSERT INTO runs (archive, title, command, class, branch,'
+                    ' parameters, date, size, tier, cache_hash)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (str(this_run['archive']), this_run['title'],
+                     this_run['<command>'], this_run['--class'], branch,
+                     this_run['-p'] or '',
+                     datetime.now().isoformat(timespec='seconds'),
+                     sum([size for name, size in manifest]),
+                     tier, this_run.get('cache_hash'))).lastrowid
+                connection.executemany(
+                    'INSERT INTO parameters VALUES (?, ?, ?)',
+                    [(run_id, name, value) for name, value in values.items()])
+                connection.executemany(
+                    'INSERT INTO files VALUES (?, ?, ?)',
+                    [(run_id, name, size) for name, size in manifest])
+        finally:
+            connection.close()
+
+def get_condition_sql(node):
+    """Translate a parsed condition into SQL on the parameters of a run"""
+    if isinstance(node, ast.Constant):
+        return '?', [node.value]
+    elif isinstance(node, ast.Name):
+        return ('(SELECT value FROM parameters WHERE run_id = runs.id'
+                ' AND name = ?)', [node.id])
+    elif isinstance(node, ast.UnaryOp):
+        operand, values = get_condition_sql(node.operand)
+        return f'({INDEX_OPERATORS[type(node.op)]} {operand})', values
+    elif isinstance(node, ast.BinOp) and type(node.op) in INDEX_OPERATORS:
+        left, left_values = get_condition_sql(node.left)
+        right, right_values = get_condition_sql(node.right)
+        return (f'({left} {INDEX_OPERATORS[type(node.op)]} {right})',
+                left_values + right_values)
+    elif isinstance(node, ast.BoolOp):
+        parts = [get_condition_sql(value) for value in node.values]
+        return ('(' + f' {INDEX_OPERATORS[type(node.op)]} '.join(
+                    [part for part, values in parts]) + ')',
+                [value for part, values in parts for value in values])
+    elif isinstance(node, ast.Compare):
+        parts = []
+        values = []
+        left, left_values = get_condition_sql(node.left)
+        for this_operator, comparator in zip(node.ops, node.comparators):
+            right, right_values = get_condition_sql(comparator)
+            parts.append(f'{left} {INDEX_OPERATORS[type(this_operator)]} '
+                         f'{right}')
+            values += left_values + right_values
+            left, left_values = right, right_values
+        return '(' + ' AND '.join(parts) + ')', values
+    else:
+        raise ValueError(f'Invalid condition for a query: {ast.dump(node)}')
+
+def get_query_date(given_date, days_later=0):
+    """Convert a date given as YYYY-MM-DD to a string to compare with"""
+    try:
+        query_date = date.fromisoformat(given_date)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid date: {given_date}')
+    return (query_date + timedelta(days=days_later)).isoformat()
+
+def query_archive_index(archive_root, condition=None, branches=None,
+                        since=None, until=None):
+    """Get the archived runs that meet a condition, oldest first"""
+    import sqlite3
+    if not archive_root.joinpath(ARCHIVE_INDEX).is_file():
+        raise OSError(f'Archive index not found in {archive_root}')
+    clauses = []
+    values = []
+    if condition is not None:
+        clause, clause_values = get_condition_sql(condition)
+        clauses.append(clause)
+        values += clause_values
+    if branches:
+        clauses.append('branch IN (' + ', '.join(['?'] * len(branches)) + ')')
+        values += list(branches)
+    if since:
+        clauses.append('date >= ?')
+        values.append(get_query_date(since))
+    if until:
+        clauses.append('date < ?')
+        values.append(get_query_date(until, days_later=1))
+    query = ('SELECT archive, title, branch, parameters, date, size'
+             ' FROM runs')
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    connection = open_archive_index(archive_root)
+    try:
+        connection.row_factory = sqlite3.Row
+        return [dict(row) for row in
+                connection.execute(query + ' ORDER BY date, id', values)]
+    finally:
+        connection.close()
+
+def show_runs(runs):
+    """Print a line for each archived run found in the index"""
+    for this_run in runs:
+        print(f'{this_run["date"]}  {format_size(this_run["size"]):>9}  '
+              f'{this_run["branch"] or "-":<20} '
+              f'{this_run["parameters"] or "-":<24} {this_run["archive"]}')
+    announce(f'{len(runs)} archived runs found')
+
+def run_query(arguments):
+    """Search the archive index for runs given on the command line"""
+    if arguments['--where']:
+        condition = parse_condition(arguments['--where'])
+    else:
+        condition = None
+    show_runs(query_archive_index(get_folder(ARCHIVE_ROOT), condition,
+                                  arguments['--input_branch'],
+                                  arguments['--since'], arguments['--until']))
+
+# Archive retention methods
+def get_days(given_days, description):
+    """Convert a number of days given as an option to a number"""
+    try:
+        days = int(given_days)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid {description}: {given_days}')
+    if days < 0:
+        raise ValueError(f'Invalid {description}: {given_days}')
+    return days
+
+def get_retention_cutoff(days):
+    """Get the date and time before which runs are older than given days"""
+    return (datetime.now() - timedelta(days=days)).isoformat(
+        timespec='seconds')
+
+def get_prune_list(simulation_class):
+    """Get list of file patterns that only a full archive keeps"""
+    reduced_list = get_move_list(simulation_class, is_full_archive=False)
+    return [pattern for pattern in get_move_list(simulation_class, True)
+            if pattern not in reduced_list]
+
+def prune_run(archive_folder, simulation_class):
+    """Delete the files of an archived run that only a full archive keeps"""
+    scan = scan_run_folder(archive_folder, [],
+                           get_move_list(simulation_class, False),
+                           get_prune_list(simulation_class))
+    for path in scan['delete']:
+        if path in scan['move']:
+            continue
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink(missing_ok=True)
+
+def compress_run(archive_folder, archive_format):
+    """Pack the files of an archived run, except its log and shared blobs"""
+    keep_names = [ARCHIVE_LOG, BLOB_MANIFEST]
+    manifest_file = archive_folder.joinpath(BLOB_MANIFEST)
+    if manifest_file.is_file():
+        with open(manifest_file, 'r') as f:
+            keep_names.extend(json.load(f))
+    paths = sorted([path for path in archive_folder.iterdir()
+                    if path.name not in keep_names
+                    and not path.name.startswith(ARCHIVE_PACK + '.')])
+    if not paths:
+        return
+    pack_file = archive_folder.joinpath(f'{ARCHIVE_PACK}.{archive_format}')
+    if archive_format == 'zip':
+        pack_zip(iter_archive_members(paths), pack_file)
+    else:
+        pack_tar_zst(iter_archive_members(paths), pack_file)
+    for path in paths:
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+def retire_run(archive_folder, simulation_class, steps, archive_format):
+    """Carry out the retention steps for one archived run"""
+    if not archive_folder.is_dir():
+        return 'missing'
+    tier = None
+    if 'prune' in steps:
+        prune_run(archive_folder, simulation_class)
+        tier = 'reduced'
+    if 'compress' in steps:
+        compress_run(archive_folder, archive_format)
+        tier = 'packed'
+    return tier
+
+def get_retention_steps(connection, keep_full_days, compress_days):
+    """Get the archived runs that are due for retention steps, by index"""
+    due_runs = dict()
+    if keep_full_days is not None:
+        for run_id, archive, simulation_class in connection.execute(
+                "SELECT id, archive, class FROM runs"
+                " WHERE tier = 'full' AND date < ?",
+                (get_retention_cutoff(keep_full_days),)):
+            due_runs[run_id] = (archive, simulation_class, ['prune'])
+    if compress_days is not None:
+        for run_id, archive, simulation_class in connection.execute(
+                "SELECT id, archive, class FROM runs"
+                " WHERE tier IN ('full', 'reduced') AND date < ?",
+                (get_retention_cutoff(compress_days),)):
+            due_runs.setdefault(run_id, (archive, simulation_class, []))
+            due_runs[run_id][2].append('compress')
+    return due_runs
+
+def apply_retention(archive_root, keep_full_days=None, compress_days=None,
+                    archive_format='zip', jobs=1):
+    """Prune and compress archived runs that are old enough, in parallel"""
+    import concurrent.futures
+    if keep_full_days is None and compress_days is None:
+        raise ValueError('Give a number of days to keep full data or to '
+                         'compress runs after')
+    if (keep_full_days is not None and compress_days is not None
+            and compress_days < keep_full_days):
+        raise ValueError('Runs cannot be compressed before they are pruned')
+    if not archive_root.joinpath(ARCHIVE_INDEX).is_file():
+        raise OSError(f'Archive index not found in {archive_root}')
+    connection = open_archive_index(archive_root)
+    try:
+        due_runs = get_retention_steps(connection, keep_full_days,
+                                       compress_days)
+        freed_size = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as (
+                executor):
+            futures = {executor.submit(retire_run, pathlib.Path(archive),
+                                       simulation_class, steps,
+                                       archive_format): run_id
+                       for run_id, (archive, simulation_class, steps)
+                       in due_runs.items()}
+            for future in concurrent.futures.as_completed(futures):
+                run_id = futures[future]
+                tier = future.result()
+                archive = pathlib.Path(due_runs[run_id][0])
+                with connection:
+                    old_size, = connection.execute(
+                        'SELECT size FROM runs WHERE id = ?',
+                        (run_id,)).fetchone()
+                    connection.execute('DELETE FROM files WHERE run_id = ?',
+                                       (run_id,))
+                    if tier == 'missing':
+                        manifest = []
+                        announce_error(f'Archive folder not found: {archive}')
+                    else:
+                        manifest = get_archive_manifest(archive)
+                    size = sum([size for name, size in manifest])
+                    connection.execute(
+                        'UPDATE runs SET tier = ?, size = ? WHERE id = ?',
+                        (tier, size, run_id))
+                    connection.executemany(
+                        'INSERT INTO files VALUES (?, ?, ?)',
+                        [(run_id, name, size) for name, size in manifest])
+                freed_size += (old_size or 0) - size
+    finally:
+        connection.close()
+    announce(f'Applied retention to {len(due_runs)} archived runs, '
+             f'freeing {format_size(max(freed_size, 0))}')
+
+def run_prune(arguments):
+    """Apply the retention policy given on the command line to the archive"""
+    keep_full_days = compress_days = None
+    if arguments['--keep-full']:
+        keep_full_days = get_days(arguments['--keep-full'],
+                                  'number of days to keep full data')
+    if arguments['--compress-after']:
+        compress_days = get_days(arguments['--compress-after'],
+                                 'number of days before compressing')
+    apply_retention(get_folder(ARCHIVE_ROOT), keep_full_days, compress_days,
+                    get_archive_format(arguments['--archive-format'] or 'zip'),
+                    get_job_count(arguments['--jobs']))
 
 # Define run settings and parameters
 def get_settings(arguments):
@@ -494,8 +2186,8 @@ def get_settings(arguments):
     settings['archive_root'] = get_folder(ARCHIVE_ROOT)
     settings['reproducible'] = get_folder(REPRODUCIBLE)
     settings['pyenv'] = get_folder(PYENV)
-    settings['python'] = get_python_for_reproducible(settings['reproducible'],
-                                                     settings['pyenv'])
+    settings['python'] = get_cached_python(settings['reproducible'],
+                                           settings['pyenv'])
     settings['reproduce'] = get_folder(REPRODUCIBLE).joinpath('reproduce')
     settings['logfile'] = LOGFILE
     settings['archive_log'] = ARCHIVE_LOG
@@ -510,16 +2202,135 @@ def get_parameters(settings, arguments):
         parameters['archive_copy'] = get_copy_list(parameters['--class'])
         parameters['archive_move'] = (
             get_move_list(parameters['--class'], parameters['--full']))
+        parameters['archive_format'] = (
+            get_archive_format(parameters['--archive-format']))
+        if parameters['archive_format'] and parameters['--fast-archive']:
+            raise ValueError('Packed archives cannot use --fast-archive')
     else:
         parameters['archive'] = None
+        parameters['archive_format'] = None
+    if parameters['--cache'] and not parameters['--archive']:
+        raise ValueError('The result cache can only be used with --archive')
+    if parameters['--cache'] and parameters['--git']:
+        raise ValueError('Cached runs cannot commit results with --git')
+    if parameters['--cache'] and parameters['--adapt']:
+        raise ValueError('Adaptive sweeps cannot use the result cache')
     if parameters['--git']:
         repo = get_git_repo(settings['current_folder'])
         parameters['--input_branch'] = (
             get_input_branch(repo, arguments['--input_branch']))
         parameters['--results_branch'] = (
             get_results_branch(repo, arguments['--results_branch']))
+        parameters['commit_batch'] = get_commit_batch(settings, parameters)
+    elif parameters['--commit-batch']:
+        raise ValueError('Commit batches can only be used with --git')
+    else:
+        parameters['commit_batch'] = None
+    sweep_ranges = [get_sweep_range(sweep)
+                    for sweep in parameters['--sweep'] or []]
+    if parameters['--samples']:
+        if not any(sweep_ranges):
+            raise ValueError('Samples can only be taken with a sweep range')
+        if parameters['--adapt']:
+            raise ValueError('Adaptive sweeps cannot use sweep ranges')
+        parameters['--sweep'] = get_sampled_sweeps(
+            parameters['--sweep'],
+            get_positive_integer(parameters['--samples'], 'number of samples'),
+            parameters['--sampling'] or 'random',
+            get_seed(parameters['--seed']))
+    elif any(sweep_ranges):
+        raise ValueError('Sweep ranges need a number of --samples')
+    elif parameters['--sampling'] or parameters['--seed']:
+        raise ValueError('Sampling options need a number of --samples')
+    if (parameters['--where'] or parameters['--shard']) and (
+            not parameters['--sweep']):
+        raise ValueError('Conditions and shards can only be used with --sweep')
+    if parameters['--where']:
+        parameters['condition'] = parse_condition(parameters['--where'])
+    else:
+        parameters['condition'] = None
+    if parameters['--shard']:
+        parameters['shard'] = get_shard(parameters['--shard'])
+    else:
+        parameters['shard'] = None
+    if parameters['--queue'] and (parameters['--git'] or parameters['--adapt']
+                                  or parameters['--submit']):
+        raise ValueError('Queued runs cannot use --git, --adapt or --submit')
+    if parameters['--adapt']:
+        parameters['adapt'] = get_positive_integer(parameters['--adapt'],
+                                                   'adaptive run budget')
+        if not (parameters['--sweep'] and parameters['--post']):
+            raise ValueError('Adaptive sweeps need --sweep and --post')
+        if parameters['--where'] or parameters['--shard']:
+            raise ValueError('Adaptive sweeps cannot use --where or --shard')
+        if (isinstance(parameters['--input_branch'], list)
+                and len(parameters['--input_branch']) > 1):
+            raise ValueError('Adaptive sweeps need a single input branch')
+        if parameters['--git'] and isinstance(parameters['--input_branch'],
+                                              list):
+            # Keep the metric on the run itself rather than on a branch copy
+            parameters['--input_branch'] = parameters['--input_branch'][0]
+    else:
+        parameters['adapt'] = None
+    parameters['cancel'] = None
+    parameters['ledger'] = settings['current_folder'].joinpath(LEDGER)
+    parameters['telemetry'] = settings['current_folder'].joinpath(TELEMETRY)
+    parameters['stage_times'] = None
+    parameters['progress'] = None
+    if parameters['--resume']:
+        parameters['completed_runs'] = (
+            get_completed_runs(parameters['ledger']))
+    else:
+        parameters['completed_runs'] = None
+    parameters['jobs'] = get_job_count(arguments['--jobs'])
+    parameters['cost'] = get_resource_cost(parameters['--class'],
+                                           parameters['--cores'],
+                                           parameters['--memory'])
+    parameters['priority'] = get_priority(parameters['--priority'])
+    if parameters['--archive-queue']:
+        if not (parameters['--archive'] or parameters['--clean']):
+            raise ValueError('Background archiving needs --archive or --clean')
+        parameters['archive_queue'] = get_positive_integer(
+            parameters['--archive-queue'], 'archive queue size')
+        parameters['--sandbox'] = True
+    else:
+        parameters['archive_queue'] = None
+    parameters['archiver'] = None
+    if parameters['jobs'] > 1:
+        parameters['--sandbox'] = True
+    if parameters['--worktree'] and not parameters['--git']:
+        raise ValueError('Worktrees can only be used with --git')
+    if parameters['--sandbox'] and parameters['--git']:
+        if not parameters['--worktree']:
+            raise ValueError('Use --worktree to run --git in separate folders')
+        parameters['--sandbox'] = False
     return parameters
 
+def get_job_count(given_jobs):
+    """Get the number of runs to carry out at the same time"""
+    if not given_jobs:
+        return 1
+    return get_positive_integer(given_jobs, 'number of jobs')
+
+def get_priority(given_priority):
+    """Get the scheduling priority of the runs, 0 unless given"""
+    if not given_priority:
+        return 0
+    try:
+        return int(given_priority)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid priority: {given_priority}')
+
+def get_memory_size(given_memory):
+    """Convert a memory size in GB given as an option to a number"""
+    try:
+        memory = float(given_memory)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid memory size: {given_memory}')
+    if not memory > 0:
+        raise ValueError(f'Invalid memory size: {given_memory}')
+    return memory
+
 def get_title(this_run):
     """Create a title string including the run date and main command"""
     if 'title' in this_run:
@@ -529,6 +2340,198 @@ def get_title(this_run):
                       this_run['<command>'].split()[0]])
     return title
 
+# Scheduler methods
+def get_resource_cost(simulation_class, given_cores=None, given_memory=None):
+    """Get the cores and memory in GB used by a run of a simulation type"""
+    if simulation_class == 'impact':
+        cost = {'cores': 1, 'memory': 2.0}
+    elif simulation_class == 'bdsim':
+        cost = {'cores': 1, 'memory': 4.0}
+    elif simulation_class == 'opal':
+        cost = {'cores': 4, 'memory': 8.0}
+    else:
+        cost = {'cores': 1, 'memory': 1.0}
+    if given_cores:
+        cost['cores'] = get_positive_integer(given_cores, 'number of cores')
+    if given_memory:
+        cost['memory'] = get_memory_size(given_memory)
+    return cost
+
+def get_machine_capacity():
+    """Get the cores and memory in GB available on this computer"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        memory = (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+                  / 2**30)
+    except (AttributeError, ValueError, OSError):
+        memory = float('inf')
+    return {'cores': cores, 'memory': memory}
+
+def create_scheduler(capacity):
+    """Create a scheduler that shares the given resources between runs"""
+    return {'capacity': dict(capacity),
+            'free': dict(capacity),
+            'waiting': [],
+            'order': itertools.count(),
+            'condition': threading.Condition()}
+
+def get_scheduler():
+    """Get the scheduler for this computer, shared by all runs"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = create_scheduler(get_machine_capacity())
+        return _scheduler
+
+def acquire_resources(scheduler, cost, priority=0):
+    """Wait until a run is first in line and its resources are free"""
+    cost = {name: min(amount, scheduler['capacity'][name])
+            for name, amount in cost.items()}
+    ticket = (-priority, next(scheduler['order']))
+    with scheduler['condition']:
+        heapq.heappush(scheduler['waiting'], ticket)
+        scheduler['condition'].wait_for(lambda: (
+            scheduler['waiting'][0] == ticket
+            and all([scheduler['free'][name] >= amount
+                     for name, amount in cost.items()])))
+        heapq.heappop(scheduler['waiting'])
+        for name, amount in cost.items():
+            scheduler['free'][name] -= amount
+        scheduler['condition'].notify_all()
+    return cost
+
+def release_resources(scheduler, cost):
+    """Return the resources of a finished run to the scheduler"""
+    with scheduler['condition']:
+        for name, amount in cost.items():
+            scheduler['free'][name] += amount
+        scheduler['condition'].notify_all()
+
+def run_scheduled(settings, this_run, run_method):
+    """Carry out a run with a given method once its resources are free"""
+    if not this_run['cost'] or (this_run.get('--worktree') and isinstance(
+            this_run.get('--input_branch'), list)):
+        # Each branch of this run waits for its own resources
+        return run_method(settings, this_run)
+    scheduler = get_scheduler()
+    cost = acquire_resources(scheduler, this_run['cost'], this_run['priority'])
+    try:
+        return run_method(settings, this_run)
+    finally:
+        release_resources(scheduler, cost)
+
+# Resource usage methods
+def get_usage(rusage, wall_time):
+    """Get the resources used by a finished process as a dictionary"""
+    max_rss = rusage.ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+    return {'wall_time': round(wall_time, 6),
+            'user_time': round(rusage.ru_utime, 6),
+            'system_time': round(rusage.ru_stime, 6),
+            'max_rss': max_rss,
+            'block_input': rusage.ru_inblock,
+            'block_output': rusage.ru_oublock,
+            'voluntary_switches': rusage.ru_nvcsw,
+            'involuntary_switches': rusage.ru_nivcsw}
+
+def run_with_usage(command, **popen_arguments):
+    """Run a command like subprocess.run and measure the resources it uses"""
+    start_time = time.perf_counter()
+    with subprocess.Popen(command, **popen_arguments) as process:
+        stdout = process.stdout.read() if process.stdout else None
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    result = subprocess.CompletedProcess(command, process.returncode, stdout)
+    result.usage = get_usage(rusage, time.perf_counter() - start_time)
+    return result
+
+# Fork server methods
+def start_fork_server(settings):
+    """Start a Reproducible helper process that forks a copy for each run"""
+    request_read, request_write = os.pipe()
+    response_read, response_write = os.pipe()
+    try:
+        process = subprocess.Popen(
+            [str(settings['python']), str(FORK_SERVER),
+             str(settings['reproduce']), str(request_read),
+             str(response_write)],
+            pass_fds=(request_read, response_write))
+    except:
+        for pipe_end in [request_write, response_read]:
+            os.close(pipe_end)
+        raise
+    finally:
+        os.close(request_read)
+        os.close(response_write)
+    fork_server = {'process': process,
+                   'thread': threading.current_thread(),
+                   'key': (str(settings['python']), str(settings['reproduce'])),
+                   'requests': os.fdopen(request_write, 'w'),
+                   'responses': os.fdopen(response_read, 'r')}
+    with _fork_server_lock:
+        _fork_server_list.append(fork_server)
+    return fork_server
+
+def get_fork_server(settings):
+    """Get the fork server of this thread, starting one if needed"""
+    fork_server = getattr(_fork_servers, 'server', None)
+    key = (str(settings['python']), str(settings['reproduce']))
+    if (fork_server is None or fork_server['key'] != key
+            or fork_server['process'].poll() is not None):
+        if fork_server is not None:
+            stop_fork_server(fork_server)
+        fork_server = start_fork_server(settings)
+        _fork_servers.server = fork_server
+    return fork_server
+
+def run_in_fork_server(settings, arguments, *, stdout=None):
+    """Run Reproducible with the given arguments through the fork server"""
+    fork_server = get_fork_server(settings)
+    request = {'arguments': [str(argument) for argument in arguments],
+               'cwd': str(settings['current_folder']),
+               'stdout': str(stdout) if stdout else None}
+    try:
+        fork_server['requests'].write(json.dumps(request) + '\n')
+        fork_server['requests'].flush()
+        response = fork_server['responses'].readline()
+    except BrokenPipeError:
+        response = ''
+    if not response:
+        stop_fork_server(fork_server)
+        raise OSError('Reproducible fork server stopped unexpectedly')
+    response = json.loads(response)
+    result = subprocess.CompletedProcess(arguments, response['returncode'])
+    result.usage = get_usage(types.SimpleNamespace(**response['usage']),
+                             response['wall_time'])
+    return result
+
+def stop_fork_server(fork_server):
+    """Close the requests to a fork server and wait for it to stop"""
+    with _fork_server_lock:
+        if fork_server in _fork_server_list:
+            _fork_server_list.remove(fork_server)
+    for pipe in [fork_server['requests'], fork_server['responses']]:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+    fork_server['process'].wait()
+    if getattr(_fork_servers, 'server', None) is fork_server:
+        _fork_servers.server = None
+
+def stop_fork_servers():
+    """Stop the fork servers of this thread and of threads that have ended"""
+    with _fork_server_lock:
+        fork_servers = [fork_server for fork_server in _fork_server_list
+                        if fork_server['thread'] is threading.current_thread()
+                        or not fork_server['thread'].is_alive()]
+    for fork_server in fork_servers:
+        stop_fork_server(fork_server)
+
 # Run methods
 def reproducible_run(settings, this_run):
     """Run the given command using Reproducible"""
@@ -566,39 +2569,134 @@ def reproducible_run(settings, this_run):
         command.append(this_run['-p'])
     command.append('--')
     command.append(this_run['<command>'])
-    return subprocess.run(command, cwd=settings['current_folder'])
+    if this_run['--fork-server']:
+        return run_in_fork_server(settings, command[2:])
+    return run_with_usage(command, cwd=settings['current_folder'])
 
 def run_single(settings, this_run):
+    """Carry out a single run and keep track of it in the ledger"""
+    this_run['run_hash'] = get_run_hash(this_run)
+    if is_cancelled_run(this_run) or is_completed_run(this_run):
+        return
+    record_run(this_run, 'started')
+    start_progress_run(this_run)
+    this_run['timings'] = dict()
+    this_run['usage'] = dict()
+    this_run['cache_hit'] = False
+    try:
+        result = run_steps(settings, this_run)
+    except:
+        record_run(this_run, 'failed')
+        record_telemetry(this_run)
+        finish_progress_run(this_run, 'failed')
+        raise
+    this_run['returncode'] = result.returncode
+    record_run(this_run, 'completed' if result.returncode == 0 else 'failed')
+    finish_progress_run(this_run,
+                        'completed' if result.returncode == 0 else 'failed')
+    if this_run['cache_hit'] or not (
+            this_run['archiver']
+            and (this_run['--archive'] or this_run['--clean'])):
+        record_telemetry(this_run)
+
+def run_steps(settings, this_run):
     """Work through the simulation steps for each individual run"""
     announce_start(this_run)
     if this_run['--git']:
-        repo = get_git_repo(settings['current_folder'])
-        git_checkout(repo, this_run['--input_branch'])
-        git_get_file(repo, this_run['--results_branch'], settings['logfile'])
+        with timed_stage(this_run, 'checkout'):
+            repo = get_git_repo(settings['current_folder'])
+            if not this_run['--worktree']:
+                git_checkout(repo, this_run['--input_branch'])
+            if not (this_run['--worktree'] or this_run['commit_batch']):
+                git_get_file(repo, this_run['--results_branch'],
+                             settings['logfile'])
+            elif (this_run['--worktree']
+                    or not this_run['commit_batch']['updates']):
+                git_read_file(repo, this_run['--results_branch'],
+                              settings['logfile'], settings['current_folder'])
+        logfile = settings['current_folder'].joinpath(settings['logfile'])
+        log_offset = get_file_size(logfile)
     if this_run['--template']:
-        valid, invalid = get_valid_templates(settings['current_folder'],
-                                             this_run['--template'])
+        with timed_stage(this_run, 'templates'):
+            valid, invalid = get_valid_templates(settings['current_folder'],
+                                                 this_run['--template'])
         if invalid:
             announce_error(f'Skipping missing templates: {invalid}')
         this_run['--template'] = valid
-    reproducible_run(settings, this_run)
+    if this_run['--cache']:
+        with timed_stage(this_run, 'cache'):
+            this_run['cache_hash'] = get_cache_hash(settings, this_run)
+            cached_folder = find_cached_results(settings['archive_root'],
+                                                this_run['cache_hash'])
+            if cached_folder:
+                announce(f'Using cached results from {cached_folder}')
+                link_cached_results(cached_folder, this_run['archive'])
+                index_run(settings['archive_root'], this_run)
+        if cached_folder:
+            this_run['cache_hit'] = True
+            announce_end(this_run)
+            return subprocess.CompletedProcess(this_run['<command>'], 0)
+    with timed_stage(this_run, 'run'):
+        result = reproducible_run(settings, this_run)
+    this_run.setdefault('usage', dict())['run'] = result.usage
     if this_run['--post']:
-        post_process(settings, this_run['--post'])
+        with timed_stage(this_run, 'post'):
+            post_result = post_process(settings, this_run['--post'],
+                                       capture=bool(this_run['adapt']))
+        this_run['usage']['post'] = post_result.usage
+        if this_run['adapt']:
+            this_run['metric'] = get_metric(post_result.stdout)
     if this_run['--git']:
-        git_switch(repo, this_run['--results_branch'])
-        git_commit(repo, this_run['commit_files'], this_run['commit_message'])
-        git_switch(repo, this_run['--input_branch'])
+        with timed_stage(this_run, 'commit'):
+            if this_run['commit_batch']:
+                add_to_commit_batch(repo, this_run['commit_batch'],
+                                    get_log_update(logfile, log_offset),
+                                    this_run['commit_message'])
+            elif this_run['--worktree']:
+                git_append_to_file(repo, this_run['--results_branch'],
+                                   settings['logfile'],
+                                   get_log_update(logfile, log_offset),
+                                   this_run['commit_message'])
+            else:
+                git_switch(repo, this_run['--results_branch'])
+                git_commit(repo, this_run['commit_files'],
+                           this_run['commit_message'])
+                git_switch(repo, this_run['--input_branch'])
+    if not this_run['archiver']:
+        store_output(settings, this_run, result.returncode)
+    announce_end(this_run)
+    return result
+
+def store_output(settings, this_run, returncode):
+    """Archive or delete the output files of a finished run"""
     if this_run['--archive']:
-        archive_output(settings, this_run)
+        copy_patterns = this_run['archive_copy']
+        move_patterns = this_run['archive_move']
+    else:
+        copy_patterns = move_patterns = []
     if this_run['--clean']:
-        delete_output(settings, this_run)
-    announce_end(this_run)
+        delete_patterns = get_delete_list(this_run['--class'])
+    else:
+        delete_patterns = []
+    with timed_stage(this_run, 'scan'):
+        scan = scan_run_folder(settings['current_folder'], copy_patterns,
+                               move_patterns, delete_patterns)
+    if this_run['--archive']:
+        with timed_stage(this_run, 'archive'):
+            archive_output(settings, this_run, scan=scan)
+            if this_run['--cache'] and returncode == 0:
+                add_to_cache(settings['archive_root'], this_run['cache_hash'],
+                             this_run['archive'])
+    if this_run['--clean']:
+        with timed_stage(this_run, 'clean'):
+            delete_output(settings, this_run, scan=scan)
 
 def run_with_git(settings, this_run):
     """Run for a single or multiple input branches"""
     this_run['commit_files'] = get_commit_files(settings, this_run)
     this_run['commit_message'] = get_commit_message(this_run)
     if isinstance(this_run['--input_branch'], list):
+        branch_runs = []
         for this_branch in this_run['--input_branch']:
             branch_run = this_run.copy()
             branch_run['--input_branch'] = this_branch
@@ -609,40 +2707,633 @@ def run_with_git(settings, this_run):
             if branch_run['--archive']:
                 branch_run['archive'] = this_run['archive'].joinpath(
                     this_branch.replace('input/', ''))
-            run_single(settings, branch_run)
+            branch_runs.append(branch_run)
+        if this_run['--worktree']:
+            run_parallel(settings, branch_runs, len(branch_runs),
+                         run_in_worktree)
+        else:
+            for branch_run in branch_runs:
+                run_single(settings, branch_run)
+    elif this_run['--worktree']:
+        run_in_worktree(settings, this_run)
     else:
         run_single(settings, this_run)
 
+def run_in_worktree(settings, this_run):
+    """Run in a separate worktree for the input branch of this run"""
+    if is_cancelled_run(this_run) or is_completed_run(this_run):
+        return
+    repo = get_git_repo(settings['current_folder'])
+    worktree_settings = settings.copy()
+    worktree_settings['current_folder'] = (
+        create_worktree(repo, this_run['--input_branch']))
+    handed_off = False
+    try:
+        run_single(worktree_settings, this_run)
+        handed_off = hand_off_output(
+            worktree_settings, this_run,
+            lambda: remove_worktree(repo, worktree_settings['current_folder']))
+    finally:
+        if handed_off:
+            pass
+        elif this_run['--archive'] or this_run['--clean']:
+            remove_worktree(repo, worktree_settings['current_folder'])
+        else:
+            detach_worktree(repo, worktree_settings['current_folder'])
+            announce('Results of ' + this_run['title'] + ' kept in '
+                     + str(worktree_settings['current_folder']))
+
+def run_in_sandbox(settings, this_run):
+    """Run in a sandbox folder and merge the log back"""
+    if is_cancelled_run(this_run) or is_completed_run(this_run):
+        return
+    sandbox_settings = settings.copy()
+    sandbox_settings['current_folder'] = (
+        create_sandbox_folder(settings['current_folder'], this_run['--class'],
+                              templates=this_run['--template']))
+    sandbox_log = sandbox_settings['current_folder'].joinpath(
+        settings['logfile'])
+    log_offset = get_file_size(sandbox_log)
+    handed_off = False
+    try:
+        run_single(sandbox_settings, this_run)
+        merge_log(sandbox_log,
+                  settings['current_folder'].joinpath(settings['logfile']),
+                  log_offset)
+        handed_off = hand_off_output(
+            sandbox_settings, this_run,
+            lambda: remove_sandbox_folder(sandbox_settings['current_folder']))
+    finally:
+        if handed_off:
+            pass
+        elif this_run['--archive'] or this_run['--clean']:
+            remove_sandbox_folder(sandbox_settings['current_folder'])
+        else:
+            announce('Results of ' + this_run['title'] + ' kept in '
+                     + str(sandbox_settings['current_folder']))
+
+def run_selected(settings, this_run):
+    """Run in the way selected by the options for this run"""
+    if this_run['--git']:
+        run_with_git(settings, this_run)
+    elif this_run['--sandbox']:
+        run_in_sandbox(settings, this_run)
+    else:
+        run_single(settings, this_run)
+
+def run_parallel(settings, runs, jobs, run_method):
+    """Use the given method to carry out up to a number of runs at once"""
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = set()
+        for this_run in runs:
+            if len(running) >= jobs:
+                finished, running = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+            running.add(executor.submit(run_scheduled, settings, this_run,
+                                        run_method))
+        for future in concurrent.futures.as_completed(running):
+            future.result()
+
+def get_sweep_runs(batch_run):
+    """Generate the settings for each run in a parametric sweep"""
+    combinations = iter_sweep_combinations(
+        batch_run['--sweep'], batch_run['condition'],
+        get_parameter_values(batch_run['-p']))
+    if batch_run['shard']:
+        combinations = select_shard(combinations, *batch_run['shard'])
+    for this_combination in combinations:
+        yield get_combination_run(batch_run, this_combination)
+
+def get_combination_run(batch_run, this_combination):
+    """Get the settings for the run of one combination of sweep values"""
+    this_run = batch_run.copy()
+    this_run['title'] = batch_run['title'] + ' for ' + this_combination
+    if this_run['-p']:
+        this_run['-p'] += ',' + this_combination
+    else:
+        this_run['-p'] = this_combination
+    if this_run['--archive']:
+        folder_name = get_safe_folder_name(this_combination)
+        this_run['archive'] = batch_run['archive'].joinpath(folder_name)
+    return this_run
+
+# Adaptive sweep methods
+def get_adaptive_axes(sweeps):
+    """Get the parameter name and sorted numeric values for each sweep"""
+    axes = []
+    for sweep in sweeps:
+        sweep_parameters = get_sweep_parameters(sweep)
+        if len(sweep_parameters) > 1:
+            raise ValueError(f'Adaptive sweeps need separate parameters: {sweep}')
+        try:
+            values = sorted(set([float(value)
+                                 for value in get_sweep_values(sweep)]))
+        except ValueError:
+            raise ValueError(f'Adaptive sweeps need numeric values: {sweep}')
+        axes.append((sweep_parameters[0], values))
+    return axes
+
+def get_value_labels(sweeps):
+    """Get the value strings as given by the user for each sweep"""
+    labels = []
+    for sweep in sweeps:
+        axis_labels = dict()
+        for value in get_sweep_values(sweep):
+            axis_labels.setdefault(float(value), value)
+        labels.append(axis_labels)
+    return labels
+
+def get_adaptive_combination(axes, labels, point):
+    """Get a parameter string for a point on the adaptive grid"""
+    return ','.join([name + ':' + axis_labels[value]
+                     for (name, _), axis_labels, value
+                     in zip(axes, labels, point)])
+
+def get_value_string(value):
+    """Format a numeric parameter value for use in a parameter string"""
+    return f'{value:.10g}'
+
+def get_refinement(axes, metrics):
+    """Find the interval with the largest change in metric and its midpoint"""
+    best_change = 0
+    best_refinement = None
+    for axis, (_, values) in enumerate(axes):
+        other_axes = [axis_values for i, (_, axis_values) in enumerate(axes)
+                      if i != axis]
+        for low, high in zip(values[:-1], values[1:]):
+            midpoint = (low + high) / 2
+            if get_value_string(midpoint) in [get_value_string(low),
+                                              get_value_string(high)]:
+                continue
+            for others in itertools.product(*other_axes):
+                low_point = others[:axis] + (low,) + others[axis:]
+                high_point = others[:axis] + (high,) + others[axis:]
+                if (metrics.get(low_point) is None
+                        or metrics.get(high_point) is None):
+                    continue
+                change = abs(metrics[high_point] - metrics[low_point])
+                if change > best_change:
+                    best_change = change
+                    best_refinement = (axis, midpoint)
+    return best_refinement
+
+def run_adaptive(settings, batch_run):
+    """Run a coarse sweep and then refine it where the metric changes most"""
+    axes = get_adaptive_axes(batch_run['--sweep'])
+    labels = get_value_labels(batch_run['--sweep'])
+    metrics = dict()
+    points = list(itertools.product(*[values for _, values in axes]))
+    if len(points) > batch_run['adapt']:
+        raise ValueError(f'Initial sweep needs {len(points)} runs, '
+                         f'more than the budget of {batch_run["adapt"]}')
+    run_count = 0
+    while points:
+        runs = [get_combination_run(batch_run,
+                                    get_adaptive_combination(axes, labels,
+                                                             point))
+                for point in points]
+        if batch_run['jobs'] > 1:
+            run_parallel(settings, runs, batch_run['jobs'], run_selected)
+        else:
+            for this_run in runs:
+                run_scheduled(settings, this_run, run_selected)
+        for point, this_run in zip(points, runs):
+            metrics[point] = this_run.get('metric')
+        run_count += len(points)
+        refinement = get_refinement(axes, metrics)
+        if refinement is None:
+            break
+        axis, midpoint = refinement
+        axes[axis][1].append(midpoint)
+        axes[axis][1].sort()
+        labels[axis][midpoint] = get_value_string(midpoint)
+        other_axes = [values for i, (_, values) in enumerate(axes) if i != axis]
+        points = [others[:axis] + (midpoint,) + others[axis:]
+                  for others in itertools.product(*other_axes)]
+        if run_count + len(points) > batch_run['adapt']:
+            break
+    announce(f'Adaptive sweep finished after {run_count} runs')
+
 # Main batch method
 def run_batch(settings, parameters):
     """Run through the batch for different parameter values and input files"""
     batch_run = parameters.copy()
     batch_run['title'] = get_title(batch_run)
-    if batch_run['--sweep']:
-        for this_combination in get_sweep_combinations(batch_run['--sweep']):
-            this_run = batch_run.copy()
-            this_run['title'] = batch_run['title'] + ' for ' + this_combination
-            if this_run['-p']:
-                this_run['-p'] += ',' + this_combination
-            else:
-                this_run['-p'] = this_combination
-            if this_run['--archive']:
-                folder_name = get_safe_folder_name(this_combination)
-                this_run['archive'] = batch_run['archive'].joinpath(folder_name)
-            if this_run['--git']:
-                run_with_git(settings, this_run)
-            else:
-                run_single(settings, this_run)
+    batch_run['stage_times'] = dict()
+    if batch_run['--progress']:
+        batch_run['progress'] = create_progress(
+            get_run_count(batch_run), get_run_history(batch_run['telemetry']),
+            batch_run['jobs'])
+    if batch_run['archive_queue']:
+        batch_run['archiver'] = create_archiver(batch_run['archive_queue'])
+    try:
+        if batch_run['adapt']:
+            run_adaptive(settings, batch_run)
+        elif batch_run['--sweep'] and batch_run['jobs'] > 1:
+            run_parallel(settings, get_sweep_runs(batch_run),
+                         batch_run['jobs'], run_selected)
+        elif batch_run['--sweep']:
+            for this_run in get_sweep_runs(batch_run):
+                run_scheduled(settings, this_run, run_selected)
+        else:
+            run_scheduled(settings, batch_run, run_selected)
+    finally:
+        if batch_run['archiver']:
+            wait_for_archiver(batch_run['archiver'])
+        if batch_run['commit_batch']:
+            commit_batch_results(get_git_repo(settings['current_folder']),
+                                 batch_run['commit_batch'])
+        if batch_run['--fork-server']:
+            stop_fork_servers()
+        if batch_run['progress']:
+            stop_progress(batch_run['progress'])
+        show_stage_times(batch_run['stage_times'])
+
+
+# Daemon methods
+def get_socket_path(given_socket):
+    """Get the path of the daemon socket, unless given an override"""
+    if given_socket:
+        return get_folder(given_socket)
+    return get_folder(tempfile.gettempdir()).joinpath(DAEMON_SOCKET)
+
+def is_cancelled_run(this_run):
+    """Check whether the batch of a run was cancelled through the daemon"""
+    if this_run['cancel'] and this_run['cancel'].is_set():
+        finish_progress_run(this_run, 'skipped')
+        return True
+    return False
+
+def send_request(socket_path, request):
+    """Send a request to the daemon and return its answer"""
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(str(socket_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise OSError(f'No run_batch daemon running at {socket_path}')
+        connection.sendall((json.dumps(request) + '\n').encode())
+        with connection.makefile('r') as answer:
+            response = json.loads(answer.readline())
+    if 'error' in response:
+        raise ValueError(response['error'])
+    return response
+
+def create_daemon(jobs):
+    """Create the state of a daemon that runs up to a number of batches"""
+    return {'jobs': jobs,
+            'batches': dict(),
+            'order': itertools.count(1),
+            'condition': threading.Condition()}
+
+def get_isolated_batch(settings, folder, arguments):
+    """Get settings and parameters to run a batch beside others in a folder"""
+    arguments = dict(arguments, **{'--submit': False, '--queue': None})
+    if arguments['--git']:
+        arguments['--worktree'] = True
     else:
-        if batch_run['--git']:
-            run_with_git(settings, batch_run)
+        arguments['--sandbox'] = True
+    settings = dict(settings, current_folder=get_folder(folder))
+    parameters = get_parameters(settings, arguments)
+    return settings, parameters
+
+def get_batch_status(batch):
+    """Get the details of a batch that can be sent to a client"""
+    return {name: batch[name] for name in ['id', 'state', 'folder', 'title',
+                                           'submitted', 'started', 'finished',
+                                           'error']}
+
+def get_batch_ids(daemon, request):
+    """Get the batches a request is about, all batches if none is given"""
+    if request.get('id') is None:
+        return list(daemon['batches'])
+    batch_id = get_positive_integer(request['id'], 'batch number')
+    if batch_id not in daemon['batches']:
+        raise ValueError(f'Unknown batch: {batch_id}')
+    return [batch_id]
+
+def handle_request(daemon, request):
+    """Carry out a submit, status, cancel or wait request for a client"""
+    action = request.get('action')
+    with daemon['condition']:
+        if action == 'submit':
+            settings, parameters = get_isolated_batch(
+                get_settings(request['arguments']), request['folder'],
+                request['arguments'])
+            parameters['cancel'] = threading.Event()
+            batch_id = next(daemon['order'])
+            daemon['batches'][batch_id] = {
+                'id': batch_id, 'state': 'queued',
+                'folder': str(settings['current_folder']),
+                'title': get_title(parameters),
+                'submitted': datetime.now().isoformat(timespec='seconds'),
+                'started': None, 'finished': None, 'error': None,
+                'settings': settings, 'parameters': parameters}
+            daemon['condition'].notify_all()
+            return {'id': batch_id}
+        batch_ids = get_batch_ids(daemon, request)
+        if action == 'cancel':
+            for batch_id in batch_ids:
+                batch = daemon['batches'][batch_id]
+                batch['parameters']['cancel'].set()
+                if batch['state'] == 'queued':
+                    batch['state'] = 'cancelled'
+            daemon['condition'].notify_all()
+        elif action == 'wait':
+            daemon['condition'].wait_for(lambda: all([
+                daemon['batches'][batch_id]['state'] not in ['queued',
+                                                             'running']
+                for batch_id in batch_ids]))
+        elif action != 'status':
+            raise ValueError(f'Unknown daemon request: {action}')
+        return {'batches': [get_batch_status(daemon['batches'][batch_id])
+                            for batch_id in batch_ids]}
+
+def get_next_batch(daemon):
+    """Wait for the queued batch with the highest priority and start it"""
+    with daemon['condition']:
+        queued = lambda: [batch for batch in daemon['batches'].values()
+                          if batch['state'] == 'queued']
+        daemon['condition'].wait_for(queued)
+        batch = max(queued(), key=lambda batch: (
+            batch['parameters']['priority'], -batch['id']))
+        batch['state'] = 'running'
+        batch['started'] = datetime.now().isoformat(timespec='seconds')
+        return batch
+
+def finish_batch(daemon, batch, error=None):
+    """Record the end of a batch and wake up waiting clients"""
+    with daemon['condition']:
+        if batch['parameters']['cancel'].is_set():
+            batch['state'] = 'cancelled'
+        elif error:
+            batch['state'] = 'failed'
         else:
-            run_single(settings, batch_run)
+            batch['state'] = 'completed'
+        batch['error'] = error
+        batch['finished'] = datetime.now().isoformat(timespec='seconds')
+        daemon['condition'].notify_all()
+
+def run_daemon_batches(daemon):
+    """Keep running queued batches one after the other"""
+    while True:
+        batch = get_next_batch(daemon)
+        try:
+            run_batch(batch['settings'], batch['parameters'])
+        except Exception as error:
+            announce_error(f'Batch {batch["id"]} failed: {error}')
+            finish_batch(daemon, batch, str(error))
+        else:
+            finish_batch(daemon, batch)
+
+def serve_connection(daemon, connection):
+    """Answer the requests of one client connection"""
+    with connection, connection.makefile('rw') as stream:
+        for line in stream:
+            try:
+                response = handle_request(daemon, json.loads(line))
+            except Exception as error:
+                response = {'error': str(error)}
+            stream.write(json.dumps(response) + '\n')
+            stream.flush()
+
+def serve_daemon(socket_path, jobs):
+    """Listen for batch requests and run batches until interrupted"""
+    import socket
+    if socket_path.exists():
+        try:
+            send_request(socket_path, {'action': 'status'})
+        except OSError:
+            socket_path.unlink()
+        else:
+            raise OSError(f'A run_batch daemon is already running at '
+                          f'{socket_path}')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    daemon = create_daemon(jobs)
+    for _ in range(jobs):
+        threading.Thread(target=run_daemon_batches, args=(daemon,),
+                         daemon=True).start()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(str(socket_path))
+        os.chmod(socket_path, 0o600)
+        server.listen()
+        announce(f'Daemon listening at {socket_path} for up to {jobs} batches')
+        try:
+            while True:
+                connection, _ = server.accept()
+                threading.Thread(target=serve_connection,
+                                 args=(daemon, connection),
+                                 daemon=True).start()
+        finally:
+            socket_path.unlink()
+
+def show_batches(response):
+    """Print the state of the batches in a daemon response"""
+    for batch in response['batches']:
+        print(f'{batch["id"]:>4}  {batch["state"]:<10} {batch["folder"]}  '
+              f'{batch["title"]}')
+        if batch['error']:
+            print(f'      {batch["error"]}')
+
+def run_client(arguments):
+    """Send a daemon command or a batch submission to the daemon"""
+    socket_path = get_socket_path(arguments['--socket'])
+    if arguments['daemon']:
+        serve_daemon(socket_path, get_job_count(arguments['--jobs']))
+    elif arguments['--submit']:
+        settings = get_settings(arguments)
+        get_parameters(settings, arguments)
+        response = send_request(socket_path, {
+            'action': 'submit',
+            'folder': str(settings['current_folder']),
+            'arguments': arguments})
+        announce(f'Submitted batch {response["id"]}')
+    else:
+        action = [name for name in ['status', 'cancel', 'wait']
+                  if arguments[name]][0]
+        show_batches(send_request(socket_path, {'action': action,
+                                                'id': arguments['<batch>']}))
+
+# Work queue methods
+def get_queue_folder(queue_path, state):
+    """Get the folder for tasks in a given state, making it if needed"""
+    folder = get_folder(queue_path).joinpath(state)
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+def write_task(queue_path, task_name, task):
+    """Add a task to a queue folder, so that workers only see complete files"""
+    new_file = get_queue_folder(queue_path, 'new').joinpath(task_name)
+    with open(new_file, 'w') as f:
+        json.dump(task, f)
+    os.rename(new_file, get_queue_folder(queue_path, 'pending').joinpath(
+        task_name))
+
+def queue_batch(settings, batch_run, arguments):
+    """Write each run of a batch as a task file into a queue folder"""
+    import socket
+    batch_run['title'] = get_title(batch_run)
+    if batch_run['--sweep']:
+        runs = get_sweep_runs(batch_run)
+    else:
+        runs = [batch_run]
+    prefix = (f'{datetime.now():%Y%m%d-%H%M%S}-{socket.gethostname()}-'
+              f'{os.getpid()}')
+    task_count = 0
+    for task_count, this_run in enumerate(runs, start=1):
+        write_task(batch_run['--queue'], f'{prefix}-{task_count:06d}.json', {
+            'folder': str(settings['current_folder']),
+            'arguments': arguments,
+            'title': this_run['title'],
+            '-p': this_run['-p'],
+            'archive': str(this_run['archive']) if this_run['archive']
+                       else None,
+            'cost': this_run['cost'],
+            'priority': this_run['priority']})
+    announce(f'Queued {task_count} runs in {get_folder(batch_run["--queue"])}')
+
+def get_worker_name():
+    """Get the host name and process ID that identify this worker"""
+    import socket
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def claim_task(queue_path):
+    """Claim the oldest pending task in a queue folder, if there is one"""
+    pending_folder = get_queue_folder(queue_path, 'pending')
+    claimed_folder = get_queue_folder(queue_path, 'claimed')
+    for task_file in sorted(pending_folder.glob('*.json')):
+        claimed_file = claimed_folder.joinpath(task_file.name)
+        try:
+            os.rename(task_file, claimed_file)
+        except FileNotFoundError:
+            continue
+        with open(claimed_file, 'r') as f:
+            task = json.load(f)
+        task.update({'worker': get_worker_name(),
+                     'claimed': datetime.now().isoformat(timespec='seconds')})
+        with open(claimed_file, 'w') as f:
+            json.dump(task, f)
+        task['task_file'] = str(claimed_file)
+        return task
+    return None
+
+def is_running_process(pid):
+    """Check whether a process with the given ID runs on this computer"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def is_stale_task(task, claimed_time, max_hours=None):
+    """Check whether the worker that claimed a task has stopped"""
+    host, _, pid = (task.get('worker') or '').rpartition(':')
+    if host and host == get_worker_name().rpartition(':')[0]:
+        if not is_running_process(int(pid)):
+            return True
+    return (max_hours is not None
+            and datetime.now() - claimed_time > timedelta(hours=max_hours))
+
+def requeue_stale_tasks(queue_path, max_hours=None):
+    """Return tasks claimed by workers that stopped to the pending tasks"""
+    claimed_folder = get_queue_folder(queue_path, 'claimed')
+    pending_folder = get_queue_folder(queue_path, 'pending')
+    requeued = 0
+    for claimed_file in sorted(claimed_folder.glob('*.json')):
+        try:
+            with open(claimed_file, 'r') as f:
+                task = json.load(f)
+            claimed_time = datetime.fromtimestamp(claimed_file.stat().st_mtime)
+        except (OSError, ValueError):
+            continue
+        if not is_stale_task(task, claimed_time, max_hours):
+            continue
+        try:
+            os.rename(claimed_file, pending_folder.joinpath(claimed_file.name))
+        except FileNotFoundError:
+            continue
+        requeued += 1
+    if requeued:
+        announce(f'Returned {requeued} tasks of stopped workers to the queue')
+    return requeued
+
+def iter_claimed_tasks(queue_path):
+    """Keep claiming tasks from a queue folder until none are left"""
+    while True:
+        task = claim_task(queue_path)
+        if task is None:
+            return
+        yield task
+
+def finish_task(task, state):
+    """Record the outcome of a claimed task and move it to done or failed"""
+    claimed_file = pathlib.Path(task.pop('task_file'))
+    task['state'] = state
+    task['finished'] = datetime.now().isoformat(timespec='seconds')
+    with open(claimed_file, 'w') as f:
+        json.dump(task, f)
+    os.rename(claimed_file, get_queue_folder(
+        claimed_file.parent.parent, state).joinpath(claimed_file.name))
+
+def run_task(settings, task):
+    """Carry out a run claimed from a queue folder"""
+    try:
+        task_settings, this_run = get_isolated_batch(
+            settings, task['folder'], task['arguments'])
+        this_run.update({'title': task['title'], '-p': task['-p'],
+                         'archive': get_folder(task['archive'])
+                                    if task['archive'] else None})
+        run_selected(task_settings, this_run)
+    except Exception as error:
+        announce_error(f'Task {task["title"]} failed: {error}')
+        task['error'] = str(error)
+        finish_task(task, 'failed')
+    else:
+        finish_task(task, 'done' if this_run.get('returncode', 0) == 0
+                          else 'failed')
+
+def run_worker(arguments):
+    """Carry out the tasks in a queue folder until none are left"""
+    settings = get_settings(arguments)
+    jobs = get_job_count(arguments['--jobs'])
+    if arguments['--requeue-after']:
+        max_hours = get_positive_integer(arguments['--requeue-after'],
+                                         'number of hours')
+    else:
+        max_hours = None
+    requeue_stale_tasks(arguments['--worker'], max_hours)
+    tasks = iter_claimed_tasks(arguments['--worker'])
+    if jobs > 1:
+        run_parallel(settings, tasks, jobs, run_task)
+    else:
+        for task in tasks:
+            run_scheduled(settings, task, run_task)
+    stop_fork_servers()
+    announce(f'No more pending tasks in {get_folder(arguments["--worker"])}')
 
 
 # What to do when run as a script
 if __name__ == '__main__':
+    from docopt import docopt
     arguments = docopt(__doc__)
-    settings = get_settings(arguments)
-    parameters = get_parameters(settings, arguments)
-    run_batch(settings, parameters)
+    if arguments['--worker']:
+        run_worker(arguments)
+    elif arguments['query']:
+        run_query(arguments)
+    elif arguments['prune']:
+        run_prune(arguments)
+    elif (arguments['daemon'] or arguments['status'] or arguments['cancel']
+            or arguments['wait'] or arguments['--submit']):
+        run_client(arguments)
+    else:
+        settings = get_settings(arguments)
+        parameters = get_parameters(settings, arguments)
+        if parameters['--queue']:
+            queue_batch(settings, parameters, arguments)
+        else:
+            run_batch(settings, parameters)
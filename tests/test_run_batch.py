@@ -6,7 +6,16 @@ import os
 import pathlib
 import shutil
 import subprocess
+import json
+import sys
+import threading
+import time
+import socket
+import zipfile
+import tarfile
+import io
 from datetime import datetime
+from docopt import docopt
 import git
 
 RUN_FOLDER = pathlib.Path.home().joinpath('Simulations/Current')
@@ -37,12 +46,49 @@ class TestRunBatch:
             '--git': False,
             '--archive': False,
             '--full': False,
+            '--cache': False,
+            '--fast-archive': False,
+            '--archive-format': None,
+            '--dedup': False,
             '--clean': False,
             '--class': None,
             '--input_branch': None,
             '--results_branch': None,
             '--sweep': None,
+            '--where': None,
+            '--shard': None,
+            '--adapt': None,
+            '--samples': None,
+            '--sampling': None,
+            '--seed': None,
             '--post': False,
+            '--worktree': False,
+            '--commit-batch': None,
+            '--sandbox': False,
+            '--jobs': None,
+            '--archive-queue': None,
+            '--resume': False,
+            '--progress': False,
+            '--fork-server': False,
+            '--priority': None,
+            '--submit': False,
+            '--socket': None,
+            '--queue': None,
+            '--worker': None,
+            '--requeue-after': None,
+            'daemon': False,
+            'status': False,
+            'cancel': False,
+            'wait': False,
+            '<batch>': None,
+            'query': False,
+            '--since': None,
+            '--until': None,
+            'prune': False,
+            '--keep-full': None,
+            '--compress-after': None,
+            '--cores': None,
+            '--memory': None,
             '--config': False,
             '--logfile': False,
             '--runlog': False,
@@ -62,7 +108,44 @@ class TestRunBatch:
             'archive_move': None,
             'archive_copy': None,
             'commit_files': None,
-            'commit_message': None})
+            'commit_message': None,
+            'commit_batch': None,
+            'ledger': None,
+            'completed_runs': None,
+            'condition': None,
+            'shard': None,
+            'adapt': None,
+            'cost': None,
+            'priority': 0,
+            'cancel': None,
+            'archive_queue': None,
+            'archiver': None,
+            'archive_format': None,
+            'telemetry': None,
+            'stage_times': None,
+            'progress': None})
+
+    def get_fake_settings(self, run_folder, archive_root):
+        """Get settings that run a stand-in for Reproducible."""
+        reproduce = run_folder.parent.joinpath('fake_reproduce')
+        reproduce.write_text(
+            'import sys, pathlib\n'
+            'if sys.argv[1] == "run":\n'
+            '    pathlib.Path("fort.40").write_text(" ".join(sys.argv[1:]))\n'
+            f'    with open("{self.logfile}", "a") as log:\n'
+            '        log.write("Fake run\\n")\n'
+            'else:\n'
+            '    print("Fake log")\n')
+        return {'current_folder': run_folder,
+                'archive_root': archive_root,
+                'python': sys.executable,
+                'reproduce': reproduce,
+                'logfile': self.logfile,
+                'archive_log': self.archive_log}
+
+    def get_fake_parameters(self, test_settings, argv):
+        return run_batch.get_parameters(
+            test_settings, docopt(run_batch.__doc__, argv))
 
     def get_run_folder(self, cloned_repo):
         return pathlib.Path(cloned_repo.working_dir)
@@ -167,6 +250,29 @@ class TestRunBatch:
         results_branch.commit = results_commit
         initial_branch.checkout(force=True)
 
+    @pytest.fixture
+    def tmp_repo(self, tmp_path):
+        """Create a small repo with input and results branches."""
+        repo_path = tmp_path.joinpath('repo')
+        repo = git.Repo.init(repo_path)
+        with repo.config_writer() as config:
+            config.set_value('user', 'name', 'Test user')
+            config.set_value('user', 'email', 'test@example.com')
+        with open(repo_path.joinpath('input.in'), 'w') as f:
+            f.write(self.test_message)
+        repo.index.add(['input.in'])
+        repo.index.commit('Initial commit')
+        repo.create_head(self.input_branch)
+        results_branch = repo.create_head(self.results_branch)
+        repo.head.reference = results_branch
+        with open(repo_path.joinpath(self.logfile), 'w') as f:
+            f.write('Old entry\n')
+        repo.index.add([self.logfile])
+        repo.index.commit('Add log file')
+        repo.heads[self.input_branch].checkout(force=True)
+        yield repo
+        repo.git.worktree('prune')
+
     @pytest.fixture
     def tmp_srcfile(self, cloned_src):
         filename = 'test_file.tmp'
@@ -462,6 +568,20 @@ class TestRunBatch:
         with pytest.raises(git.exc.InvalidGitRepositoryError):
             run_batch.get_git_repo('/')
 
+    def test_get_git_repo_reused(self, tmp_path):
+        git.Repo.init(tmp_path)
+        test_repo = run_batch.get_git_repo(tmp_path)
+        assert run_batch.get_git_repo(str(tmp_path)) is test_repo
+        thread_repos = []
+        thread = threading.Thread(target=lambda: thread_repos.append(
+            run_batch.get_git_repo(tmp_path)))
+        thread.start()
+        thread.join()
+        assert thread_repos[0] is not test_repo
+        run_batch.forget_git_repo(tmp_path)
+        assert run_batch.get_git_repo(tmp_path) is not test_repo
+        run_batch.forget_git_repo(tmp_path)
+
     # Test git_checkout method
     @pytest.mark.gitchanges
     def test_git_checkout_no_output(self, capsys, cloned_repo, protect_git):
@@ -550,6 +670,33 @@ class TestRunBatch:
         with pytest.raises(git.exc.GitCommandError):
             run_batch.git_get_file(cloned_repo, 'master', 'not_a_file.txt')
 
+    # Test git_read_file method
+    def test_git_read_file_result(self, tmp_repo):
+        repo_folder = pathlib.Path(tmp_repo.working_tree_dir)
+        run_batch.git_read_file(tmp_repo, self.results_branch, self.logfile,
+                                repo_folder)
+        assert repo_folder.joinpath(self.logfile).read_text() == 'Old entry\n'
+        assert tmp_repo.active_branch.name == self.input_branch
+        assert not tmp_repo.is_dirty()
+        assert self.logfile not in tmp_repo.git.ls_files()
+
+    def test_git_read_file_missing(self, tmp_repo):
+        repo_folder = pathlib.Path(tmp_repo.working_tree_dir)
+        run_batch.git_read_file(tmp_repo, self.results_branch, 'not_a_file',
+                                repo_folder)
+        assert repo_folder.joinpath('not_a_file').read_bytes() == b''
+
+    def test_git_read_file_invalid_input(self, tmp_repo, tmp_path):
+        with pytest.raises(TypeError):
+            run_batch.git_read_file(tmp_repo, self.results_branch,
+                                    self.logfile)
+        with pytest.raises(TypeError):
+            run_batch.git_read_file('not_a_repo', self.results_branch,
+                                    self.logfile, tmp_path)
+        with pytest.raises(IndexError):
+            run_batch.git_read_file(tmp_repo, 'not a branch', self.logfile,
+                                    tmp_path)
+
     # Test git_commit method
     @pytest.mark.gitchanges
     def test_git_commit_no_output(self, capsys, cloned_repo, protect_git, tmp_file):
@@ -605,6 +752,144 @@ class TestRunBatch:
             run_batch.git_commit(cloned_repo, 'not_a_file.txt', 'Test commit')
 
     # Test get_input_branch method
+    # Test git_append_to_file method
+    def test_git_append_to_file_no_output(self, capsys, tmp_repo):
+        run_batch.git_append_to_file(tmp_repo, self.results_branch,
+                                     self.logfile, b'New entry\n', 'Test')
+        captured = capsys.readouterr()
+        assert len(captured.out) == 0
+
+    def test_git_append_to_file_result(self, tmp_repo):
+        old_commit = tmp_repo.heads[self.results_branch].commit
+        run_batch.git_append_to_file(tmp_repo, self.results_branch,
+                                     self.logfile, b'New entry\n',
+                                     'Test commit')
+        new_commit = tmp_repo.heads[self.results_branch].commit
+        assert new_commit != old_commit
+        assert new_commit.parents == (old_commit,)
+        assert new_commit.message == 'Test commit'
+        assert (new_commit.tree[self.logfile].data_stream.read()
+                == b'Old entry\nNew entry\n')
+        assert 'input.in' in new_commit.tree
+
+    def test_git_append_to_file_new_file(self, tmp_repo):
+        run_batch.git_append_to_file(tmp_repo, self.input_branch,
+                                     self.logfile, b'New entry\n', 'Test')
+        new_commit = tmp_repo.heads[self.input_branch].commit
+        assert (new_commit.tree[self.logfile].data_stream.read()
+                == b'New entry\n')
+
+    def test_git_append_to_file_no_checkout(self, tmp_repo):
+        initial_branch = tmp_repo.active_branch
+        run_batch.git_append_to_file(tmp_repo, self.results_branch,
+                                     self.logfile, b'New entry\n', 'Test')
+        assert tmp_repo.active_branch == initial_branch
+        assert not tmp_repo.is_dirty()
+        assert not pathlib.Path(tmp_repo.working_dir).joinpath(
+            self.logfile).is_file()
+
+    def test_git_append_to_file_invalid_input(self, tmp_repo):
+        with pytest.raises(TypeError):
+            run_batch.git_append_to_file()
+        with pytest.raises(TypeError):
+            run_batch.git_append_to_file(tmp_repo, self.results_branch,
+                                         self.logfile, b'New entry\n')
+        with pytest.raises(TypeError):
+            run_batch.git_append_to_file('not a repo', self.results_branch,
+                                         self.logfile, b'New entry\n', 'Test')
+        with pytest.raises(TypeError):
+            run_batch.git_append_to_file(tmp_repo, self.results_branch,
+                                         self.logfile, 'not bytes', 'Test')
+        with pytest.raises(IndexError):
+            run_batch.git_append_to_file(tmp_repo, 'not a branch',
+                                         self.logfile, b'New entry\n', 'Test')
+
+    # Test create_worktree method
+    def test_create_worktree_result(self, tmp_repo):
+        worktree_folder = run_batch.create_worktree(tmp_repo,
+                                                    self.input_branch)
+        assert isinstance(worktree_folder, pathlib.Path)
+        assert worktree_folder.is_dir()
+        assert worktree_folder.joinpath('input.in').is_file()
+        worktree_repo = git.Repo(worktree_folder)
+        assert (worktree_repo.head.commit
+                == tmp_repo.heads[self.input_branch].commit)
+        assert tmp_repo.active_branch.name == self.input_branch
+
+    def test_create_worktree_same_branch_twice(self, tmp_repo):
+        first = run_batch.create_worktree(tmp_repo, self.input_branch)
+        second = run_batch.create_worktree(tmp_repo, self.input_branch)
+        assert first != second
+        assert first.is_dir()
+        assert second.is_dir()
+
+    def test_create_worktree_invalid_input(self, tmp_repo):
+        with pytest.raises(TypeError):
+            run_batch.create_worktree()
+        with pytest.raises(TypeError):
+            run_batch.create_worktree(tmp_repo)
+        with pytest.raises(TypeError):
+            run_batch.create_worktree('not a repo', self.input_branch)
+        with pytest.raises(ValueError):
+            run_batch.create_worktree(tmp_repo, 'not a branch')
+
+    # Test remove_worktree method
+    def test_remove_worktree_result(self, tmp_repo):
+        worktree_folder = run_batch.create_worktree(tmp_repo,
+                                                    self.input_branch)
+        run_batch.remove_worktree(tmp_repo, worktree_folder)
+        assert not worktree_folder.exists()
+        assert str(worktree_folder) not in tmp_repo.git.worktree('list')
+
+    # Test run_in_worktree method
+    def test_run_in_worktree_archive(self, tmp_repo, tmp_path):
+        repo_folder = pathlib.Path(tmp_repo.working_tree_dir)
+        archive_root = tmp_path.joinpath('archive')
+        archive_root.mkdir()
+        test_settings = self.get_fake_settings(repo_folder, archive_root)
+        test_parameters = self.get_fake_parameters(test_settings, [
+            '--git', f'--input_branch={self.input_branch}',
+            f'--results_branch={self.results_branch}', '--worktree',
+            '--archive', '--', 'ImpactTexe'])
+        test_parameters['title'] = run_batch.get_title(test_parameters)
+        results_commit = tmp_repo.heads[self.results_branch].commit
+        run_batch.run_with_git(test_settings, test_parameters)
+        results_branch = tmp_repo.heads[self.results_branch]
+        assert results_branch.commit.parents == (results_commit,)
+        assert results_branch.commit.message.startswith(
+            'Results for ' + test_parameters['title'])
+        log = results_branch.commit.tree[self.logfile].data_stream.read()
+        assert log == b'Old entry\nFake run\n'
+        assert tmp_repo.active_branch.name == self.input_branch
+        assert not tmp_repo.is_dirty()
+        assert len(tmp_repo.git.worktree('list').splitlines()) == 1
+        assert [path.name for path in tmp_path.iterdir()
+                if 'worktree' in path.name] == []
+
+    def test_run_in_worktree_keep(self, tmp_repo, tmp_path):
+        repo_folder = pathlib.Path(tmp_repo.working_tree_dir)
+        test_settings = self.get_fake_settings(repo_folder, tmp_path)
+        test_parameters = self.get_fake_parameters(test_settings, [
+            '--git', f'--input_branch={self.input_branch}',
+            f'--results_branch={self.results_branch}', '--worktree',
+            '--', 'ImpactTexe'])
+        test_parameters['title'] = run_batch.get_title(test_parameters)
+        run_batch.run_with_git(test_settings, test_parameters)
+        assert len(tmp_repo.git.worktree('list').splitlines()) == 1
+        kept = [path for path in tmp_path.iterdir() if 'worktree' in path.name]
+        assert len(kept) == 1
+        assert kept[0].joinpath('fort.40').is_file()
+        assert not kept[0].joinpath('.git').exists()
+
+    def test_remove_worktree_invalid_input(self, tmp_repo, tmp_path):
+        with pytest.raises(TypeError):
+            run_batch.remove_worktree()
+        with pytest.raises(TypeError):
+            run_batch.remove_worktree('not a repo', tmp_path)
+        with pytest.raises(OSError):
+            run_batch.remove_worktree(tmp_repo,
+                                      tmp_path.joinpath('not_a_folder'))
+
     def test_get_input_branch_no_output(self, cloned_repo, capsys):
         run_batch.get_input_branch(cloned_repo, self.arguments['--input_branch'])
         captured = capsys.readouterr()
@@ -741,6 +1026,94 @@ class TestRunBatch:
             run_batch.get_commit_files('not a dict')
 
 
+    # Test get_commit_batch method
+    def test_get_commit_batch_none(self):
+        test_settings = {'logfile': self.logfile}
+        test_parameters = self.arguments.copy()
+        assert run_batch.get_commit_batch(test_settings, test_parameters) is None
+
+    def test_get_commit_batch_result(self):
+        test_settings = {'logfile': self.logfile}
+        test_parameters = self.arguments.copy()
+        test_parameters.update({'--commit-batch': '5',
+                                '--results_branch': self.results_branch})
+        commit_batch = run_batch.get_commit_batch(test_settings,
+                                                  test_parameters)
+        assert isinstance(commit_batch, dict)
+        assert commit_batch['size'] == 5
+        assert commit_batch['branch'] == self.results_branch
+        assert commit_batch['file'] == self.logfile
+        assert commit_batch['updates'] == []
+        assert commit_batch['messages'] == []
+
+    def test_get_commit_batch_invalid_input(self):
+        test_settings = {'logfile': self.logfile}
+        test_parameters = self.arguments.copy()
+        with pytest.raises(TypeError):
+            run_batch.get_commit_batch()
+        with pytest.raises(TypeError):
+            run_batch.get_commit_batch(test_settings)
+        for invalid_size in ['not a number', '0', '-1']:
+            test_parameters['--commit-batch'] = invalid_size
+            with pytest.raises(ValueError):
+                run_batch.get_commit_batch(test_settings, test_parameters)
+
+    # Test add_to_commit_batch method
+    def test_add_to_commit_batch_waits(self, tmp_repo):
+        old_commit = tmp_repo.heads[self.results_branch].commit
+        commit_batch = {'size': 2, 'branch': self.results_branch,
+                        'file': self.logfile, 'updates': [], 'messages': []}
+        run_batch.add_to_commit_batch(tmp_repo, commit_batch,
+                                      b'First entry\n', 'First run')
+        assert tmp_repo.heads[self.results_branch].commit == old_commit
+        assert commit_batch['updates'] == [b'First entry\n']
+        assert commit_batch['messages'] == ['First run']
+
+    def test_add_to_commit_batch_commits_when_full(self, tmp_repo):
+        old_commit = tmp_repo.heads[self.results_branch].commit
+        commit_batch = {'size': 2, 'branch': self.results_branch,
+                        'file': self.logfile, 'updates': [], 'messages': []}
+        run_batch.add_to_commit_batch(tmp_repo, commit_batch,
+                                      b'First entry\n', 'First run')
+        run_batch.add_to_commit_batch(tmp_repo, commit_batch,
+                                      b'Second entry\n', 'Second run')
+        new_commit = tmp_repo.heads[self.results_branch].commit
+        assert new_commit.parents == (old_commit,)
+        assert (new_commit.tree[self.logfile].data_stream.read()
+                == b'Old entry\nFirst entry\nSecond entry\n')
+        assert 'First run' in new_commit.message
+        assert 'Second run' in new_commit.message
+        assert commit_batch['updates'] == []
+        assert commit_batch['messages'] == []
+
+    # Test commit_batch_results method
+    def test_commit_batch_results_single(self, tmp_repo):
+        commit_batch = {'size': 10, 'branch': self.results_branch,
+                        'file': self.logfile, 'updates': [b'New entry\n'],
+                        'messages': ['Test commit']}
+        run_batch.commit_batch_results(tmp_repo, commit_batch)
+        new_commit = tmp_repo.heads[self.results_branch].commit
+        assert new_commit.message == 'Test commit'
+        assert (new_commit.tree[self.logfile].data_stream.read()
+                == b'Old entry\nNew entry\n')
+
+    def test_commit_batch_results_empty(self, tmp_repo):
+        old_commit = tmp_repo.heads[self.results_branch].commit
+        commit_batch = {'size': 10, 'branch': self.results_branch,
+                        'file': self.logfile, 'updates': [], 'messages': []}
+        run_batch.commit_batch_results(tmp_repo, commit_batch)
+        assert tmp_repo.heads[self.results_branch].commit == old_commit
+
+    def test_commit_batch_results_no_checkout(self, tmp_repo):
+        initial_branch = tmp_repo.active_branch
+        commit_batch = {'size': 10, 'branch': self.results_branch,
+                        'file': self.logfile, 'updates': [b'New entry\n'],
+                        'messages': ['Test commit']}
+        run_batch.commit_batch_results(tmp_repo, commit_batch)
+        assert tmp_repo.active_branch == initial_branch
+        assert not tmp_repo.is_dirty()
+
+
     # Template methods
     # Test get_valid_templates method
     def test_get_valid_templates_no_output(self, capsys, cloned_repo):
@@ -836,6 +1209,15 @@ class TestRunBatch:
         assert result.returncode == 0
         assert test_message in captured.out
 
+    def test_post_process_capture(self, capfd, tmp_path):
+        test_settings = {'current_folder': tmp_path}
+        result = run_batch.post_process(
+            test_settings, 'echo Energy spread 0.25', capture=True)
+        captured = capfd.readouterr()
+        assert result.returncode == 0
+        assert result.stdout == 'Energy spread 0.25\n'
+        assert 'Energy spread 0.25' in captured.out
+
     def test_post_process_invalid_input(self, cloned_repo, tmp_archive):
         test_message = 'Post-processing output'
         test_settings = self.get_settings(cloned_repo, tmp_archive)
@@ -1692,6 +2074,557 @@ class TestRunBatch:
                 assert not self.get_run_folder(cloned_repo).joinpath(filename).is_file()
 
 
+    # Sandbox folder methods
+    # Test create_sandbox_folder method
+    def test_create_sandbox_folder_no_output(self, capsys, tmp_path):
+        sandbox_folder = run_batch.create_sandbox_folder(tmp_path, None)
+        captured = capsys.readouterr()
+        assert len(captured.out) == 0
+        shutil.rmtree(sandbox_folder)
+
+    def test_create_sandbox_folder_result(self, tmp_path):
+        test_files = ['file1.in', 'file2.data', self.logfile]
+        for filename in test_files:
+            with open(tmp_path.joinpath(filename), 'w') as f:
+                f.write(self.test_message)
+        sandbox_folder = run_batch.create_sandbox_folder(tmp_path, None)
+        assert isinstance(sandbox_folder, pathlib.Path)
+        assert sandbox_folder.is_absolute()
+        assert sandbox_folder != tmp_path
+        for filename in test_files:
+            assert tmp_path.joinpath(filename).is_file()
+            assert sandbox_folder.joinpath(filename).is_file()
+            with open(sandbox_folder.joinpath(filename), 'r') as f:
+                assert f.readline() == self.test_message
+        shutil.rmtree(sandbox_folder)
+
+    def test_create_sandbox_folder_skips_git(self, tmp_path):
+        git.Repo.init(tmp_path)
+        sandbox_folder = run_batch.create_sandbox_folder(tmp_path, None)
+        assert not sandbox_folder.joinpath('.git').exists()
+        assert not sandbox_folder.joinpath('.git').is_symlink()
+        shutil.rmtree(sandbox_folder)
+
+    def test_create_sandbox_folder_shares_inputs(self, tmp_path):
+        test_files = ['ImpactT.in', 'beam.data']
+        for filename in test_files:
+            with open(tmp_path.joinpath(filename), 'w') as f:
+                f.write(self.test_message)
+        sandbox_folder = run_batch.create_sandbox_folder(tmp_path, 'impact')
+        for filename in test_files:
+            original = tmp_path.joinpath(filename).stat()
+            shared = sandbox_folder.joinpath(filename).stat()
+            assert (original.st_ino == shared.st_ino
+                    or original.st_size == shared.st_size)
+        shutil.rmtree(sandbox_folder)
+        for filename in test_files:
+            assert tmp_path.joinpath(filename).is_file()
+
+    def test_create_sandbox_folder_copies_logfile(self, tmp_path):
+        with open(tmp_path.joinpath(self.logfile), 'w') as f:
+            f.write(self.test_message)
+        sandbox_folder = run_batch.create_sandbox_folder(tmp_path, 'impact')
+        with open(sandbox_folder.joinpath(self.logfile), 'a') as f:
+            f.write('New entry')
+        with open(tmp_path.joinpath(self.logfile), 'r') as f:
+            assert f.read() == self.test_message
+        shutil.rmtree(sandbox_folder)
+
+    def test_create_sandbox_folder_skips_outputs(self, tmp_path):
+        test_files = ['fort.18', 'output.dst', 'template.in.rendered']
+        for filename in test_files:
+            with open(tmp_path.joinpath(filename), 'w') as f:
+                f.write(self.test_message)
+        sandbox_folder = run_batch.create_sandbox_folder(tmp_path, 'impact')
+        for filename in test_files:
+            assert tmp_path.joinpath(filename).is_file()
+            assert not sandbox_folder.joinpath(filename).exists()
+        shutil.rmtree(sandbox_folder)
+
+    def test_create_sandbox_folder_skips_records(self, tmp_path):
+        for filename in [run_batch.LEDGER, run_batch.TELEMETRY]:
+            tmp_path.joinpath(filename).write_text(self.test_message)
+        sandbox_folder = run_batch.create_sandbox_folder(tmp_path, None)
+        assert not sandbox_folder.joinpath(run_batch.LEDGER).exists()
+        assert not sandbox_folder.joinpath(run_batch.TELEMETRY).exists()
+        shutil.rmtree(sandbox_folder)
+
+    def test_create_sandbox_folder_skips_output_folders(self, tmp_path):
+        tmp_path.joinpath('data').mkdir()
+        sandbox_folder = run_batch.create_sandbox_folder(tmp_path, 'opal')
+        assert not sandbox_folder.joinpath('data').exists()
+        assert not sandbox_folder.joinpath('data').is_symlink()
+        shutil.rmtree(sandbox_folder)
+
+    def test_create_sandbox_folder_copies_templates(self, tmp_path):
+        with open(tmp_path.joinpath('ImpactT.in'), 'w') as f:
+            f.write(self.test_message)
+        sandbox_folder = run_batch.create_sandbox_folder(
+            tmp_path, 'impact', templates='ImpactT.in')
+        assert (sandbox_folder.joinpath('ImpactT.in').stat().st_ino
+                != tmp_path.joinpath('ImpactT.in').stat().st_ino)
+        with open(sandbox_folder.joinpath('ImpactT.in'), 'a') as f:
+            f.write('New line')
+        with open(tmp_path.joinpath('ImpactT.in'), 'r') as f:
+            assert f.read() == self.test_message
+        shutil.rmtree(sandbox_folder)
+
+    def test_create_sandbox_folder_same_parent(self, tmp_path):
+        run_folder = tmp_path.joinpath('run')
+        run_folder.mkdir()
+        sandbox_folder = run_batch.create_sandbox_folder(run_folder, None)
+        assert sandbox_folder.parent == run_folder.parent
+        shutil.rmtree(sandbox_folder)
+
+    def test_create_sandbox_folder_invalid_input(self, tmp_path):
+        with pytest.raises(TypeError):
+            run_batch.create_sandbox_folder()
+        with pytest.raises(TypeError):
+            run_batch.create_sandbox_folder(tmp_path)
+        with pytest.raises(TypeError):
+            run_batch.create_sandbox_folder(tmp_path, None, 'extra parameter')
+        with pytest.raises(AttributeError):
+            run_batch.create_sandbox_folder('not a path', None)
+        with pytest.raises(OSError):
+            run_batch.create_sandbox_folder(
+                tmp_path.joinpath('not_a_folder'), None)
+
+    # Test run_in_sandbox method
+    def test_run_in_sandbox_result(self, monkeypatch, tmp_path):
+        run_folder = tmp_path.joinpath('run')
+        run_folder.mkdir()
+        for filename in ['ImpactT.in', 'beam.data']:
+            run_folder.joinpath(filename).write_text(self.test_message)
+        run_folder.joinpath(self.logfile).write_text('')
+        archive_root = tmp_path.joinpath('archive')
+        archive_root.mkdir()
+        test_settings = self.get_fake_settings(run_folder, archive_root)
+        test_parameters = self.get_fake_parameters(test_settings, [
+            '--archive', '--sandbox', '--class=impact', '--', 'ImpactTexe'])
+        test_parameters['title'] = run_batch.get_title(test_parameters)
+        sandboxes = []
+        run_single = run_batch.run_single
+        def check_sandbox(settings, this_run):
+            sandbox_folder = settings['current_folder']
+            sandboxes.append(sandbox_folder)
+            assert sandbox_folder != run_folder
+            for filename in ['ImpactT.in', 'beam.data']:
+                original = run_folder.joinpath(filename).stat()
+                shared = sandbox_folder.joinpath(filename).stat()
+                assert (original.st_ino == shared.st_ino
+                        or original.st_size == shared.st_size)
+            run_single(settings, this_run)
+            assert sandbox_folder.joinpath('fort.40').is_file()
+        monkeypatch.setattr(run_batch, 'run_single', check_sandbox)
+        run_batch.run_in_sandbox(test_settings, test_parameters)
+        assert len(sandboxes) == 1
+        assert not sandboxes[0].exists()
+        for filename in ['ImpactT.in', 'beam.data']:
+            assert run_folder.joinpath(filename).read_text() == (
+                self.test_message)
+        assert not run_folder.joinpath('fort.40').exists()
+        assert test_parameters['archive'].joinpath('ImpactT.in').is_file()
+
+    # Test remove_sandbox_folder method
+    def test_remove_sandbox_folder_result(self, tmp_path):
+        sandbox_folder = run_batch.create_sandbox_folder(tmp_path, None)
+        run_batch.remove_sandbox_folder(sandbox_folder)
+        assert not sandbox_folder.exists()
+        assert tmp_path.is_dir()
+
+    def test_remove_sandbox_folder_invalid_input(self, tmp_path):
+        with pytest.raises(TypeError):
+            run_batch.remove_sandbox_folder()
+        with pytest.raises(AttributeError):
+            run_batch.remove_sandbox_folder('not a path')
+        with pytest.raises(OSError):
+            run_batch.remove_sandbox_folder(tmp_path.joinpath('not_a_folder'))
+
+    # Test share_file method
+    def test_share_file_result(self, tmp_path_factory):
+        source = tmp_path_factory.mktemp('from').joinpath('test_file.tmp')
+        destination = tmp_path_factory.mktemp('to').joinpath('test_file.tmp')
+        with open(source, 'w') as f:
+            f.write(self.test_message)
+        run_batch.share_file(source, destination)
+        assert source.is_file()
+        with open(destination, 'r') as f:
+            assert f.readline() == self.test_message
+
+    def test_share_file_invalid_input(self, tmp_path):
+        with pytest.raises(TypeError):
+            run_batch.share_file()
+        with pytest.raises(TypeError):
+            run_batch.share_file(tmp_path)
+        with pytest.raises(OSError):
+            run_batch.share_file(tmp_path.joinpath('not_a_file'),
+                                 tmp_path.joinpath('new_file'))
+
+    # Test copy_file method
+    def test_copy_file_result(self, tmp_path_factory):
+        source = tmp_path_factory.mktemp('from').joinpath('test_file.tmp')
+        destination = tmp_path_factory.mktemp('to').joinpath('test_file.tmp')
+        with open(source, 'w') as f:
+            f.write(self.test_message)
+        run_batch.copy_file(source, destination)
+        assert source.stat().st_ino != destination.stat().st_ino
+        with open(destination, 'r') as f:
+            assert f.readline() == self.test_message
+
+    # Test matches_any method
+    def test_matches_any_result(self):
+        assert run_batch.matches_any('fort.18', ['*.dst', 'fort.*'])
+        assert run_batch.matches_any('beam.data', ['*.data'])
+        assert not run_batch.matches_any('beam.data', ['*.in', 'fort.*'])
+        assert not run_batch.matches_any('beam.data', [])
+
+    # Test get_file_size method
+    def test_get_file_size_result(self, tmp_path):
+        test_file = tmp_path.joinpath('test_file.tmp')
+        with open(test_file, 'w') as f:
+            f.write(self.test_message)
+        assert run_batch.get_file_size(test_file) == len(self.test_message)
+
+    def test_get_file_size_missing_file(self, tmp_path):
+        test_file = tmp_path.joinpath('not_a_file.tmp')
+        assert run_batch.get_file_size(test_file) == 0
+
+    def test_get_file_size_invalid_input(self):
+        with pytest.raises(TypeError):
+            run_batch.get_file_size()
+        with pytest.raises(AttributeError):
+            run_batch.get_file_size('not a path')
+
+    # Test get_log_update method
+    def test_get_log_update_result(self, tmp_path):
+        logfile = tmp_path.joinpath(self.logfile)
+        with open(logfile, 'w') as f:
+            f.write('Old entry\n')
+        offset = run_batch.get_file_size(logfile)
+        with open(logfile, 'a') as f:
+            f.write('New entry\n')
+        assert run_batch.get_log_update(logfile, offset) == b'New entry\n'
+        assert run_batch.get_log_update(logfile, 0) == (
+            b'Old entry\nNew entry\n')
+
+    def test_get_log_update_missing_file(self, tmp_path):
+        logfile = tmp_path.joinpath(self.logfile)
+        assert run_batch.get_log_update(logfile, 0) == b''
+
+    # Test merge_log method
+    def test_merge_log_no_output(self, capsys, tmp_path_factory):
+        source = tmp_path_factory.mktemp('from').joinpath(self.logfile)
+        destination = tmp_path_factory.mktemp('to').joinpath(self.logfile)
+        run_batch.merge_log(source, destination, 0)
+        captured = capsys.readouterr()
+        assert len(captured.out) == 0
+
+    def test_merge_log_result(self, tmp_path_factory):
+        source = tmp_path_factory.mktemp('from').joinpath(self.logfile)
+        destination = tmp_path_factory.mktemp('to').joinpath(self.logfile)
+        for log in source, destination:
+            with open(log, 'w') as f:
+                f.write('Old entry\n')
+        offset = run_batch.get_file_size(source)
+        with open(source, 'a') as f:
+            f.write('New entry\n')
+        run_batch.merge_log(source, destination, offset)
+        with open(destination, 'r') as f:
+            assert f.readlines() == ['Old entry\n', 'New entry\n']
+
+    def test_merge_log_missing_source(self, tmp_path_factory):
+        source = tmp_path_factory.mktemp('from').joinpath(self.logfile)
+        destination = tmp_path_factory.mktemp('to').joinpath(self.logfile)
+        run_batch.merge_log(source, destination, 0)
+        assert not destination.is_file()
+
+    def test_merge_log_invalid_input(self, tmp_path):
+        with pytest.raises(TypeError):
+            run_batch.merge_log()
+        with pytest.raises(TypeError):
+            run_batch.merge_log(tmp_path, tmp_path)
+        with pytest.raises(AttributeError):
+            run_batch.merge_log('not a path', tmp_path, 0)
+
+
+    # Ledger methods
+    # Test get_run_hash method
+    def test_get_run_hash_result(self):
+        run_hash = run_batch.get_run_hash(self.single_run)
+        assert isinstance(run_hash, str)
+        assert len(run_hash) == 40
+        assert run_hash == run_batch.get_run_hash(self.single_run.copy())
+
+    def test_get_run_hash_ignores_title_and_archive(self, tmp_path):
+        test_run = self.single_run.copy()
+        test_run.update({'title': 'Different title', 'archive': tmp_path})
+        assert (run_batch.get_run_hash(test_run)
+                == run_batch.get_run_hash(self.single_run))
+
+    def test_get_run_hash_depends_on_inputs(self):
+        hashes = set()
+        for key, value in [('-p', 'I:0.2'), ('-p', 'I:0.4'),
+                           ('<command>', 'ImpactTexe'),
+                           ('--input_branch', self.input_branch)]:
+            test_run = self.single_run.copy()
+            test_run[key] = value
+            hashes.add(run_batch.get_run_hash(test_run))
+        assert len(hashes) == 4
+        assert run_batch.get_run_hash(self.single_run) not in hashes
+
+    def test_get_run_hash_invalid_input(self):
+        with pytest.raises(TypeError):
+            run_batch.get_run_hash()
+        with pytest.raises(KeyError):
+            run_batch.get_run_hash({'-p': 'I:0.2'})
+
+    # Test record_run method
+    def test_record_run_no_output(self, capsys, tmp_path):
+        test_run = self.single_run.copy()
+        test_run['ledger'] = tmp_path.joinpath(run_batch.LEDGER)
+        run_batch.record_run(test_run, 'started')
+        captured = capsys.readouterr()
+        assert len(captured.out) == 0
+
+    def test_record_run_result(self, tmp_path):
+        test_run = self.single_run.copy()
+        test_run.update({'ledger': tmp_path.joinpath(run_batch.LEDGER),
+                         'archive': tmp_path.joinpath('archive'),
+                         '-p': 'I:0.2'})
+        run_batch.record_run(test_run, 'started')
+        run_batch.record_run(test_run, 'completed')
+        with open(test_run['ledger'], 'r') as f:
+            records = [json.loads(line) for line in f]
+        assert [record['status'] for record in records] == [
+            'started', 'completed']
+        for record in records:
+            assert record['hash'] == run_batch.get_run_hash(test_run)
+            assert record['title'] == test_run['title']
+            assert record['parameters'] == 'I:0.2'
+            assert record['archive'] == str(test_run['archive'])
+
+    def test_record_run_started_hash(self, tmp_path):
+        test_run = self.single_run.copy()
+        test_run.update({'ledger': tmp_path.joinpath(run_batch.LEDGER),
+                         '--template': 'ImpactT.in,missing.in'})
+        test_run['run_hash'] = run_batch.get_run_hash(test_run)
+        run_batch.record_run(test_run, 'started')
+        test_run['--template'] = 'ImpactT.in'
+        run_batch.record_run(test_run, 'completed')
+        assert run_batch.get_completed_runs(test_run['ledger']) == {
+            test_run['run_hash']}
+        test_run['--template'] = 'ImpactT.in,missing.in'
+        test_run['completed_runs'] = {test_run.pop('run_hash')}
+        assert run_batch.is_completed_run(test_run)
+
+    def test_record_run_no_ledger(self, tmp_path):
+        run_batch.record_run(self.single_run, 'started')
+        assert not tmp_path.joinpath(run_batch.LEDGER).exists()
+
+    def test_record_run_usage(self, tmp_path):
+        test_run = self.single_run.copy()
+        test_run.update({'ledger': tmp_path.joinpath(run_batch.LEDGER),
+                         'usage': {'run': {'max_rss': 1024}}})
+        run_batch.record_run(test_run, 'started')
+        run_batch.record_run(test_run, 'completed')
+        with open(test_run['ledger'], 'r') as f:
+            records = [json.loads(line) for line in f]
+        assert 'usage' not in records[0]
+        assert records[1]['usage'] == {'run': {'max_rss': 1024}}
+
+    # Test get_completed_runs method
+    def test_get_completed_runs_result(self, tmp_path):
+        ledger = tmp_path.joinpath(run_batch.LEDGER)
+        runs = []
+        for value in ['0.0', '0.2', '0.4', '0.6']:
+            test_run = self.single_run.copy()
+            test_run.update({'ledger': ledger, '-p': f'I:{value}'})
+            runs.append(test_run)
+        run_batch.record_run(runs[0], 'started')
+        run_batch.record_run(runs[0], 'completed')
+        run_batch.record_run(runs[1], 'started')
+        run_batch.record_run(runs[1], 'failed')
+        run_batch.record_run(runs[2], 'started')
+        run_batch.record_run(runs[3], 'completed')
+        run_batch.record_run(runs[3], 'started')
+        completed = run_batch.get_completed_runs(ledger)
+        assert completed == {run_batch.get_run_hash(runs[0])}
+
+    def test_get_completed_runs_missing_ledger(self, tmp_path):
+        ledger = tmp_path.joinpath(run_batch.LEDGER)
+        assert run_batch.get_completed_runs(ledger) == set()
+
+    def test_get_completed_runs_broken_line(self, tmp_path):
+        ledger = tmp_path.joinpath(run_batch.LEDGER)
+        test_run = self.single_run.copy()
+        test_run['ledger'] = ledger
+        run_batch.record_run(test_run, 'completed')
+        with open(ledger, 'a') as f:
+            f.write('{"hash": "unfinished')
+        assert run_batch.get_completed_runs(ledger) == {
+            run_batch.get_run_hash(test_run)}
+
+    def test_get_completed_runs_invalid_input(self):
+        with pytest.raises(TypeError):
+            run_batch.get_completed_runs()
+        with pytest.raises(AttributeError):
+            run_batch.get_completed_runs('not a path')
+
+    # Test is_completed_run method
+    def test_is_completed_run_result(self, capsys):
+        test_run = self.single_run.copy()
+        test_run['completed_runs'] = {run_batch.get_run_hash(test_run)}
+        assert run_batch.is_completed_run(test_run)
+        captured = capsys.readouterr()
+        assert 'Skipping completed run' in captured.out
+        assert test_run['title'] in captured.out
+
+    def test_is_completed_run_not_completed(self, capsys):
+        test_run = self.single_run.copy()
+        test_run['completed_runs'] = {'not a matching hash'}
+        assert not run_batch.is_completed_run(test_run)
+        assert not run_batch.is_completed_run(self.single_run)
+        captured = capsys.readouterr()
+        assert len(captured.out) == 0
+
+
+    # Result cache methods
+    # Test get_file_hash method
+    def test_get_file_hash_result(self, tmp_path):
+        test_files = ['file1.tmp', 'file2.tmp', 'file3.tmp']
+        for filename, text in zip(test_files, ['a', 'a', 'b']):
+            with open(tmp_path.joinpath(filename), 'w') as f:
+                f.write(text)
+        hashes = [run_batch.get_file_hash(tmp_path.joinpath(filename))
+                  for filename in test_files]
+        assert all([isinstance(file_hash, str) for file_hash in hashes])
+        assert hashes[0] == hashes[1]
+        assert hashes[0] != hashes[2]
+
+    def test_get_file_hash_invalid_input(self, tmp_path):
+        with pytest.raises(TypeError):
+            run_batch.get_file_hash()
+        with pytest.raises(OSError):
+            run_batch.get_file_hash(tmp_path.joinpath('not_a_file'))
+
+    # Test get_cache_hash method
+    def test_get_cache_hash_result(self, tmp_path):
+        test_settings = {'current_folder': tmp_path}
+        test_run = self.single_run.copy()
+        test_run['--class'] = 'impact'
+        with open(tmp_path.joinpath('ImpactT.in'), 'w') as f:
+            f.write(self.test_message)
+        first_hash = run_batch.get_cache_hash(test_settings, test_run)
+        assert first_hash == run_batch.get_cache_hash(test_settings, test_run)
+        with open(tmp_path.joinpath('ImpactT.in'), 'a') as f:
+            f.write(self.test_message)
+        assert first_hash != run_batch.get_cache_hash(test_settings, test_run)
+
+    def test_get_cache_hash_parameters(self, tmp_path):
+        test_settings = {'current_folder': tmp_path}
+        first_run = self.single_run.copy()
+        first_run['-p'] = 'I:0.2'
+        second_run = self.single_run.copy()
+        second_run['-p'] = 'I:0.4'
+        assert (run_batch.get_cache_hash(test_settings, first_run)
+                != run_batch.get_cache_hash(test_settings, second_run))
+
+    def test_get_cache_hash_options(self, tmp_path):
+        test_settings = {'current_folder': tmp_path}
+        hashes = {run_batch.get_cache_hash(test_settings, self.single_run)}
+        for option, value in [('--full', True), ('--src', '/tmp/src'),
+                              ('--build', True), ('--hash', 'abc1234'),
+                              ('--config', True), ('--dedup', True),
+                              ('--archive-format', 'zip')]:
+            test_run = self.single_run.copy()
+            test_run[option] = value
+            hashes.add(run_batch.get_cache_hash(test_settings, test_run))
+        assert len(hashes) == 8
+
+    def test_get_cache_hash_ignores_outputs(self, tmp_path):
+        test_settings = {'current_folder': tmp_path}
+        test_run = self.single_run.copy()
+        test_run['--class'] = 'impact'
+        first_hash = run_batch.get_cache_hash(test_settings, test_run)
+        for filename in ['fort.18', 'output.dst', self.logfile]:
+            with open(tmp_path.joinpath(filename), 'w') as f:
+                f.write(self.test_message)
+        assert first_hash == run_batch.get_cache_hash(test_settings, test_run)
+
+    # Test add_to_cache and find_cached_results methods
+    def test_find_cached_results_result(self, tmp_path):
+        archive_folder = tmp_path.joinpath('archive')
+        archive_folder.mkdir()
+        run_batch.add_to_cache(tmp_path, 'test hash', archive_folder)
+        assert tmp_path.joinpath(run_batch.CACHE_INDEX).is_file()
+        assert (run_batch.find_cached_results(tmp_path, 'test hash')
+                == archive_folder)
+
+    def test_find_cached_results_no_match(self, tmp_path):
+        archive_folder = tmp_path.joinpath('archive')
+        archive_folder.mkdir()
+        assert run_batch.find_cached_results(tmp_path, 'test hash') is None
+        run_batch.add_to_cache(tmp_path, 'test hash', archive_folder)
+        assert run_batch.find_cached_results(tmp_path, 'other hash') is None
+
+    def test_find_cached_results_missing_folder(self, tmp_path):
+        archive_folder = tmp_path.joinpath('archive')
+        run_batch.add_to_cache(tmp_path, 'test hash', archive_folder)
+        assert run_batch.find_cached_results(tmp_path, 'test hash') is None
+
+    def test_find_cached_results_overwritten_folder(self, tmp_path):
+        archive_folder = tmp_path.joinpath('archive')
+        archive_folder.mkdir()
+        run_batch.add_to_cache(tmp_path, 'first hash', archive_folder)
+        run_batch.add_to_cache(tmp_path, 'second hash', archive_folder)
+        assert run_batch.find_cached_results(tmp_path, 'first hash') is None
+        assert (run_batch.find_cached_results(tmp_path, 'second hash')
+                == archive_folder)
+
+    # Test link_cached_results method
+    def test_link_cached_results_result(self, tmp_path_factory):
+        cached_folder = tmp_path_factory.mktemp('cached')
+        archive_folder = tmp_path_factory.mktemp('new').joinpath('archive')
+        test_files = ['file1.tmp', 'file2.tmp', self.archive_log]
+        for filename in test_files:
+            with open(cached_folder.joinpath(filename), 'w') as f:
+                f.write(self.test_message)
+        run_batch.link_cached_results(cached_folder, archive_folder)
+        for filename in test_files:
+            assert cached_folder.joinpath(filename).is_file()
+            with open(archive_folder.joinpath(filename), 'r') as f:
+                assert f.readline() == self.test_message
+
+    def test_link_cached_results_subfolders(self, tmp_path_factory):
+        cached_folder = tmp_path_factory.mktemp('cached')
+        archive_folder = tmp_path_factory.mktemp('new').joinpath('archive')
+        cached_folder.joinpath('data', 'probes').mkdir(parents=True)
+        test_files = ['file1.tmp', 'data/file2.tmp', 'data/probes/file3.tmp']
+        for filename in test_files:
+            with open(cached_folder.joinpath(filename), 'w') as f:
+                f.write(self.test_message)
+        run_batch.link_cached_results(cached_folder, archive_folder)
+        for filename in test_files:
+            assert cached_folder.joinpath(filename).is_file()
+            with open(archive_folder.joinpath(filename), 'r') as f:
+                assert f.readline() == self.test_message
+
+    def test_link_cached_results_same_folder(self, tmp_path):
+        with open(tmp_path.joinpath('file1.tmp'), 'w') as f:
+            f.write(self.test_message)
+        run_batch.link_cached_results(tmp_path, tmp_path)
+        assert [item.name for item in tmp_path.iterdir()] == ['file1.tmp']
+
+    def test_link_cached_results_invalid_input(self, tmp_path):
+        with pytest.raises(TypeError):
+            run_batch.link_cached_results()
+        with pytest.raises(TypeError):
+            run_batch.link_cached_results(tmp_path)
+        with pytest.raises(OSError):
+            run_batch.link_cached_results(tmp_path.joinpath('not_a_folder'),
+                                          tmp_path)
+
+
     # Sweep methods
     # Test get_sweep_parameters method
     def test_get_sweep_parameters_no_output(self, capsys):
@@ -1953,6 +2886,197 @@ class TestRunBatch:
         with pytest.raises(ValueError):
             run_batch.get_sweep_combinations(['not', 'a', 'sweep', 'list'])
 
+    # Test get_sweep_assignments method
+    def test_get_sweep_assignments_single(self):
+        assignments = run_batch.get_sweep_assignments('I:0.0,0.2')
+        assert assignments == [(('I', '0.0'),), (('I', '0.2'),)]
+
+    def test_get_sweep_assignments_multiple(self):
+        assignments = run_batch.get_sweep_assignments('(a,b):(1,10),(2,20)')
+        assert assignments == [(('a', '1'), ('b', '10')),
+                               (('a', '2'), ('b', '20'))]
+
+    def test_get_sweep_assignments_invalid_input(self):
+        with pytest.raises(TypeError):
+            run_batch.get_sweep_assignments()
+        with pytest.raises(ValueError):
+            run_batch.get_sweep_assignments('not a sweep definition')
+
+    # Test iter_sweep_combinations method
+    def test_iter_sweep_combinations_is_lazy(self):
+        test_sweeps = ['a:' + ','.join([str(v) for v in range(1000)])] * 4
+        combinations = run_batch.iter_sweep_combinations(test_sweeps)
+        assert not isinstance(combinations, list)
+        assert next(combinations) == 'a:0,a:0,a:0,a:0'
+
+    def test_iter_sweep_combinations_same_order(self):
+        test_sweeps = ['(a,b):(1,10),(2,20)', 'c:100,200', 'd:x,y']
+        assert (list(run_batch.iter_sweep_combinations(test_sweeps))
+                == run_batch.get_sweep_combinations(test_sweeps))
+
+    def test_iter_sweep_combinations_condition(self):
+        test_sweeps = ['I:0.0,0.2,0.4,0.6', 'E:1.0,1.5']
+        condition = run_batch.parse_condition('I<0.3 or E>1.2')
+        combinations = list(
+            run_batch.iter_sweep_combinations(test_sweeps, condition))
+        assert combinations == ['I:0.0,E:1.0', 'I:0.0,E:1.5',
+                                'I:0.2,E:1.0', 'I:0.2,E:1.5',
+                                'I:0.4,E:1.5', 'I:0.6,E:1.5']
+
+    def test_iter_sweep_combinations_prunes_early(self):
+        test_sweeps = (['I:' + ','.join([str(v) for v in range(1000)])]
+                       + ['E:' + ','.join([str(v) for v in range(100)])] * 3)
+        condition = run_batch.parse_condition('I>998 and E<1')
+        combinations = list(
+            run_batch.iter_sweep_combinations(test_sweeps, condition))
+        assert combinations == ['I:999,E:0,E:0,E:0']
+
+    def test_iter_sweep_combinations_known_values(self):
+        test_sweeps = ['I:0.0,0.2,0.4']
+        condition = run_batch.parse_condition('I*a < 1.0')
+        combinations = list(run_batch.iter_sweep_combinations(
+            test_sweeps, condition, {'a': 4.0}))
+        assert combinations == ['I:0.0', 'I:0.2']
+
+    def test_iter_sweep_combinations_unknown_parameter(self):
+        condition = run_batch.parse_condition('x < 1.0')
+        with pytest.raises(ValueError):
+            list(run_batch.iter_sweep_combinations(['I:0.0,0.2'], condition))
+
+    # Test get_number method
+    def test_get_number_result(self):
+        assert run_batch.get_number('0.5') == 0.5
+        assert run_batch.get_number('2') == 2.0
+        assert run_batch.get_number('1e-3') == 0.001
+        assert run_batch.get_number('text') == 'text'
+
+    # Test get_parameter_values method
+    def test_get_parameter_values_result(self):
+        assert run_batch.get_parameter_values('a:1,b:x') == {'a': 1.0,
+                                                             'b': 'x'}
+        assert run_batch.get_parameter_values(False) == {}
+        assert run_batch.get_parameter_values(None) == {}
+
+    def test_get_parameter_values_invalid_input(self):
+        with pytest.raises(TypeError):
+            run_batch.get_parameter_values()
+        with pytest.raises(ValueError):
+            run_batch.get_parameter_values('not a parameter')
+
+    # Test parse_condition method
+    def test_parse_condition_result(self):
+        condition = run_batch.parse_condition('I<0.5 or E>1.0')
+        assert run_batch.evaluate_condition(condition, {'I': 0.2, 'E': 0.5})
+        assert run_batch.evaluate_condition(condition, {'I': 0.7, 'E': 1.5})
+        assert not run_batch.evaluate_condition(condition,
+                                                {'I': 0.7, 'E': 0.5})
+
+    def test_parse_condition_invalid_input(self):
+        with pytest.raises(TypeError):
+            run_batch.parse_condition()
+        for expression in ['I <', '__import__("os").system("ls")',
+                           'I.real > 0', '[I for I in E]', 'I < 1; E']:
+            with pytest.raises(ValueError):
+                run_batch.parse_condition(expression)
+
+    # Test evaluate_condition method
+    def test_evaluate_condition_arithmetic(self):
+        condition = run_batch.parse_condition('-I + 2*E**2 % 7 >= 1/2')
+        assert run_batch.evaluate_condition(condition, {'I': 1, 'E': 1})
+        assert not run_batch.evaluate_condition(condition, {'I': 2, 'E': 1})
+
+    def test_evaluate_condition_chained(self):
+        condition = run_batch.parse_condition('0.1 < I <= 0.4')
+        assert run_batch.evaluate_condition(condition, {'I': 0.4})
+        assert not run_batch.evaluate_condition(condition, {'I': 0.1})
+
+    def test_evaluate_condition_partial(self):
+        condition = run_batch.parse_condition('I < 0.5 and E > 1.0')
+        assert run_batch.evaluate_condition(condition, {'I': 0.2}) is None
+        assert run_batch.evaluate_condition(condition, {'I': 0.7}) is False
+        condition = run_batch.parse_condition('I < 0.5 or E > 1.0')
+        assert run_batch.evaluate_condition(condition, {'I': 0.2}) is True
+        assert run_batch.evaluate_condition(condition, {'I': 0.7}) is None
+        condition = run_batch.parse_condition('not E > 1.0')
+        assert run_batch.evaluate_condition(condition, {}) is None
+
+    def test_evaluate_condition_lazy(self):
+        condition = run_batch.parse_condition('I > 0 and 1/I > 2')
+        assert run_batch.evaluate_condition(condition, {'I': 0}) is False
+        condition = run_batch.parse_condition('I == 0 or 1/I > 2')
+        assert run_batch.evaluate_condition(condition, {'I': 0}) is True
+        condition = run_batch.parse_condition('I > 1 and X > 1')
+        assert run_batch.evaluate_condition(condition, {'I': 0}) is False
+
+    def test_evaluate_condition_invalid_values(self):
+        condition = run_batch.parse_condition('I < 0.5')
+        with pytest.raises(ValueError, match='I < 0.5'):
+            run_batch.evaluate_condition(condition, {'I': 'high'})
+        condition = run_batch.parse_condition('1/I > 2')
+        with pytest.raises(ValueError, match='1 / I'):
+            run_batch.evaluate_condition(condition, {'I': 0})
+
+    # Test usage string
+    def test_usage_result(self):
+        for argv, option, value in [
+                (['--jobs=2', '--', 'echo'], '--jobs', '2'),
+                (['--worker=/tmp/queue', '--jobs=2'], '--jobs', '2'),
+                (['--queue=/tmp/queue', '--', 'echo'], '--queue', '/tmp/queue'),
+                (['--archive', '--archive-queue=2', '--', 'echo'],
+                 '--archive-queue', '2'),
+                (['cancel', '3'], '<batch>', '3')]:
+            assert docopt(run_batch.__doc__, argv)[option] == value
+
+    # Test the time taken to import run_batch
+    def test_import_time(self):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import run_batch'],
+            cwd=pathlib.Path(run_batch.__file__).parent, capture_output=True,
+            text=True)
+        assert result.returncode == 0
+        imported = []
+        for line in result.stderr.splitlines():
+            _, _, name = line.split('|')
+            if name == ' run_batch':
+                break
+            if name.startswith('   '):
+                imported.append(name.strip())
+            else:
+                imported = []
+        else:
+            pytest.fail('run_batch not found in import times')
+        for module in ['git', 'gitdb', 'docopt', 'sqlite3', 'socket',
+                       'zipfile', 'tarfile', 'concurrent.futures']:
+            assert module not in imported
+
+    # Test get_shard method
+    def test_get_shard_result(self):
+        assert run_batch.get_shard('1/4') == (1, 4)
+        assert run_batch.get_shard(' 4 / 4 ') == (4, 4)
+
+    def test_get_shard_invalid_input(self):
+        with pytest.raises(TypeError):
+            run_batch.get_shard()
+        for shard in ['0/4', '5/4', '1/0', '1', 'a/b', '-1/4']:
+            with pytest.raises(ValueError):
+                run_batch.get_shard(shard)
+
+    # Test select_shard method
+    def test_select_shard_result(self):
+        combinations = [str(i) for i in range(10)]
+        shards = [list(run_batch.select_shard(iter(combinations), i, 3))
+                  for i in [1, 2, 3]]
+        assert shards == [['0', '3', '6', '9'], ['1', '4', '7'],
+                          ['2', '5', '8']]
+
+    def test_get_sweep_runs_condition_and_shard(self):
+        test_run = self.single_run.copy()
+        test_run.update({'--sweep': ['I:0.0,0.2,0.4,0.6'],
+                         'condition': run_batch.parse_condition('I>0.1'),
+                         'shard': (2, 2)})
+        sweep_runs = list(run_batch.get_sweep_runs(test_run))
+        assert [this_run['-p'] for this_run in sweep_runs] == ['I:0.4']
+
 
     # Run settings and parameters methods
     # Test get_settings method
@@ -2046,6 +3170,27 @@ class TestRunBatch:
             self.get_settings(cloned_repo, tmp_archive), test_arguments)
         assert test_parameters['archive'].parent.is_dir()
 
+    def test_get_parameters_cache_without_archive(
+            self, cloned_repo, tmp_archive):
+        test_arguments = self.arguments.copy()
+        test_arguments['--cache'] = True
+        with pytest.raises(ValueError):
+            run_batch.get_parameters(
+                self.get_settings(cloned_repo, tmp_archive), test_arguments)
+
+    def test_get_parameters_cache_with_git(self, tmp_path):
+        test_settings = self.get_fake_settings(tmp_path, tmp_path)
+        with pytest.raises(ValueError):
+            self.get_fake_parameters(test_settings, [
+                '--git', '--archive', '--cache', '--', 'ImpactTexe'])
+
+    def test_get_parameters_cache_with_adapt(self, tmp_path):
+        test_settings = self.get_fake_settings(tmp_path, tmp_path)
+        with pytest.raises(ValueError):
+            self.get_fake_parameters(test_settings, [
+                '--archive', '--cache', '--sweep=I:0.0,1.0', '--adapt=5',
+                '--post=metric.py', '--', 'ImpactTexe'])
+
     def test_get_parameters_runlog(self, cloned_repo, tmp_archive):
         test_arguments = self.arguments.copy()
         test_arguments['--runlog'] = True
@@ -2097,6 +3242,81 @@ class TestRunBatch:
         assert '--results_branch' in test_parameters
         assert isinstance(test_parameters['--results_branch'], str)
 
+    def test_get_parameters_jobs(self, cloned_repo, tmp_archive):
+        test_arguments = self.arguments.copy()
+        test_arguments['--jobs'] = '4'
+        test_parameters = run_batch.get_parameters(
+            self.get_settings(cloned_repo, tmp_archive), test_arguments)
+        assert test_parameters['jobs'] == 4
+
+    def test_get_parameters_jobs_sandbox(self, cloned_repo, tmp_archive):
+        test_arguments = self.arguments.copy()
+        test_arguments['--jobs'] = '4'
+        test_parameters = run_batch.get_parameters(
+            self.get_settings(cloned_repo, tmp_archive), test_arguments)
+        assert test_parameters['--sandbox'] == True
+
+    def test_get_parameters_jobs_with_git(self, cloned_repo, tmp_archive):
+        test_arguments = self.arguments.copy()
+        test_arguments['--jobs'] = '4'
+        test_arguments['--git'] = True
+        with pytest.raises(ValueError):
+            run_batch.get_parameters(
+                self.get_settings(cloned_repo, tmp_archive), test_arguments)
+        test_arguments['--worktree'] = True
+        test_parameters = run_batch.get_parameters(
+            self.get_settings(cloned_repo, tmp_archive), test_arguments)
+        assert test_parameters['jobs'] == 4
+        assert test_parameters['--sandbox'] == False
+
+    def test_get_parameters_commit_batch_without_git(
+            self, cloned_repo, tmp_archive):
+        test_arguments = self.arguments.copy()
+        test_arguments['--commit-batch'] = '10'
+        with pytest.raises(ValueError):
+            run_batch.get_parameters(
+                self.get_settings(cloned_repo, tmp_archive), test_arguments)
+
+    def test_get_parameters_worktree_without_git(
+            self, cloned_repo, tmp_archive):
+        test_arguments = self.arguments.copy()
+        test_arguments['--worktree'] = True
+        with pytest.raises(ValueError):
+            run_batch.get_parameters(
+                self.get_settings(cloned_repo, tmp_archive), test_arguments)
+
+    def test_get_parameters_adapt_single_branch(self, tmp_repo, tmp_path):
+        test_settings = {'current_folder': pathlib.Path(
+                             tmp_repo.working_tree_dir),
+                         'archive_root': tmp_path, 'logfile': self.logfile}
+        test_arguments = self.arguments.copy()
+        test_arguments.update({'--git': True, '--adapt': '5',
+                               '--sweep': ['I:0.0,1.0'], '--post': 'echo 1',
+                               '--input_branch': [self.input_branch]})
+        test_parameters = run_batch.get_parameters(test_settings,
+                                                   test_arguments)
+        assert test_parameters['--input_branch'] == self.input_branch
+
+    # Test get_job_count method
+    def test_get_job_count_default(self):
+        assert run_batch.get_job_count(None) == 1
+        assert run_batch.get_job_count(False) == 1
+
+    def test_get_job_count_specified(self):
+        assert run_batch.get_job_count('1') == 1
+        assert run_batch.get_job_count('8') == 8
+        assert run_batch.get_job_count(8) == 8
+
+    def test_get_job_count_invalid_input(self):
+        with pytest.raises(TypeError):
+            run_batch.get_job_count()
+        with pytest.raises(ValueError):
+            run_batch.get_job_count('not a number')
+        with pytest.raises(ValueError):
+            run_batch.get_job_count('0')
+        with pytest.raises(ValueError):
+            run_batch.get_job_count('-2')
+
     # Test get_title method
     def test_get_title_no_output(self, capsys):
         run_batch.get_title(self.single_run)
@@ -2506,3 +3726,1424 @@ class TestRunBatch:
         assert self.reproduce_message in captured.err
         for filename in temp_files:
             assert not self.get_run_folder(cloned_repo).joinpath(filename).is_file()
+
+    def test_run_single_cache_hit_indexed(self, tmp_path):
+        run_folder = tmp_path.joinpath('run')
+        run_folder.mkdir()
+        run_folder.joinpath('ImpactT.in').write_text(self.test_message)
+        run_folder.joinpath(self.logfile).write_text('')
+        archive_root = tmp_path.joinpath('archive')
+        archive_root.mkdir()
+        test_settings = self.get_fake_settings(run_folder, archive_root)
+        test_parameters = self.get_fake_parameters(test_settings, [
+            '--archive', '--cache', '--class=impact', '--', 'ImpactTexe'])
+        test_parameters['title'] = run_batch.get_title(test_parameters)
+        runs = []
+        for name in ['first', 'second']:
+            test_run = test_parameters.copy()
+            test_run['archive'] = archive_root.joinpath(name)
+            run_batch.run_single(test_settings, test_run)
+            runs.append(test_run)
+        assert not runs[0]['cache_hit']
+        assert runs[1]['cache_hit']
+        assert runs[1]['archive'].joinpath('ImpactT.in').is_file()
+        connection = run_batch.open_archive_index(archive_root)
+        assert connection.execute(
+            'SELECT archive, cache_hash FROM runs ORDER BY id').fetchall() == [
+                (str(test_run['archive']), test_run['cache_hash'])
+                for test_run in runs]
+        connection.close()
+        assert runs[0]['cache_hash'] == runs[1]['cache_hash']
+
+    # Test get_sweep_runs method
+    def test_get_sweep_runs_result(self, tmp_path):
+        test_run = self.single_run.copy()
+        test_run.update({'--sweep': ['I:0.0,0.2', 'E:1.0,1.5'],
+                         '--archive': True,
+                         'archive': tmp_path})
+        sweep_runs = list(run_batch.get_sweep_runs(test_run))
+        assert len(sweep_runs) == 4
+        assert all([this_run['title'].startswith(test_run['title'])
+                    for this_run in sweep_runs])
+        assert 'I:0.2,E:1.5' in [this_run['-p'] for this_run in sweep_runs]
+        assert tmp_path.joinpath('I-0.2-E-1.5') in [
+            this_run['archive'] for this_run in sweep_runs]
+
+    def test_get_sweep_runs_existing_parameters(self):
+        test_run = self.single_run.copy()
+        test_run.update({'--sweep': ['I:0.0,0.2'], '-p': 'a:1'})
+        sweep_runs = list(run_batch.get_sweep_runs(test_run))
+        assert [this_run['-p'] for this_run in sweep_runs] == [
+            'a:1,I:0.0', 'a:1,I:0.2']
+        assert test_run['-p'] == 'a:1'
+
+    # Test get_combination_run method
+    def test_get_combination_run_result(self, tmp_path):
+        test_run = self.single_run.copy()
+        test_run.update({'-p': 'a:1', '--archive': True, 'archive': tmp_path})
+        this_run = run_batch.get_combination_run(test_run, 'I:0.2')
+        assert this_run['-p'] == 'a:1,I:0.2'
+        assert this_run['title'] == test_run['title'] + ' for I:0.2'
+        assert this_run['archive'] == tmp_path.joinpath('I-0.2')
+        assert test_run['-p'] == 'a:1'
+
+    # Test run_parallel method
+    def test_run_parallel_archives(self, tmp_path):
+        run_folder = tmp_path.joinpath('run')
+        run_folder.mkdir()
+        run_folder.joinpath('ImpactT.in').write_text(self.test_message)
+        archive_root = tmp_path.joinpath('archive')
+        archive_root.mkdir()
+        test_settings = self.get_fake_settings(run_folder, archive_root)
+        test_parameters = self.get_fake_parameters(test_settings, [
+            '--archive', '--class=impact', '--sweep=I:0.0,0.2,0.4',
+            '--jobs=2', '--', 'ImpactTexe'])
+        test_parameters['title'] = run_batch.get_title(test_parameters)
+        run_batch.run_parallel(test_settings,
+                               run_batch.get_sweep_runs(test_parameters), 2,
+                               run_batch.run_selected)
+        archive_folder = test_parameters['archive']
+        assert sorted([path.name for path in archive_folder.iterdir()]) == [
+            'I-0.0', 'I-0.2', 'I-0.4']
+        for value in ['0.0', '0.2', '0.4']:
+            run_archive = archive_folder.joinpath(f'I-{value}')
+            assert run_archive.joinpath('ImpactT.in').is_file()
+            assert run_archive.joinpath(self.archive_log).is_file()
+        assert [path.name for path in tmp_path.iterdir()
+                if 'sandbox' in path.name] == []
+
+    def test_run_parallel_error(self):
+        def failing_run(settings, this_run):
+            if this_run['-p'] == 'I:0.2':
+                raise ValueError('Run failed')
+        runs = []
+        for value in ['0.0', '0.2', '0.4']:
+            test_run = self.single_run.copy()
+            test_run['-p'] = f'I:{value}'
+            runs.append(test_run)
+        with pytest.raises(ValueError):
+            run_batch.run_parallel({}, runs, 2, failing_run)
+
+    def test_run_parallel_bounded(self):
+        taken = []
+        started = threading.Semaphore(0)
+        release = threading.Event()
+        def get_runs():
+            for number in range(10):
+                taken.append(number)
+                yield self.single_run.copy()
+        def blocked_run(settings, this_run):
+            started.release()
+            release.wait(timeout=10)
+        thread = threading.Thread(target=run_batch.run_parallel,
+                                  args=({}, get_runs(), 2, blocked_run))
+        thread.start()
+        for _ in range(2):
+            assert started.acquire(timeout=5)
+        time.sleep(0.1)
+        assert len(taken) <= 3
+        release.set()
+        thread.join(timeout=10)
+        assert len(taken) == 10
+
+    # Test get_positive_integer method
+    def test_get_positive_integer_result(self):
+        assert run_batch.get_positive_integer('3', 'test number') == 3
+        assert run_batch.get_positive_integer(1, 'test number') == 1
+
+    def test_get_positive_integer_invalid_input(self):
+        with pytest.raises(TypeError):
+            run_batch.get_positive_integer('3')
+        for value in ['0', '-2', 'two', '1.5', None]:
+            with pytest.raises(ValueError):
+                run_batch.get_positive_integer(value, 'test number')
+
+    # Test get_metric method
+    def test_get_metric_result(self):
+        assert run_batch.get_metric('Step 2 of 3\nEmittance: 1.5e-6\n') == 1.5e-6
+        assert run_batch.get_metric('-4') == -4
+        assert run_batch.get_metric('.5 and 7.') == 7
+
+    def test_get_metric_no_output(self):
+        assert run_batch.get_metric('') is None
+        assert run_batch.get_metric(None) is None
+        assert run_batch.get_metric('No numbers here') is None
+
+    # Test get_adaptive_axes method
+    def test_get_adaptive_axes_result(self):
+        assert run_batch.get_adaptive_axes(['I:0.2,0.0', 'E:3,1,2']) == [
+            ('I', [0.0, 0.2]), ('E', [1.0, 2.0, 3.0])]
+
+    def test_get_adaptive_axes_invalid_input(self):
+        with pytest.raises(ValueError):
+            run_batch.get_adaptive_axes(['I,E:0.0,0.2'])
+        with pytest.raises(ValueError):
+            run_batch.get_adaptive_axes(['mode:fast,slow'])
+
+    # Test get_value_labels method
+    def test_get_value_labels_result(self):
+        assert run_batch.get_value_labels(['I:0.0,0.20', 'E:3,1e1']) == [
+            {0.0: '0.0', 0.2: '0.20'}, {3.0: '3', 10.0: '1e1'}]
+
+    # Test get_adaptive_combination method
+    def test_get_adaptive_combination_result(self):
+        test_axes = [('I', [0.0, 0.2]), ('E', [3.0])]
+        test_labels = [{0.0: '0.0', 0.2: '0.20'}, {3.0: '3'}]
+        assert run_batch.get_adaptive_combination(
+            test_axes, test_labels, (0.0, 3.0)) == 'I:0.0,E:3'
+
+    # Test get_refinement method
+    def test_get_refinement_result(self):
+        test_axes = [('I', [0.0, 1.0, 2.0])]
+        test_metrics = {(0.0,): 1.0, (1.0,): 1.5, (2.0,): 4.0}
+        assert run_batch.get_refinement(test_axes, test_metrics) == (0, 1.5)
+
+    def test_get_refinement_no_output(self):
+        test_axes = [('I', [0.0, 1.0])]
+        assert run_batch.get_refinement(test_axes, {(0.0,): 1.0,
+                                                    (1.0,): 1.0}) is None
+        assert run_batch.get_refinement(test_axes, {(0.0,): 1.0,
+                                                    (1.0,): None}) is None
+
+    # Test run_adaptive method
+    def test_run_adaptive_result(self, monkeypatch, capfd):
+        parameter_values = []
+        def fake_run(settings, this_run):
+            values = run_batch.get_parameter_values(this_run['-p'])
+            parameter_values.append(values['I'])
+            this_run['metric'] = 1.0 if values['I'] < 0.3 else 0.0
+        monkeypatch.setattr(run_batch, 'run_selected', fake_run)
+        test_run = self.single_run.copy()
+        test_run.update({'--sweep': ['I:0.0,1.0'], 'adapt': 5, 'jobs': 1})
+        run_batch.run_adaptive({}, test_run)
+        captured = capfd.readouterr()
+        assert parameter_values == [0.0, 1.0, 0.5, 0.25, 0.375]
+        assert 'after 5 runs' in captured.out
+
+    def test_run_adaptive_value_strings(self, monkeypatch):
+        parameter_strings = []
+        def fake_run(settings, this_run):
+            parameter_strings.append(this_run['-p'])
+            values = run_batch.get_parameter_values(this_run['-p'])
+            this_run['metric'] = values['I']
+        monkeypatch.setattr(run_batch, 'run_selected', fake_run)
+        test_run = self.single_run.copy()
+        test_run.update({'--sweep': ['I:0.0,1.0'], 'adapt': 4, 'jobs': 1})
+        run_batch.run_adaptive({}, test_run)
+        assert parameter_strings == ['I:0.0', 'I:1.0', 'I:0.5', 'I:0.25']
+
+    def test_run_adaptive_invalid_input(self):
+        test_run = self.single_run.copy()
+        test_run.update({'--sweep': ['I:0,1,2', 'E:0,1'], 'adapt': 5, 'jobs': 1})
+        with pytest.raises(ValueError):
+            run_batch.run_adaptive({}, test_run)
+        with pytest.raises(TypeError):
+            run_batch.run_adaptive({})
+
+    # Test get_seed method
+    def test_get_seed_result(self):
+        assert run_batch.get_seed(None) == 0
+        assert run_batch.get_seed('42') == 42
+
+    def test_get_seed_invalid_input(self):
+        with pytest.raises(ValueError):
+            run_batch.get_seed('not a seed')
+
+    # Test get_sweep_range method
+    def test_get_sweep_range_result(self):
+        assert run_batch.get_sweep_range('I:0.0..1.0') == ('I', 0.0, 1.0, False)
+        assert run_batch.get_sweep_range('E: 1e-3 .. 10 :log') == (
+            'E', 0.001, 10.0, True)
+
+    def test_get_sweep_range_no_output(self):
+        assert run_batch.get_sweep_range('I:0.0,1.0') is None
+        assert run_batch.get_sweep_range('(I,E):(0,1),(1,2)') is None
+
+    def test_get_sweep_range_invalid_input(self):
+        with pytest.raises(ValueError):
+            run_batch.get_sweep_range('I:a..b')
+        with pytest.raises(ValueError):
+            run_batch.get_sweep_range('I:0.0..1.0:log')
+
+    # Test get_unit_samples method
+    def test_get_unit_samples_result(self):
+        for method in ['random', 'lhs']:
+            samples = run_batch.get_unit_samples(8, 3, method, 1)
+            assert len(samples) == 8
+            assert all([len(sample) == 3 for sample in samples])
+            assert all([0 <= value < 1 for sample in samples
+                        for value in sample])
+            assert samples == run_batch.get_unit_samples(8, 3, method, 1)
+            assert samples != run_batch.get_unit_samples(8, 3, method, 2)
+
+    def test_get_unit_samples_lhs_strata(self):
+        samples = run_batch.get_unit_samples(10, 2, 'lhs', 0)
+        for dimension in range(2):
+            assert sorted([int(sample[dimension] * 10)
+                           for sample in samples]) == list(range(10))
+
+    def test_get_unit_samples_sobol(self):
+        pytest.importorskip('scipy')
+        samples = run_batch.get_unit_samples(8, 2, 'sobol', 0)
+        assert len(samples) == 8
+        assert samples == run_batch.get_unit_samples(8, 2, 'sobol', 0)
+
+    def test_get_unit_samples_invalid_input(self, monkeypatch):
+        with pytest.raises(ValueError):
+            run_batch.get_unit_samples(8, 2, 'grid', 0)
+        monkeypatch.setitem(sys.modules, 'scipy.stats', None)
+        with pytest.raises(ImportError):
+            run_batch.get_unit_samples(8, 2, 'sobol', 0)
+
+    # Test get_sample_value method
+    def test_get_sample_value_result(self):
+        assert run_batch.get_sample_value(1.0, 3.0, False, 0.5) == 2.0
+        assert run_batch.get_sample_value(0.1, 10.0, True, 0.5) == (
+            pytest.approx(1.0))
+
+    # Test get_sampled_sweeps method
+    def test_get_sampled_sweeps_result(self):
+        sweeps = run_batch.get_sampled_sweeps(
+            ['mode:fast,slow', 'I:0.0..1.0', 'E:0.1..10:log'], 5, 'lhs', 3)
+        assert sweeps[0] == 'mode:fast,slow'
+        assert sweeps[1].startswith('(I,E):(')
+        assert len(run_batch.get_sweep_combinations(sweeps)) == 10
+        for combination in run_batch.get_sweep_combinations(sweeps):
+            values = run_batch.get_parameter_values(combination)
+            assert 0.0 <= values['I'] <= 1.0
+            assert 0.1 <= values['E'] <= 10.0
+
+    def test_get_sampled_sweeps_single_range(self):
+        sweeps = run_batch.get_sampled_sweeps(['I:0.0..1.0'], 4)
+        assert len(sweeps) == 1
+        assert len(run_batch.get_sweep_strings(sweeps[0])) == 4
+        assert sweeps == run_batch.get_sampled_sweeps(['I:0.0..1.0'], 4)
+
+    def test_get_sampled_sweeps_no_output(self):
+        assert run_batch.get_sampled_sweeps(['I:0.0,1.0'], 4) == ['I:0.0,1.0']
+
+    # Test get_priority method
+    def test_get_priority_result(self):
+        assert run_batch.get_priority(None) == 0
+        assert run_batch.get_priority('-3') == -3
+
+    def test_get_priority_invalid_input(self):
+        with pytest.raises(ValueError):
+            run_batch.get_priority('high')
+
+    # Test get_memory_size method
+    def test_get_memory_size_result(self):
+        assert run_batch.get_memory_size('0.5') == 0.5
+
+    def test_get_memory_size_invalid_input(self):
+        for memory in ['0', '-1', 'lots', None]:
+            with pytest.raises(ValueError):
+                run_batch.get_memory_size(memory)
+
+    # Test get_resource_cost method
+    def test_get_resource_cost_result(self):
+        assert run_batch.get_resource_cost('opal') == {'cores': 4,
+                                                       'memory': 8.0}
+        assert run_batch.get_resource_cost(None) == {'cores': 1, 'memory': 1.0}
+        assert run_batch.get_resource_cost('impact', '2', '3.5') == {
+            'cores': 2, 'memory': 3.5}
+
+    def test_get_resource_cost_invalid_input(self):
+        with pytest.raises(ValueError):
+            run_batch.get_resource_cost('impact', 'two')
+        with pytest.raises(ValueError):
+            run_batch.get_resource_cost('impact', None, '-1')
+
+    # Test get_machine_capacity method
+    def test_get_machine_capacity_result(self):
+        capacity = run_batch.get_machine_capacity()
+        assert capacity['cores'] >= 1
+        assert capacity['memory'] > 0
+
+    # Test acquire_resources and release_resources methods
+    def test_acquire_resources_result(self):
+        scheduler = run_batch.create_scheduler({'cores': 4, 'memory': 8.0})
+        cost = run_batch.acquire_resources(scheduler,
+                                           {'cores': 8, 'memory': 2.0})
+        assert cost == {'cores': 4, 'memory': 2.0}
+        assert scheduler['free'] == {'cores': 0, 'memory': 6.0}
+        run_batch.release_resources(scheduler, cost)
+        assert scheduler['free'] == scheduler['capacity']
+
+    def test_acquire_resources_priority(self):
+        scheduler = run_batch.create_scheduler({'cores': 1, 'memory': 8.0})
+        first_cost = run_batch.acquire_resources(scheduler,
+                                                 {'cores': 1, 'memory': 1.0})
+        started = []
+        def wait_for_run(name, priority):
+            cost = run_batch.acquire_resources(
+                scheduler, {'cores': 1, 'memory': 1.0}, priority)
+            started.append(name)
+            run_batch.release_resources(scheduler, cost)
+        threads = [threading.Thread(target=wait_for_run, args=('long', 0)),
+                   threading.Thread(target=wait_for_run, args=('short', 5))]
+        for thread in threads:
+            thread.start()
+            while len(scheduler['waiting']) < threads.index(thread) + 1:
+                time.sleep(0.01)
+        assert started == []
+        run_batch.release_resources(scheduler, first_cost)
+        for thread in threads:
+            thread.join(timeout=5)
+        assert started == ['short', 'long']
+
+    # Test run_scheduled method
+    def test_run_scheduled_result(self):
+        test_run = self.single_run.copy()
+        test_run['cost'] = {'cores': 1, 'memory': 0.1}
+        free = []
+        def check_run(settings, this_run):
+            free.append(dict(run_batch.get_scheduler()['free']))
+            return 'done'
+        assert run_batch.run_scheduled({}, test_run, check_run) == 'done'
+        capacity = run_batch.get_scheduler()['capacity']
+        assert free[0]['cores'] == capacity['cores'] - 1
+        assert run_batch.get_scheduler()['free'] == capacity
+
+    def test_run_scheduled_no_cost(self):
+        assert run_batch.run_scheduled(
+            {}, self.single_run.copy(), lambda settings, this_run: 'done'
+            ) == 'done'
+
+    def test_run_scheduled_branches(self):
+        test_run = self.single_run.copy()
+        test_run.update({'cost': {'cores': 1, 'memory': 0.1},
+                         '--worktree': True,
+                         '--input_branch': ['input/full', 'input/other']})
+        free = []
+        def check_run(settings, this_run):
+            free.append(dict(run_batch.get_scheduler()['free']))
+        run_batch.run_scheduled({}, test_run, check_run)
+        assert free[0] == run_batch.get_scheduler()['capacity']
+
+    # Test run_batch method
+    def test_run_batch_commit_batch_clean_index(self, tmp_repo, tmp_path):
+        repo_folder = pathlib.Path(tmp_repo.working_tree_dir)
+        test_settings = self.get_fake_settings(repo_folder, tmp_path)
+        test_parameters = self.get_fake_parameters(test_settings, [
+            '--git', f'--input_branch={self.input_branch}',
+            f'--results_branch={self.results_branch}', '--commit-batch=2',
+            '--sweep=I:0.0,0.2,0.4', '--', 'ImpactTexe'])
+        results_commit = tmp_repo.heads[self.results_branch].commit
+        run_batch.run_batch(test_settings, test_parameters)
+        assert tmp_repo.active_branch.name == self.input_branch
+        assert not tmp_repo.is_dirty()
+        assert self.logfile not in tmp_repo.git.ls_files()
+        results_branch = tmp_repo.heads[self.results_branch]
+        assert results_branch.commit.parents[0].parents == (results_commit,)
+        log = results_branch.commit.tree[self.logfile].data_stream.read()
+        assert log == b'Old entry\n' + b'Fake run\n' * 3
+
+    def test_run_batch_serial_scheduled(self, monkeypatch):
+        free = []
+        def check_run(settings, this_run):
+            free.append(dict(run_batch.get_scheduler()['free']))
+        monkeypatch.setattr(run_batch, 'run_selected', check_run)
+        test_run = self.single_run.copy()
+        test_run.update({'cost': {'cores': 1, 'memory': 0.1},
+                         '--sweep': ['I:0.0,0.2'], 'jobs': 1})
+        run_batch.run_batch({}, test_run)
+        capacity = run_batch.get_scheduler()['capacity']
+        assert [cores['cores'] for cores in free] == [capacity['cores'] - 1] * 2
+        assert run_batch.get_scheduler()['free'] == capacity
+
+    def get_test_daemon(self, monkeypatch):
+        def fake_batch(settings, folder, arguments):
+            parameters = self.single_run.copy()
+            parameters['priority'] = arguments.get('priority', 0)
+            return {'current_folder': pathlib.Path(folder)}, parameters
+        monkeypatch.setattr(run_batch, 'get_settings', lambda arguments: {})
+        monkeypatch.setattr(run_batch, 'get_isolated_batch', fake_batch)
+        return run_batch.create_daemon(1)
+
+    # Test get_socket_path method
+    def test_get_socket_path_result(self, tmp_path):
+        assert run_batch.get_socket_path(None).name == run_batch.DAEMON_SOCKET
+        assert run_batch.get_socket_path(str(tmp_path.joinpath('s'))) == (
+            tmp_path.joinpath('s'))
+
+    # Test is_cancelled_run method
+    def test_is_cancelled_run_result(self):
+        test_run = self.single_run.copy()
+        assert not run_batch.is_cancelled_run(test_run)
+        test_run['cancel'] = threading.Event()
+        assert not run_batch.is_cancelled_run(test_run)
+        test_run['cancel'].set()
+        assert run_batch.is_cancelled_run(test_run)
+
+    # Test handle_request method
+    def test_handle_request_result(self, monkeypatch, tmp_path):
+        daemon = self.get_test_daemon(monkeypatch)
+        response = run_batch.handle_request(daemon, {
+            'action': 'submit', 'folder': str(tmp_path), 'arguments': {}})
+        assert response == {'id': 1}
+        response = run_batch.handle_request(daemon, {'action': 'status'})
+        assert [batch['state'] for batch in response['batches']] == ['queued']
+        assert response['batches'][0]['folder'] == str(tmp_path)
+        response = run_batch.handle_request(daemon, {'action': 'cancel',
+                                                     'id': '1'})
+        assert response['batches'][0]['state'] == 'cancelled'
+        response = run_batch.handle_request(daemon, {'action': 'wait'})
+        assert response['batches'][0]['state'] == 'cancelled'
+
+    def test_handle_request_invalid_input(self, monkeypatch):
+        daemon = self.get_test_daemon(monkeypatch)
+        with pytest.raises(ValueError):
+            run_batch.handle_request(daemon, {'action': 'status', 'id': 4})
+        with pytest.raises(ValueError):
+            run_batch.handle_request(daemon, {'action': 'restart'})
+
+    # Test get_next_batch and finish_batch methods
+    def test_get_next_batch_result(self, monkeypatch, tmp_path):
+        daemon = self.get_test_daemon(monkeypatch)
+        for priority in [0, 2, 2]:
+            run_batch.handle_request(daemon, {
+                'action': 'submit', 'folder': str(tmp_path),
+                'arguments': {'priority': priority}})
+        batch = run_batch.get_next_batch(daemon)
+        assert batch['id'] == 2
+        assert batch['state'] == 'running'
+        run_batch.finish_batch(daemon, batch)
+        assert batch['state'] == 'completed'
+        batch = run_batch.get_next_batch(daemon)
+        assert batch['id'] == 3
+        run_batch.finish_batch(daemon, batch, 'Invalid template')
+        assert batch['state'] == 'failed'
+        assert batch['error'] == 'Invalid template'
+
+    # Test run_daemon_batches method
+    def test_run_daemon_batches_result(self, monkeypatch, tmp_path):
+        daemon = self.get_test_daemon(monkeypatch)
+        folders = []
+        monkeypatch.setattr(run_batch, 'run_batch', lambda settings,
+                            parameters: folders.append(
+                                settings['current_folder']))
+        threading.Thread(target=run_batch.run_daemon_batches, args=(daemon,),
+                         daemon=True).start()
+        run_batch.handle_request(daemon, {
+            'action': 'submit', 'folder': str(tmp_path), 'arguments': {}})
+        response = run_batch.handle_request(daemon, {'action': 'wait',
+                                                     'id': 1})
+        assert response['batches'][0]['state'] == 'completed'
+        assert folders == [tmp_path]
+
+    # Test serve_connection and send_request methods
+    def test_send_request_result(self, monkeypatch, tmp_path):
+        daemon = self.get_test_daemon(monkeypatch)
+        socket_path = tmp_path.joinpath('daemon.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(str(socket_path))
+            server.listen()
+            def serve():
+                connection, _ = server.accept()
+                run_batch.serve_connection(daemon, connection)
+            thread = threading.Thread(target=serve, daemon=True)
+            thread.start()
+            assert run_batch.send_request(socket_path, {
+                'action': 'status'}) == {'batches': []}
+            thread.join(timeout=5)
+            thread = threading.Thread(target=serve, daemon=True)
+            thread.start()
+            with pytest.raises(ValueError):
+                run_batch.send_request(socket_path, {'action': 'restart'})
+            thread.join(timeout=5)
+
+    def test_send_request_no_daemon(self, tmp_path):
+        with pytest.raises(OSError):
+            run_batch.send_request(tmp_path.joinpath('missing.sock'),
+                                   {'action': 'status'})
+
+    # Test write_task and claim_task methods
+    def test_claim_task_result(self, tmp_path):
+        run_batch.write_task(tmp_path, 'b.json', {'title': 'Second'})
+        run_batch.write_task(tmp_path, 'a.json', {'title': 'First'})
+        assert list(tmp_path.joinpath('new').iterdir()) == []
+        task = run_batch.claim_task(tmp_path)
+        assert task['title'] == 'First'
+        assert task['task_file'] == str(tmp_path.joinpath('claimed', 'a.json'))
+        assert [path.name for path in tmp_path.joinpath('pending').iterdir()
+                ] == ['b.json']
+        assert run_batch.claim_task(tmp_path)['title'] == 'Second'
+        assert run_batch.claim_task(tmp_path) is None
+
+    def test_claim_task_claimed_elsewhere(self, monkeypatch, tmp_path):
+        run_batch.write_task(tmp_path, 'a.json', {'title': 'First'})
+        run_batch.write_task(tmp_path, 'b.json', {'title': 'Second'})
+        rename = os.rename
+        def claim_first_elsewhere(source, destination):
+            if pathlib.Path(source).name == 'a.json':
+                raise FileNotFoundError(source)
+            rename(source, destination)
+        monkeypatch.setattr(os, 'rename', claim_first_elsewhere)
+        assert run_batch.claim_task(tmp_path)['title'] == 'Second'
+
+    def test_claim_task_records_worker(self, tmp_path):
+        run_batch.write_task(tmp_path, 'a.json', {'title': 'First'})
+        task = run_batch.claim_task(tmp_path)
+        with open(tmp_path.joinpath('claimed', 'a.json'), 'r') as f:
+            claimed_task = json.load(f)
+        assert claimed_task['worker'] == task['worker']
+        assert claimed_task['worker'].endswith(f':{os.getpid()}')
+        assert 'claimed' in claimed_task
+
+    # Test requeue_stale_tasks method
+    def get_claimed_task(self, queue_path, task_name, worker):
+        run_batch.write_task(queue_path, task_name, {'title': task_name})
+        task = run_batch.claim_task(queue_path)
+        task['worker'] = worker
+        with open(task.pop('task_file'), 'w') as f:
+            json.dump(task, f)
+
+    def test_requeue_stale_tasks_result(self, tmp_path, capfd):
+        host = run_batch.get_worker_name().rpartition(':')[0]
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        self.get_claimed_task(tmp_path, 'a.json', f'{host}:{process.pid}')
+        self.get_claimed_task(tmp_path, 'b.json', run_batch.get_worker_name())
+        self.get_claimed_task(tmp_path, 'c.json', 'other-host:1')
+        assert run_batch.requeue_stale_tasks(tmp_path) == 1
+        captured = capfd.readouterr()
+        assert 'Returned 1 tasks' in captured.out
+        assert [path.name for path in tmp_path.joinpath('pending').iterdir()
+                ] == ['a.json']
+        assert run_batch.claim_task(tmp_path)['title'] == 'a.json'
+
+    def test_requeue_stale_tasks_old(self, tmp_path):
+        self.get_claimed_task(tmp_path, 'a.json', 'other-host:1')
+        claimed_file = tmp_path.joinpath('claimed', 'a.json')
+        old_time = time.time() - 3 * 3600
+        os.utime(claimed_file, (old_time, old_time))
+        self.get_claimed_task(tmp_path, 'b.json', 'other-host:2')
+        assert run_batch.requeue_stale_tasks(tmp_path, 4) == 0
+        assert run_batch.requeue_stale_tasks(tmp_path, 2) == 1
+        assert [path.name for path in tmp_path.joinpath('claimed').iterdir()
+                ] == ['b.json']
+
+    # Test iter_claimed_tasks method
+    def test_iter_claimed_tasks_result(self, tmp_path):
+        for name in ['a', 'b', 'c']:
+            run_batch.write_task(tmp_path, f'{name}.json', {'title': name})
+        assert [task['title'] for task in
+                run_batch.iter_claimed_tasks(tmp_path)] == ['a', 'b', 'c']
+
+    # Test finish_task method
+    def test_finish_task_result(self, tmp_path):
+        run_batch.write_task(tmp_path, 'a.json', {'title': 'First'})
+        run_batch.finish_task(run_batch.claim_task(tmp_path), 'failed')
+        with open(tmp_path.joinpath('failed', 'a.json'), 'r') as f:
+            task = json.load(f)
+        assert task['state'] == 'failed'
+        assert list(tmp_path.joinpath('claimed').iterdir()) == []
+
+    # Test queue_batch method
+    def test_queue_batch_result(self, tmp_path):
+        test_run = self.single_run.copy()
+        test_run.update({'--sweep': ['I:0.0,0.2'], '--queue': str(tmp_path),
+                         '--archive': True,
+                         'archive': tmp_path.joinpath('archive')})
+        run_batch.queue_batch({'current_folder': tmp_path}, test_run,
+                              self.arguments)
+        tasks = sorted(tmp_path.joinpath('pending').iterdir())
+        assert len(tasks) == 2
+        with open(tasks[1], 'r') as f:
+            task = json.load(f)
+        assert task['-p'] == 'I:0.2'
+        assert task['folder'] == str(tmp_path)
+        assert task['archive'] == str(tmp_path.joinpath('archive', 'I-0.2'))
+        assert task['arguments'] == self.arguments
+
+    # Test run_task method
+    def test_run_task_result(self, monkeypatch, tmp_path):
+        runs = []
+        def fake_batch(settings, folder, arguments):
+            return {'current_folder': pathlib.Path(folder)}, (
+                self.single_run.copy())
+        def fake_run(settings, this_run):
+            runs.append(this_run)
+            this_run['returncode'] = 0 if this_run['-p'] == 'I:0.0' else 1
+        monkeypatch.setattr(run_batch, 'get_isolated_batch', fake_batch)
+        monkeypatch.setattr(run_batch, 'run_selected', fake_run)
+        for value in ['0.0', '0.2']:
+            run_batch.write_task(tmp_path, f'{value}.json', {
+                'folder': str(tmp_path), 'arguments': self.arguments,
+                'title': f'Run for I:{value}', '-p': f'I:{value}',
+                'archive': None})
+        for task in run_batch.iter_claimed_tasks(tmp_path):
+            run_batch.run_task({}, task)
+        assert [this_run['title'] for this_run in runs] == [
+            'Run for I:0.0', 'Run for I:0.2']
+        assert tmp_path.joinpath('done', '0.0.json').is_file()
+        assert tmp_path.joinpath('failed', '0.2.json').is_file()
+
+    def test_run_task_invalid_input(self, monkeypatch, tmp_path, capfd):
+        def broken_batch(settings, folder, arguments):
+            raise ValueError('Invalid sweep definition')
+        monkeypatch.setattr(run_batch, 'get_isolated_batch', broken_batch)
+        run_batch.write_task(tmp_path, 'a.json', {
+            'folder': str(tmp_path), 'arguments': self.arguments,
+            'title': 'Broken run'})
+        run_batch.run_task({}, run_batch.claim_task(tmp_path))
+        with open(tmp_path.joinpath('failed', 'a.json'), 'r') as f:
+            task = json.load(f)
+        assert task['error'] == 'Invalid sweep definition'
+
+    # Test run_worker method
+    def test_run_worker_jobs(self, monkeypatch, tmp_path, capfd):
+        runs = []
+        def fake_batch(settings, folder, arguments):
+            return {'current_folder': pathlib.Path(folder)}, (
+                self.single_run.copy())
+        def fake_run(settings, this_run):
+            runs.append(this_run['title'])
+            this_run['returncode'] = 0
+        monkeypatch.setattr(run_batch, 'get_settings', lambda arguments: {})
+        monkeypatch.setattr(run_batch, 'get_isolated_batch', fake_batch)
+        monkeypatch.setattr(run_batch, 'run_selected', fake_run)
+        for value in ['0.0', '0.2', '0.4']:
+            run_batch.write_task(tmp_path, f'{value}.json', {
+                'folder': str(tmp_path), 'arguments': self.arguments,
+                'title': f'Run for I:{value}', '-p': f'I:{value}',
+                'archive': None, 'cost': {'cores': 1, 'memory': 0.1},
+                'priority': 0})
+        test_arguments = self.arguments.copy()
+        test_arguments.update({'--worker': str(tmp_path), '--jobs': '2'})
+        run_batch.run_worker(test_arguments)
+        captured = capfd.readouterr()
+        assert 'No more pending tasks' in captured.out
+        assert sorted(runs) == ['Run for I:0.0', 'Run for I:0.2',
+                                'Run for I:0.4']
+        assert list(tmp_path.joinpath('claimed').iterdir()) == []
+        assert len(list(tmp_path.joinpath('done').iterdir())) == 3
+
+    # Test store_output method
+    def test_store_output_result(self, tmp_path):
+        test_run = self.single_run.copy()
+        test_run.update({'--clean': True, '--class': 'impact'})
+        for filename in ['fort.1', 'beam.plt', 'ImpactT.in']:
+            tmp_path.joinpath(filename).write_text('Test data')
+        run_batch.store_output({'current_folder': tmp_path}, test_run, 0)
+        assert [path.name for path in tmp_path.iterdir()] == ['ImpactT.in']
+
+    # Test create_archiver, hand_off_output and wait_for_archiver methods
+    def test_hand_off_output_result(self, monkeypatch):
+        stored = []
+        released = []
+        def slow_store(settings, this_run, returncode):
+            time.sleep(0.05)
+            stored.append((this_run['title'], returncode))
+        monkeypatch.setattr(run_batch, 'store_output', slow_store)
+        archiver = run_batch.create_archiver(1)
+        for number in range(3):
+            test_run = self.single_run.copy()
+            test_run.update({'title': f'Run {number}', '--clean': True,
+                             'archiver': archiver, 'returncode': number})
+            assert run_batch.hand_off_output(
+                {}, test_run, lambda number=number: released.append(number))
+        run_batch.wait_for_archiver(archiver)
+        assert stored == [('Run 0', 0), ('Run 1', 1), ('Run 2', 2)]
+        assert released == [0, 1, 2]
+        assert not archiver['thread'].is_alive()
+
+    def test_hand_off_output_no_output(self):
+        test_run = self.single_run.copy()
+        test_run.update({'--clean': True, 'returncode': 0})
+        assert not run_batch.hand_off_output({}, test_run, None)
+        test_run.update({'archiver': {'queue': None}})
+        del test_run['returncode']
+        assert not run_batch.hand_off_output({}, test_run, None)
+        test_run.update({'returncode': 0, '--clean': False})
+        assert not run_batch.hand_off_output({}, test_run, None)
+
+    def test_hand_off_output_cache_hit(self):
+        test_run = self.single_run.copy()
+        test_run.update({'--archive': True, 'returncode': 0,
+                         'archiver': {'queue': None}, 'cache_hit': True})
+        assert not run_batch.hand_off_output({}, test_run, None)
+
+    # Test run_archiver method
+    def test_run_archiver_invalid_input(self, monkeypatch, capfd, tmp_path):
+        def broken_store(settings, this_run, returncode):
+            raise OSError('Cannot access archive folder')
+        monkeypatch.setattr(run_batch, 'store_output', broken_store)
+        released = []
+        archiver = run_batch.create_archiver(2)
+        test_run = self.single_run.copy()
+        test_run.update({'--clean': True, 'archiver': archiver,
+                         'returncode': 0,
+                         'ledger': tmp_path.joinpath(run_batch.LEDGER)})
+        run_batch.hand_off_output({}, test_run, lambda: released.append(1))
+        run_batch.wait_for_archiver(archiver)
+        captured = capfd.readouterr()
+        assert 'Cannot access archive folder' in captured.out + captured.err
+        assert released == [1]
+        with open(test_run['ledger'], 'r') as f:
+            assert json.loads(f.readline())['status'] == 'failed'
+
+    # Test get_pattern_matcher method
+    def test_get_pattern_matcher_result(self):
+        matches = run_batch.get_pattern_matcher(['fort.*', '*.h5', 'data'])
+        assert matches('fort.40')
+        assert matches('beam.h5')
+        assert matches('data')
+        assert not matches('data.txt')
+        assert not matches('beam.H5')
+        assert not run_batch.get_pattern_matcher([])('fort.40')
+
+    # Test scan_run_folder method
+    def test_scan_run_folder_result(self, tmp_path):
+        for filename in ['ImpactT.in', 'ImpactT.in.rendered', 'fort.40',
+                         'beam.plt', run_batch.LOGFILE, 'run.log']:
+            tmp_path.joinpath(filename).write_text(self.test_message)
+        scan = run_batch.scan_run_folder(tmp_path, ['*.in'],
+                                         ['*.plt', '*.log'],
+                                         ['fort.*', '*.plt'])
+        assert {name: sorted([path.name for path in paths])
+                for name, paths in scan.items()} == {
+            'copy': ['ImpactT.in'],
+            'move': ['beam.plt', 'run.log'],
+            'delete': ['beam.plt', 'fort.40'],
+            'rendered': ['ImpactT.in.rendered']}
+
+    def test_scan_run_folder_invalid_input(self, tmp_path):
+        with pytest.raises(FileNotFoundError):
+            run_batch.scan_run_folder(tmp_path.joinpath('missing'), [], [], [])
+        with pytest.raises(TypeError):
+            run_batch.scan_run_folder(tmp_path, [], [])
+
+    # Test reuse of a single scan for archiving and deletion
+    def test_delete_output_scanned(self, tmp_path):
+        archive_folder = tmp_path.joinpath('archive')
+        archive_folder.mkdir()
+        run_folder = tmp_path.joinpath('run')
+        run_folder.mkdir()
+        for filename in ['fort.40', 'beam.plt', 'ImpactT.in']:
+            run_folder.joinpath(filename).write_text(self.test_message)
+        test_run = self.single_run.copy()
+        test_run['--class'] = 'impact'
+        scan = run_batch.scan_run_folder(
+            run_folder, ['*.in'], ['*.plt'],
+            run_batch.get_delete_list(test_run['--class']))
+        run_batch.copy_to_archive(run_folder, archive_folder, ['*.in'],
+                                  scan=scan)
+        run_batch.move_to_archive(run_folder, archive_folder, ['*.plt'],
+                                  scan=scan)
+        run_batch.delete_output({'current_folder': run_folder}, test_run,
+                                scan=scan)
+        assert sorted([path.name for path in archive_folder.iterdir()]) == [
+            'ImpactT.in', 'beam.plt']
+        assert [path.name for path in run_folder.iterdir()] == ['ImpactT.in']
+
+    # Test format_size method
+    def test_format_size_result(self):
+        assert run_batch.format_size(512) == '512.0 B'
+        assert run_batch.format_size(1500000) == '1.5 MB'
+        assert run_batch.format_size(2e13) == '20.0 TB'
+
+    # Test is_same_device method
+    def test_is_same_device_result(self, tmp_path):
+        tmp_path.joinpath('fort.40').write_text(self.test_message)
+        assert run_batch.is_same_device(tmp_path.joinpath('fort.40'), tmp_path)
+
+    # Test stream_file method
+    def test_stream_file_result(self, tmp_path):
+        source = tmp_path.joinpath('beam.h5')
+        source.write_bytes(os.urandom(300000))
+        source.chmod(0o640)
+        destination = tmp_path.joinpath('copy.h5')
+        assert run_batch.stream_file(source, destination) == 300000
+        assert destination.read_bytes() == source.read_bytes()
+        assert destination.stat().st_mode == source.stat().st_mode
+
+    def test_stream_file_sendfile(self, monkeypatch, tmp_path):
+        def unsupported(*args):
+            raise OSError('Not supported')
+        monkeypatch.setattr(os, 'copy_file_range', unsupported,
+                            raising=False)
+        source = tmp_path.joinpath('beam.h5')
+        source.write_bytes(os.urandom(100000))
+        destination = tmp_path.joinpath('copy.h5')
+        assert run_batch.stream_file(source, destination) == 100000
+        assert destination.read_bytes() == source.read_bytes()
+
+    # Test archive_file method
+    def test_archive_file_same_device(self, tmp_path):
+        run_folder = tmp_path.joinpath('run')
+        archive_folder = tmp_path.joinpath('archive')
+        run_folder.mkdir()
+        archive_folder.mkdir()
+        for filename in ['ImpactT.in', 'fort.40']:
+            run_folder.joinpath(filename).write_text(self.test_message)
+        assert run_batch.archive_file(run_folder.joinpath('ImpactT.in'),
+                                      archive_folder) in [
+            0, len(self.test_message)]
+        assert run_batch.archive_file(run_folder.joinpath('fort.40'),
+                                      archive_folder, move=True) == 0
+        assert run_folder.joinpath('ImpactT.in').is_file()
+        assert not run_folder.joinpath('fort.40').exists()
+        assert archive_folder.joinpath('fort.40').read_text() == (
+            self.test_message)
+        run_batch.archive_file(run_folder.joinpath('ImpactT.in'),
+                               archive_folder)
+        assert run_folder.joinpath('ImpactT.in').read_text() == (
+            self.test_message)
+        assert archive_folder.joinpath('ImpactT.in').read_text() == (
+            self.test_message)
+
+    def test_archive_file_copy_not_linked(self, tmp_path):
+        archive_folder = tmp_path.joinpath('archive')
+        archive_folder.mkdir()
+        source = tmp_path.joinpath('ImpactT.in')
+        source.write_text(self.test_message)
+        run_batch.archive_file(source, archive_folder)
+        archived = archive_folder.joinpath('ImpactT.in')
+        assert archived.stat().st_ino != source.stat().st_ino
+        with open(source, 'a') as f:
+            f.write('New line')
+        assert archived.read_text() == self.test_message
+
+    def test_archive_file_other_device(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(run_batch, 'is_same_device',
+                            lambda path, folder: False)
+        archive_folder = tmp_path.joinpath('archive')
+        archive_folder.mkdir()
+        tmp_path.joinpath('fort.40').write_text(self.test_message)
+        assert run_batch.archive_file(tmp_path.joinpath('fort.40'),
+                                      archive_folder, move=True) == (
+            len(self.test_message))
+        assert not tmp_path.joinpath('fort.40').exists()
+        assert archive_folder.joinpath('fort.40').read_text() == (
+            self.test_message)
+
+    # Test fast_archive_files method
+    def test_fast_archive_files_result(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(run_batch, 'is_same_device',
+                            lambda path, folder: False)
+        archive_folder = tmp_path.joinpath('archive')
+        archive_folder.mkdir()
+        files = [tmp_path.joinpath(f'fort.{number}') for number in range(10)]
+        for this_file in files:
+            this_file.write_bytes(b'x' * 1000)
+        assert run_batch.fast_archive_files(files, archive_folder) == 10000
+        assert len(list(archive_folder.iterdir())) == 10
+
+    # Test fast_archive_output method
+    def test_fast_archive_output_result(self, capsys, tmp_path):
+        archive_folder = tmp_path.joinpath('archive')
+        archive_folder.mkdir()
+        for filename in ['ImpactT.in', 'beam.plt']:
+            tmp_path.joinpath(filename).write_bytes(b'x' * 500)
+        test_run = self.single_run.copy()
+        test_run['archive'] = archive_folder
+        scan = run_batch.scan_run_folder(tmp_path, ['*.in'], ['*.plt'], [])
+        run_batch.fast_archive_output(test_run, scan)
+        captured = capsys.readouterr()
+        assert 'Archived 1.0 kB' in captured.out
+        assert sorted([path.name for path in archive_folder.iterdir()]) == [
+            'ImpactT.in', 'beam.plt']
+        assert not tmp_path.joinpath('beam.plt').exists()
+
+    def make_output_files(self, run_folder):
+        run_folder.joinpath('data').mkdir()
+        run_folder.joinpath('data', 'step1.h5').write_bytes(b'h5' * 700)
+        run_folder.joinpath('beam.plt').write_text(self.test_message)
+        run_folder.joinpath('ImpactT.in').write_text(self.test_message)
+
+    # Test get_archive_format method
+    def test_get_archive_format_result(self):
+        assert run_batch.get_archive_format(None) is None
+        assert run_batch.get_archive_format('folder') is None
+        assert run_batch.get_archive_format('zip') == 'zip'
+
+    def test_get_archive_format_invalid_input(self, monkeypatch):
+        with pytest.raises(ValueError):
+            run_batch.get_archive_format('rar')
+        monkeypatch.setattr(shutil, 'which', lambda command: None)
+        with pytest.raises(OSError):
+            run_batch.get_archive_format('tar.zst')
+
+    # Test iter_archive_members method
+    def test_iter_archive_members_result(self, tmp_path):
+        self.make_output_files(tmp_path)
+        members = list(run_batch.iter_archive_members(
+            [tmp_path.joinpath('beam.plt'), tmp_path.joinpath('data')]))
+        assert members == [
+            (tmp_path.joinpath('beam.plt'), 'beam.plt'),
+            (tmp_path.joinpath('data', 'step1.h5'), 'data/step1.h5')]
+
+    # Test pack_zip method
+    def test_pack_zip_result(self, tmp_path):
+        self.make_output_files(tmp_path)
+        pack_file = tmp_path.joinpath('outputs.zip')
+        run_batch.pack_zip(run_batch.iter_archive_members(
+            [tmp_path.joinpath('beam.plt'), tmp_path.joinpath('data')]),
+            pack_file)
+        with zipfile.ZipFile(pack_file) as archive:
+            assert archive.read('data/step1.h5') == b'h5' * 700
+            assert archive.read('beam.plt').decode() == self.test_message
+
+    # Test pack_tar_zst method
+    def test_pack_tar_zst_result(self, tmp_path):
+        if not shutil.which('zstd'):
+            pytest.skip('zstd is not installed')
+        self.make_output_files(tmp_path)
+        pack_file = tmp_path.joinpath('outputs.tar.zst')
+        run_batch.pack_tar_zst(run_batch.iter_archive_members(
+            [tmp_path.joinpath('beam.plt'), tmp_path.joinpath('data')]),
+            pack_file)
+        tar_data = subprocess.run(['zstd', '-dc', str(pack_file)],
+                                  capture_output=True, check=True).stdout
+        with open(f'{pack_file}.index.json', 'r') as f:
+            index = json.load(f)
+        assert [member['name'] for member in index['members']] == [
+            'beam.plt', 'data/step1.h5']
+        assert len(index['frames']) == 1
+        member = index['members'][1]
+        assert tar_data[member['offset']:member['offset'] + member['size']
+                        ] == b'h5' * 700
+        with tarfile.open(fileobj=io.BytesIO(tar_data)) as archive:
+            assert archive.getnames() == ['beam.plt', 'data/step1.h5']
+            assert archive.extractfile('data/step1.h5').read() == b'h5' * 700
+
+    def test_pack_tar_zst_frames(self, monkeypatch, tmp_path):
+        if not shutil.which('zstd'):
+            pytest.skip('zstd is not installed')
+        monkeypatch.setattr(run_batch, 'PACK_FRAME_SIZE', 4096)
+        paths = []
+        for i in range(20):
+            paths.append(tmp_path.joinpath(f'file{i}.dat'))
+            paths[-1].write_bytes(bytes([i]) * 1000)
+        pack_file = tmp_path.joinpath('outputs.tar.zst')
+        run_batch.pack_tar_zst(run_batch.iter_archive_members(paths),
+                               pack_file)
+        with open(f'{pack_file}.index.json', 'r') as f:
+            index = json.load(f)
+        assert 1 < len(index['frames']) < len(paths)
+        assert index['frames'][0][0] == 0
+        assert sum([size for _, size in index['frames']]) == (
+            pack_file.stat().st_size)
+        for path in paths:
+            assert run_batch.read_packed_file(pack_file, path.name) == (
+                path.read_bytes())
+        tar_data = subprocess.run(['zstd', '-dc', str(pack_file)],
+                                  capture_output=True, check=True).stdout
+        with tarfile.open(fileobj=io.BytesIO(tar_data)) as archive:
+            assert len(archive.getnames()) == len(paths)
+
+    # Test read_packed_file method
+    def test_read_packed_file_result(self, tmp_path):
+        if not shutil.which('zstd'):
+            pytest.skip('zstd is not installed')
+        self.make_output_files(tmp_path)
+        pack_file = tmp_path.joinpath('outputs.tar.zst')
+        run_batch.pack_tar_zst(run_batch.iter_archive_members(
+            [tmp_path.joinpath('beam.plt'), tmp_path.joinpath('data')]),
+            pack_file)
+        assert run_batch.read_packed_file(pack_file, 'data/step1.h5') == (
+            b'h5' * 700)
+        assert run_batch.read_packed_file(pack_file, 'beam.plt') == (
+            tmp_path.joinpath('beam.plt').read_bytes())
+        with pytest.raises(ValueError):
+            run_batch.read_packed_file(pack_file, 'missing.h5')
+
+    # Test pack_output method
+    def test_pack_output_result(self, tmp_path):
+        run_folder = tmp_path.joinpath('run')
+        run_folder.mkdir()
+        self.make_output_files(run_folder)
+        archive_folder = tmp_path.joinpath('archive')
+        archive_folder.mkdir()
+        test_run = self.single_run.copy()
+        test_run.update({'archive': archive_folder, 'archive_format': 'zip'})
+        scan = run_batch.scan_run_folder(run_folder, ['*.in'],
+                                         ['*.plt', 'data'], [])
+        run_batch.pack_output(test_run, scan)
+        assert [path.name for path in archive_folder.iterdir()] == [
+            'outputs.zip']
+        assert [path.name for path in run_folder.iterdir()] == ['ImpactT.in']
+        with zipfile.ZipFile(archive_folder.joinpath('outputs.zip')) as f:
+            assert sorted(f.namelist()) == ['ImpactT.in', 'beam.plt',
+                                            'data/step1.h5']
+
+    # Test store_blob and get_blob_path methods
+    def test_store_blob_result(self, tmp_path):
+        blob_store = tmp_path.joinpath(run_batch.BLOB_STORE)
+        source = tmp_path.joinpath('beam.data')
+        source.write_text(self.test_message)
+        file_hash = run_batch.store_blob(blob_store, source)
+        assert file_hash == run_batch.get_file_hash(source)
+        blob = run_batch.get_blob_path(blob_store, file_hash)
+        assert blob == blob_store.joinpath(file_hash[:2], file_hash[2:])
+        assert blob.read_text() == self.test_message
+        assert not os.access(blob, os.W_OK) or os.geteuid() == 0
+        assert run_batch.store_blob(blob_store, source) == file_hash
+        assert len(list(blob.parent.iterdir())) == 1
+
+    # Test link_blob method
+    def test_link_blob_result(self, tmp_path):
+        blob = tmp_path.joinpath('blob')
+        blob.write_text(self.test_message)
+        destination = tmp_path.joinpath('beam.data')
+        destination.write_text('Old data')
+        run_batch.link_blob(blob, destination)
+        assert destination.read_text() == self.test_message
+        assert destination.stat().st_ino == blob.stat().st_ino
+
+    # Test dedup_to_archive method
+    def test_dedup_to_archive_result(self, tmp_path):
+        run_folder = tmp_path.joinpath('run')
+        run_folder.mkdir()
+        for filename in ['beam.data', 'lattice.xlsx']:
+            run_folder.joinpath(filename).write_text(self.test_message)
+        paths = sorted(run_folder.iterdir())
+        archive_folders = [tmp_path.joinpath('archive', name)
+                           for name in ['I-0.0', 'I-0.2']]
+        for archive_folder in archive_folders:
+            archive_folder.mkdir(parents=True)
+            run_batch.dedup_to_archive(tmp_path, archive_folder, paths)
+        blobs = [path for path in tmp_path.joinpath(
+            run_batch.BLOB_STORE).rglob('*') if path.is_file()]
+        assert len(blobs) == 1
+        assert blobs[0].stat().st_nlink == 5
+        with open(archive_folders[1].joinpath(run_batch.BLOB_MANIFEST)) as f:
+            manifest = json.load(f)
+        assert manifest == {
+            'beam.data': run_batch.get_file_hash(paths[0]),
+            'lattice.xlsx': run_batch.get_file_hash(paths[0])}
+        assert archive_folders[0].joinpath('lattice.xlsx').read_text() == (
+            self.test_message)
+
+    # Test index_run method
+    def index_test_runs(self, tmp_path):
+        runs = []
+        for parameters, branch in [('I:0.2,E:1.0', 'input/full'),
+                                   ('I:0.4,E:1.0', 'input/full'),
+                                   ('I:0.4,E:2.0', 'input/nospacecharge')]:
+            test_run = self.single_run.copy()
+            test_run.update({'--git': True,
+                             '--input_branch': branch,
+                             '-p': parameters,
+                             'archive': tmp_path.joinpath(
+                                 run_batch.get_safe_folder_name(
+                                     parameters + branch))})
+            test_run['archive'].mkdir()
+            test_run['archive'].joinpath('fort.1').write_text(
+                self.test_message)
+            run_batch.index_run(tmp_path, test_run)
+            runs.append(test_run)
+        return runs
+
+    def test_index_run_result(self, tmp_path):
+        runs = self.index_test_runs(tmp_path)
+        run_batch.index_run(tmp_path, runs[0])
+        found_runs = run_batch.query_archive_index(tmp_path)
+        assert [this_run['archive'] for this_run in found_runs] == (
+            [str(this_run['archive']) for this_run in runs[1:] + runs[:1]])
+        assert found_runs[0]['branch'] == 'input/full'
+        assert found_runs[0]['parameters'] == 'I:0.4,E:1.0'
+        assert found_runs[0]['size'] == len(self.test_message)
+        connection = run_batch.open_archive_index(tmp_path)
+        assert connection.execute(
+            'SELECT COUNT(*) FROM parameters').fetchone()[0] == 6
+        assert connection.execute(
+            'SELECT name, size FROM files').fetchall()[0] == (
+                'fort.1', len(self.test_message))
+        connection.close()
+
+    # Test query_archive_index method
+    def test_query_archive_index_result(self, tmp_path):
+        runs = self.index_test_runs(tmp_path)
+        def get_folders(**conditions):
+            if 'where' in conditions:
+                conditions['condition'] = run_batch.parse_condition(
+                    conditions.pop('where'))
+            return [this_run['archive'] for this_run in
+                    run_batch.query_archive_index(tmp_path, **conditions)]
+        folders = [str(this_run['archive']) for this_run in runs]
+        assert get_folders(where='I==0.4') == folders[1:]
+        assert get_folders(where='I==0.4', branches=['input/full']) == (
+            folders[1:2])
+        assert get_folders(where='I<0.3 or E>1.5') == (
+            [folders[0], folders[2]])
+        assert get_folders(where='0.3 < I*E < 0.5') == folders[1:2]
+        assert get_folders(where='not X==1') == []
+        today = datetime.today().strftime('%Y-%m-%d')
+        assert get_folders(since=today, until=today) == folders
+        assert get_folders(until='2000-01-01') == []
+        with pytest.raises(ValueError):
+            get_folders(since='last month')
+        with pytest.raises(ValueError):
+            get_folders(where='I**2 > 0.1')
+
+    def test_query_archive_index_no_index(self, tmp_path):
+        with pytest.raises(OSError):
+            run_batch.query_archive_index(tmp_path)
+
+    # Test run_query method
+    def test_run_query_result(self, capsys, monkeypatch, tmp_path):
+        runs = self.index_test_runs(tmp_path)
+        monkeypatch.setattr(run_batch, 'ARCHIVE_ROOT', str(tmp_path))
+        test_arguments = self.arguments.copy()
+        test_arguments.update({'query': True,
+                               '--input_branch': ['input/nospacecharge'],
+                               '--where': 'E>1.0'})
+        run_batch.run_query(test_arguments)
+        captured = capsys.readouterr()
+        assert str(runs[2]['archive']) in captured.out
+        assert '1 archived runs found' in captured.out
+
+    # Test prune_run method
+    def test_prune_run_result(self, tmp_path):
+        for filename in ['fort.1', 'ImpactT.dst', 'ImpactT.in', 'run.log']:
+            tmp_path.joinpath(filename).write_text(self.test_message)
+        run_batch.prune_run(tmp_path, 'impact')
+        assert sorted([path.name for path in tmp_path.iterdir()]) == (
+            ['ImpactT.dst', 'ImpactT.in', 'run.log'])
+
+    # Test compress_run method
+    def test_compress_run_result(self, tmp_path):
+        for filename in ['fort.1', 'beam.data', 'simulation.log']:
+            tmp_path.joinpath(filename).write_text(self.test_message)
+        tmp_path.joinpath(run_batch.BLOB_MANIFEST).write_text(
+            json.dumps({'beam.data': 'abc'}))
+        run_batch.compress_run(tmp_path, 'zip')
+        assert sorted([path.name for path in tmp_path.iterdir()]) == (
+            sorted(['beam.data', 'simulation.log', 'outputs.zip',
+                    run_batch.BLOB_MANIFEST]))
+        with zipfile.ZipFile(tmp_path.joinpath('outputs.zip')) as archive:
+            assert archive.namelist() == ['fort.1']
+
+    # Test apply_retention method
+    def test_apply_retention_result(self, capsys, tmp_path):
+        runs = self.index_test_runs(tmp_path)
+        connection = run_batch.open_archive_index(tmp_path)
+        with connection:
+            connection.execute("UPDATE runs SET class = 'impact'")
+            connection.execute("UPDATE runs SET tier = 'full', date = ?"
+                               " WHERE archive != ?",
+                               ('2000-01-01T00:00:00',
+                                str(runs[2]['archive'])))
+        run_batch.apply_retention(tmp_path, keep_full_days=30, jobs=2)
+        assert not runs[0]['archive'].joinpath('fort.1').exists()
+        assert not runs[1]['archive'].joinpath('fort.1').exists()
+        assert runs[2]['archive'].joinpath('fort.1').exists()
+        assert 'Applied retention to 2 archived runs' in (
+            capsys.readouterr().out)
+        run_batch.apply_retention(tmp_path, keep_full_days=30)
+        assert 'Applied retention to 0 archived runs' in (
+            capsys.readouterr().out)
+        runs[0]['archive'].joinpath('ImpactT.dst').write_text(
+            self.test_message)
+        run_batch.apply_retention(tmp_path, compress_days=3650)
+        assert runs[0]['archive'].joinpath('outputs.zip').is_file()
+        tiers = dict(connection.execute('SELECT archive, tier FROM runs'))
+        assert tiers[str(runs[0]['archive'])] == 'packed'
+        assert tiers[str(runs[2]['archive'])] == 'reduced'
+        connection.close()
+
+    def test_apply_retention_invalid_input(self, tmp_path):
+        with pytest.raises(ValueError):
+            run_batch.apply_retention(tmp_path)
+        with pytest.raises(ValueError):
+            run_batch.apply_retention(tmp_path, keep_full_days=30,
+                                      compress_days=10)
+        with pytest.raises(OSError):
+            run_batch.apply_retention(tmp_path, keep_full_days=30)
+        with pytest.raises(ValueError):
+            run_batch.get_days('-1', 'number of days')
+
+    # Test timed_stage method
+    def test_timed_stage_result(self):
+        test_run = self.single_run.copy()
+        for _ in range(2):
+            with run_batch.timed_stage(test_run, 'run'):
+                time.sleep(0.01)
+        with pytest.raises(OSError):
+            with run_batch.timed_stage(test_run, 'archive'):
+                raise OSError('Archive failed')
+        assert test_run['timings']['run'] >= 0.02
+        assert test_run['timings']['archive'] >= 0
+
+    # Test record_telemetry method
+    def test_record_telemetry_result(self, tmp_path):
+        test_run = self.single_run.copy()
+        test_run.update({'telemetry': tmp_path.joinpath(run_batch.TELEMETRY),
+                         'stage_times': dict(),
+                         '-p': 'I:0.4',
+                         'returncode': 0,
+                         'timings': {'run': 2.0, 'archive': 0.5}})
+        run_batch.record_telemetry(test_run)
+        run_batch.record_telemetry(dict(test_run, timings={'run': 1.0}))
+        assert test_run['stage_times'] == {'run': (2, 3.0),
+                                           'archive': (1, 0.5)}
+        with open(test_run['telemetry'], 'r') as f:
+            records = [json.loads(line) for line in f]
+        assert len(records) == 2
+        assert records[0]['parameters'] == 'I:0.4'
+        assert records[0]['timings'] == {'run': 2.0, 'archive': 0.5}
+        assert records[0]['total'] == 2.5
+        assert records[1]['returncode'] == 0
+
+    # Test show_stage_times method
+    def test_show_stage_times_result(self, capsys):
+        run_batch.show_stage_times({'archive': (2, 1.0), 'run': (2, 3.0)})
+        lines = capsys.readouterr().out.splitlines()[1:]
+        assert lines[0].split() == ['Stage', 'Runs', 'Total', 'Mean', 'Share']
+        assert lines[1].split() == ['run', '2', '3.00', 's', '1.500', 's',
+                                    '75.0%']
+        assert lines[2].split()[0] == 'archive'
+        run_batch.show_stage_times(dict())
+        assert capsys.readouterr().out == ''
+
+    # Test run_with_usage method
+    def test_run_with_usage_result(self):
+        command = [sys.executable, '-c',
+                   'x = bytearray(50 * 1024 * 1024); print("Hello world")']
+        result = run_batch.run_with_usage(command, stdout=subprocess.PIPE,
+                                          text=True)
+        assert result.returncode == 0
+        assert result.stdout == self.test_message + '\n'
+        assert result.usage['max_rss'] > 50 * 1024 * 1024
+        assert result.usage['wall_time'] > 0
+        assert result.usage['user_time'] + result.usage['system_time'] > 0
+        assert set(result.usage) == {
+            'wall_time', 'user_time', 'system_time', 'max_rss', 'block_input',
+            'block_output', 'voluntary_switches', 'involuntary_switches'}
+
+    def test_run_with_usage_returncode(self):
+        result = run_batch.run_with_usage(
+            [sys.executable, '-c', 'import sys; sys.exit(3)'])
+        assert result.returncode == 3
+        assert result.stdout is None
+        with pytest.raises(OSError):
+            run_batch.run_with_usage(['command-that-does-not-exist'])
+
+    # Test format_duration method
+    def test_format_duration_result(self):
+        assert run_batch.format_duration(7.4) == '7s'
+        assert run_batch.format_duration(187) == '3m 07s'
+        assert run_batch.format_duration(3900) == '1h 05m'
+
+    # Test get_run_history method
+    def test_get_run_history_result(self, tmp_path):
+        telemetry = tmp_path.joinpath(run_batch.TELEMETRY)
+        telemetry.write_text('{"hash": "a", "total": 2.0}\n'
+                             'not json\n'
+                             '{"hash": "a", "total": 4.0}\n'
+                             '{"hash": "b", "total": 1.0}\n')
+        assert run_batch.get_run_history(telemetry) == {'a': [2.0, 4.0],
+                                                        'b': [1.0]}
+        assert run_batch.get_run_history(tmp_path.joinpath('missing')) == {}
+
+    # Test progress methods
+    def test_progress_result(self, tmp_path):
+        stream = io.StringIO()
+        test_run = self.single_run.copy()
+        history = {run_batch.get_run_hash(test_run): [10.0]}
+        progress = run_batch.create_progress(4, history, 2, stream)
+        test_run['progress'] = progress
+        assert run_batch.get_expected_duration(progress) == 10.0
+        run_batch.start_progress_run(test_run)
+        assert 'about 20s left' in run_batch.get_progress_line(progress)
+        run_batch.finish_progress_run(test_run, 'completed')
+        run_batch.finish_progress_run(dict(test_run, title='Other run'),
+                                      'skipped')
+        other_run = dict(test_run, title='Failed run', **{'-p': 'I:1'})
+        run_batch.start_progress_run(other_run)
+        run_batch.finish_progress_run(other_run, 'failed')
+        run_batch.stop_progress(progress)
+        lines = stream.getvalue().splitlines()
+        assert lines[0].startswith('Completed: Test run in 0s (1/4 finished')
+        assert lines[1].startswith('Failed: Failed run in 0s (3/4 finished: '
+                                   '1 completed, 1 failed, 0 running')
+        assert lines[2].startswith('3/4 finished')
+        assert not progress['thread'].is_alive()
+
+    def test_get_run_count_result(self):
+        test_run = self.single_run.copy()
+        assert run_batch.get_run_count(test_run) == 1
+        test_run.update({'--sweep': ['I:1,2,3', 'E:1,2'],
+                         'title': 'Test run'})
+        assert run_batch.get_run_count(test_run) == 6
+        test_run.update({'--git': True, '--input_branch': ['a', 'b']})
+        assert run_batch.get_run_count(test_run) == 12
+        test_run['adapt'] = 5
+        assert run_batch.get_run_count(test_run) == 10
+
+    # Test fork server methods
+    def get_fork_server_settings(self, tmp_path):
+        reproduce = tmp_path.joinpath('reproduce')
+        reproduce.write_text(
+            'import sys, os, json\n'
+            'print(json.dumps({"arguments": sys.argv[1:],'
+            ' "cwd": os.getcwd()}))\n'
+            'if sys.argv[1] == "fail":\n'
+            '    sys.exit(4)\n')
+        run_folder = tmp_path.joinpath('run')
+        run_folder.mkdir()
+        return {'python': sys.executable,
+                'reproduce': reproduce,
+                'current_folder': run_folder,
+                'archive_log': self.archive_log}
+
+    def test_run_in_fork_server_result(self, tmp_path):
+        test_settings = self.get_fork_server_settings(tmp_path)
+        output = tmp_path.joinpath('output.json')
+        try:
+            result = run_batch.run_in_fork_server(
+                test_settings, ['run', '--', 'ImpactTexe'], stdout=output)
+            assert result.returncode == 0
+            assert result.usage['wall_time'] > 0
+            with open(output, 'r') as f:
+                assert json.load(f) == {
+                    'arguments': ['run', '--', 'ImpactTexe'],
+                    'cwd': str(test_settings['current_folder'])}
+            server = run_batch.get_fork_server(test_settings)
+            result = run_batch.run_in_fork_server(test_settings, ['fail'],
+                                                  stdout=output)
+            assert result.returncode == 4
+            assert run_batch.get_fork_server(test_settings) is server
+            run_batch.archive_log(test_settings,
+                                  test_settings['current_folder'],
+                                  fork_server=True)
+            with open(test_settings['current_folder'].joinpath(
+                    self.archive_log), 'r') as f:
+                assert json.load(f)['arguments'] == ['log', '-n1']
+        finally:
+            run_batch.stop_fork_servers()
+        assert server['process'].returncode == 0
+        assert server not in run_batch._fork_server_list
+
+    def test_run_in_fork_server_stopped(self, tmp_path):
+        test_settings = self.get_fork_server_settings(tmp_path)
+        try:
+            server = run_batch.get_fork_server(test_settings)
+            server['process'].kill()
+            server['process'].wait()
+            result = run_batch.run_in_fork_server(
+                test_settings, ['run'], stdout=tmp_path.joinpath('output'))
+            assert result.returncode == 0
+            assert run_batch.get_fork_server(test_settings) is not server
+        finally:
+            run_batch.stop_fork_servers()
+
+    # Test get_cached_python method
+    def test_get_cached_python_result(self, tmp_path):
+        reproducible = tmp_path.joinpath('Reproducible')
+        pyenv = tmp_path.joinpath('pyenv')
+        reproducible.mkdir()
+        pyenv.mkdir()
+        version_file = reproducible.joinpath('.python-version')
+        version_file.write_text('3.9.1\n')
+        test_python = run_batch.get_cached_python(reproducible, pyenv)
+        assert test_python == str(pyenv.joinpath('versions/3.9.1/bin/python3'))
+        version_file.write_text('3.10.2\n')
+        os.utime(version_file, ns=(0, 0))
+        assert run_batch.get_cached_python(reproducible, pyenv) == (
+            str(pyenv.joinpath('versions/3.10.2/bin/python3')))
+        version_file.unlink()
+        assert run_batch.get_cached_python(reproducible, pyenv) == 'python3'